@@ -0,0 +1,288 @@
+"""
+Stitches every dataset attached to the capsule in one run.
+The dataset folders with the stitching inputs are discovered
+under the data folder and run concurrently on a process pool.
+The pool is sized by the available CPUs and memory, which are
+split between the datasets in flight. Every dataset has its
+own results folder and log, and a summary of the throughput
+and the failures is written to the results folder.
+
+Run from the code folder:
+    python -m aind_proteomics_stitch.batch --data_root ../data \
+        --results_root ../results --registration
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from . import pipeline, planner, worker
+from .utils import resources
+
+logger = logging.getLogger(__name__)
+
+# Memory in bytes a dataset is expected to need at least
+MIN_DATASET_MEMORY = 4 * 1024**3
+
+
+def has_required_inputs(folder: str) -> bool:
+    """
+    Whether a folder has the stitching inputs of a dataset.
+    """
+    return all(
+        os.path.exists(os.path.join(folder, name)) for name in pipeline.REQUIRED_INPUTS
+    )
+
+
+def discover_datasets(data_root: str) -> List[str]:
+    """
+    Finds the dataset folders in the data folder: the data
+    folder itself, as read by run_capsule.py, or its
+    subfolders with the stitching inputs.
+
+    Parameters
+    ----------
+    data_root: str
+        Data folder of the capsule
+
+    Returns
+    -------
+    List[str]
+        Sorted dataset folders
+    """
+    if has_required_inputs(data_root):
+        return [str(data_root)]
+
+    return sorted(
+        entry.path
+        for entry in os.scandir(data_root)
+        if entry.is_dir() and has_required_inputs(entry.path)
+    )
+
+
+def plan_workers(
+    n_datasets: int,
+    cpus: Optional[int] = None,
+    memory_bytes: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    min_dataset_memory: int = MIN_DATASET_MEMORY,
+) -> Tuple[int, int, int]:
+    """
+    Number of datasets run concurrently and the share of
+    the resources of each of them.
+
+    Parameters
+    ----------
+    n_datasets: int
+        Number of datasets
+    cpus: Optional[int]
+        Available CPUs. Default: None (discovered)
+    memory_bytes: Optional[int]
+        Available memory in bytes. Default: None (discovered)
+    max_workers: Optional[int]
+        Maximum number of datasets in flight. Default: None
+    min_dataset_memory: int
+        Memory in bytes a dataset needs at least.
+        Default: MIN_DATASET_MEMORY
+
+    Returns
+    -------
+    Tuple[int, int, int]
+        Number of workers, and CPUs and memory in bytes
+        of every worker
+    """
+    if cpus is None or memory_bytes is None:
+        available_cpus, available_memory = planner.get_available_resources()
+        cpus = available_cpus if cpus is None else cpus
+        memory_bytes = available_memory if memory_bytes is None else memory_bytes
+
+    workers = min(n_datasets, cpus, max(1, memory_bytes // min_dataset_memory))
+    if max_workers is not None:
+        workers = min(workers, max_workers)
+    workers = max(1, workers)
+
+    return workers, max(1, cpus // workers), memory_bytes // workers
+
+
+def _init_worker(cpus: int, memory_bytes: int) -> None:
+    """
+    Limits the resources seen by the planner of the
+    datasets run in a worker to its share.
+    """
+    os.environ[resources.CPUS_ENV] = str(cpus)
+    os.environ[resources.MEMORY_ENV] = str(memory_bytes)
+
+
+def run_batch(
+    datasets: List[str],
+    results_root: str,
+    overrides: Optional[Dict] = None,
+    registration: bool = False,
+    max_workers: Optional[int] = None,
+) -> Dict:
+    """
+    Stitches datasets concurrently on a process pool.
+
+    Parameters
+    ----------
+    datasets: List[str]
+        Dataset folders
+    results_root: str
+        Folder with a results folder per dataset, named as
+        the dataset folder. A single dataset is written to
+        it directly, as run_capsule.py does
+    overrides: Optional[Dict]
+        Overrides of pipeline.OVERRIDES applied to every
+        dataset. Default: None
+    registration: bool
+        Whether to compute the registration in process.
+        Default: False
+    max_workers: Optional[int]
+        Maximum number of datasets in flight. Default: None
+
+    Returns
+    -------
+    Dict
+        Summary of the batch with the result of every dataset
+    """
+    workers, worker_cpus, worker_memory = plan_workers(
+        len(datasets), max_workers=max_workers
+    )
+    logger.info(
+        f"Stitching {len(datasets)} datasets with {workers} workers, "
+        f"{worker_cpus} CPUs and {worker_memory / 1024 ** 3:.1f} GiB each"
+    )
+
+    jobs = [
+        {
+            "job_id": Path(dataset).name,
+            "data_folder": str(dataset),
+            "results_folder": str(
+                Path(results_root).joinpath(Path(dataset).name)
+                if len(datasets) > 1
+                else Path(results_root)
+            ),
+            "overrides": overrides or {},
+            "registration": registration,
+        }
+        for dataset in datasets
+    ]
+
+    results = []
+    start = perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(worker_cpus, worker_memory),
+    ) as executor:
+        futures = {executor.submit(worker.run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process died
+                result = {
+                    "job_id": job["job_id"],
+                    "status": "failed",
+                    "outputs": {},
+                    "seconds": None,
+                    "timings": {},
+                    "error": repr(e),
+                }
+            logger.info(f"Dataset {result['job_id']}: {result['status']}")
+            results.append({"data_folder": job["data_folder"], **result})
+    seconds = perf_counter() - start
+
+    results = sorted(results, key=lambda result: result["job_id"])
+    failed = [result for result in results if result["status"] != "done"]
+    dataset_seconds = sum(result["seconds"] or 0.0 for result in results)
+    return {
+        "datasets": len(results),
+        "done": len(results) - len(failed),
+        "failed": [result["job_id"] for result in failed],
+        "workers": workers,
+        "worker_cpus": worker_cpus,
+        "worker_memory_bytes": worker_memory,
+        "seconds": seconds,
+        "datasets_per_hour": 3600 * len(results) / seconds if seconds else None,
+        # Sum of the time of the datasets over the wall time
+        "concurrency": dataset_seconds / seconds if seconds else None,
+        "results": results,
+    }
+
+
+def main(
+    data_root: str,
+    results_root: str,
+    overrides: Optional[Dict] = None,
+    registration: bool = False,
+    max_workers: Optional[int] = None,
+) -> int:
+    """
+    Discovers the datasets, stitches them and writes the
+    summary to batch_summary.json in the results folder.
+
+    Returns
+    -------
+    int
+        Exit code, 1 if there are no datasets or any of
+        them failed
+    """
+    datasets = discover_datasets(data_root)
+    if not len(datasets):
+        logger.error(f"No datasets with {pipeline.REQUIRED_INPUTS} in {data_root}")
+        return 1
+
+    summary = run_batch(
+        datasets,
+        results_root,
+        overrides=overrides,
+        registration=registration,
+        max_workers=max_workers,
+    )
+
+    os.makedirs(results_root, exist_ok=True)
+    with open(os.path.join(results_root, "batch_summary.json"), "w") as f:
+        json.dump(summary, f, indent=4)
+
+    logger.info(
+        f"Stitched {summary['done']}/{summary['datasets']} datasets in "
+        f"{summary['seconds']:.1f}s ({summary['datasets_per_hour']:.1f} per hour, "
+        f"concurrency {summary['concurrency']:.2f})"
+    )
+    for result in summary["results"]:
+        if result["status"] != "done":
+            logger.error(
+                f"Dataset {result['job_id']} failed: "
+                f"{(result['error'] or '').strip().splitlines()[-1:]}"
+            )
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data_root", type=str, default="../data")
+    parser.add_argument("--results_root", type=str, default="../results")
+    parser.add_argument("--set", type=str, nargs="*", default=None)
+    parser.add_argument("--registration", action="store_true")
+    parser.add_argument("--max_workers", type=int, default=None)
+    parser.add_argument("--log_level", type=str, default="INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    sys.exit(
+        main(
+            args.data_root,
+            args.results_root,
+            overrides=worker.parse_overrides(args.set),
+            registration=args.registration,
+            max_workers=args.max_workers,
+        )
+    )
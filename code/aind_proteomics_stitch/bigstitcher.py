@@ -3,18 +3,29 @@ Computes stitching transformations using
 bigstitcher for proteomics data structure
 """
 
+import argparse
 import json
-import math
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from time import time
-from typing import List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-from aind_data_schema.core.processing import DataProcess, ProcessName
+import numpy as np
 
 from . import (__maintainers__, __pipeline_version__, __version__,
-               bigstitcher_utilities)
-from .utils import utils
+               bigstitcher_utilities, metadata_reader, planner,
+               result_cache, validation, xml_streaming)
+from .utils import profiling, utils
+
+# aind_data_schema is imported when the processing metadata
+# is built, since it dominates the import time of the module
+if TYPE_CHECKING:
+    from aind_data_schema.core.processing import DataProcess
+
+# Stage timings written next to the processing metadata
+SPANS_FILE = "stitching_spans.json"
 
 
 def validate_capsule_inputs(input_elements: List[str]) -> List[str]:
@@ -102,7 +113,12 @@ def get_data_config(
 
 
 def get_stitching_dict(
-    specimen_id: str, dataset_xml_path: str, downsample: Optional[int] = 2
+    specimen_id: str,
+    dataset_xml_path: str,
+    downsample: Optional[int] = 2,
+    memgb: Optional[int] = None,
+    parallel: Optional[int] = None,
+    plan: Optional[dict] = None,
 ) -> dict:
     """
     A function that writes a stitching dictioonary that will be used for
@@ -116,6 +132,13 @@ def get_stitching_dict(
         Path where the xml is located
     downsample: Optional[int] = 2
         Image multiscale used for stitching
+    memgb: Optional[int] = None
+        Memory in GB of the JVM. Default: 100
+    parallel: Optional[int] = None
+        Number of parallel workers. Default: the CPU limit
+    plan: Optional[dict] = None
+        Choice of the registration planner, recorded
+        in the parameters if provided
 
     Returns
     -------
@@ -128,8 +151,10 @@ def get_stitching_dict(
     max_shift = 100 // (downsample + 1)
     stitching_dict = {
         "session_id": str(specimen_id),
-        "memgb": 100,
-        "parallel": utils.get_code_ocean_cpu_limit(),
+        "memgb": 100 if memgb is None else int(memgb),
+        "parallel": (
+            utils.get_code_ocean_cpu_limit() if parallel is None else int(parallel)
+        ),
         "dataset_xml": str(dataset_xml_path),
         "do_phase_correlation": True,
         "do_detection": False,
@@ -142,39 +167,267 @@ def get_stitching_dict(
             "max_shift_in_z": max_shift,
         },
     }
+    if plan is not None:
+        stitching_dict["planner"] = plan
     return stitching_dict
 
 
-def get_estimated_downsample(
-    voxel_resolution: List[float], phase_corr_res: Tuple[float] = (8.0, 8.0, 4.0)
-) -> int:
+def group_by_channel(tile_metadata: List[dict]) -> Dict[int, List[dict]]:
     """
-    Estimate the multiscale level (power-of-two downsampling) such that
-    the resolution at that level is at least the phase_corr_res in all axes.
+    Groups the tile metadata records by channel wavelength.
 
     Parameters
     ----------
-    voxel_resolution : List[float]
-        Resolution of the original image at level 0 (in XYZ order).
-    phase_corr_res : Tuple[float]
-        Target resolution for phase correlation (in XYZ order).
+    tile_metadata: List[dict]
+        Tile metadata records
 
     Returns
     -------
-    int
-        Estimated downsample level (0 or higher).
+    Dict[int, List[dict]]
+        Records of each channel wavelength, in their
+        original order
+    """
+    wavelengths = np.array(
+        [int(t["channel_wavelength"]) for t in tile_metadata], dtype=np.int64
+    )
+    channels, inverse, counts = np.unique(
+        wavelengths, return_inverse=True, return_counts=True
+    )
+    order = np.argsort(inverse, kind="stable")
+    groups = np.split(order, np.cumsum(counts)[:-1])
+    return {
+        int(channel): [tile_metadata[i] for i in group]
+        for channel, group in zip(channels, groups)
+    }
+
+
+def write_channel_outputs(
+    channel_metadata: List[dict],
+    path_to_data: str,
+    channel_wavelength: int,
+    voxel_resolution: List[float],
+    output_json_file: str,
+    results_folder: Path,
+    proteomics_dataset_name: str,
+    res_for_transforms: Tuple[float] = (0.19, 0.19, 0.85),
+    scale_for_transforms: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    validate_tiles: bool = True,
+    write_tile_metadata: bool = True,
+) -> Tuple[str, "DataProcess"]:
     """
+    Writes the tile metadata, BigStitcher XML and stitching
+    parameters of a channel, or restores them from the
+    result cache.
+
+    Parameters
+    ----------
+    channel_metadata: List[dict]
+        Tile metadata records of the channel
+    path_to_data: str
+        Path to the tiles
+    channel_wavelength: int
+        Channel wavelength
+    voxel_resolution: List[float]
+        Voxel resolution in order XYZ
+    output_json_file: str
+        Path where the tile metadata json will be written
+    results_folder: Path
+        Results folder
+    proteomics_dataset_name: str
+        Proteomics dataset name
+    res_for_transforms: Tuple[float]
+        Resolution used to estimate the transforms
+    scale_for_transforms: Optional[int]
+        Multiscale used to estimate the transforms. If
+        provided, res_for_transforms is ignored. Otherwise
+        the planner chooses it
+    cache_dir: Optional[str]
+        Result cache directory
+    validate_tiles: bool
+        Whether to check every tile store before writing
+        the outputs. Default: True
+    write_tile_metadata: bool
+        Whether to write the tile metadata json. The XML is
+        built from the records in memory, so the json is only
+        needed by later stages. Default: True
+
+    Returns
+    -------
+    Tuple[str, DataProcess]
+        Path to the stitching parameters json and
+        processing metadata of the channel
+    """
+    start_time = time()
+    recorder = profiling.SpanRecorder()
+
+    zarr_path = str(path_to_data)
+    if not zarr_path.startswith("s3://"):
+        zarr_path = os.path.abspath(zarr_path)
+
+    output_big_stitcher_xml = f"{results_folder}/{proteomics_dataset_name}_stitching_channel_{channel_wavelength}.xml"
+
+    # Columns of the channel shared by the planner and the XML writer
+    table = bigstitcher_utilities.TileTable.from_records(channel_metadata, microns=True)
+
+    # The tile metadata json is written in the background while
+    # the registration is planned and the tiles are checked
+    tile_metadata_written = None
+    if write_tile_metadata:
+
+        def save_tile_metadata():
+            with recorder.span("write_tile_metadata"):
+                utils.save_dict_as_json(
+                    filename=output_json_file, dictionary=channel_metadata
+                )
 
-    levels = []
-    for vres, cres in zip(voxel_resolution, phase_corr_res):
-        if cres < vres:
-            raise ValueError(
-                "phase_corr_res must be greater than or equal to voxel_resolution."
+        json_writer = ThreadPoolExecutor(max_workers=1)
+        tile_metadata_written = json_writer.submit(save_tile_metadata)
+        json_writer.shutdown(wait=False)
+
+    output_big_stitcher_json = f"{results_folder}/{proteomics_dataset_name}_stitch_channel_{channel_wavelength}_params.json"
+
+    cache_dir = result_cache.get_cache_dir(cache_dir)
+
+    def lookup_cache(level):
+        # The key leaves out the parameters sized by the planner,
+        # so it can be looked up before planning if the level is known
+        with recorder.span("cache_lookup"):
+            key = result_cache.compute_cache_key(
+                channel_metadata=channel_metadata,
+                path_to_data=path_to_data,
+                channel_wavelength=channel_wavelength,
+                scale_for_transforms=level,
+                stitching_dict=get_stitching_dict(
+                    specimen_id=proteomics_dataset_name,
+                    dataset_xml_path=output_big_stitcher_xml,
+                    downsample=level,
+                ),
+            )
+            return key, result_cache.load_entry(cache_dir, key)
+
+    cache_key = None
+    cached_files = None
+    if cache_dir is not None and scale_for_transforms is not None:
+        cache_key, cached_files = lookup_cache(int(scale_for_transforms))
+
+    if cached_files is None:
+        with recorder.span("plan_registration"):
+            plan = planner.plan_registration(
+                tile_metadata=table,
+                res_for_transforms=res_for_transforms,
+                level=scale_for_transforms,
+                pyramid=planner.get_pyramid(
+                    f"{path_to_data}/{channel_metadata[0]['file']}"
+                ),
             )
-        ratio = cres / vres
-        levels.append(math.floor(math.log2(ratio)))
 
-    return max(levels)
+        if cache_dir is not None and plan["level"] != scale_for_transforms:
+            cache_key, cached_files = lookup_cache(plan["level"])
+        scale_for_transforms = plan["level"]
+
+    else:
+        # The pyramid is not opened on a hit, the cached plan
+        # is sized again to the resources of this node
+        with open(cached_files["params_json"], "r") as f:
+            plan = planner.resize_plan(json.load(f)["planner"])
+        scale_for_transforms = plan["level"]
+
+    # Cached outputs were written from tiles that were checked
+    if validate_tiles and cached_files is None:
+        with recorder.span("validate_tiles"):
+            validation.check_tiles(
+                path_to_data=path_to_data,
+                tile_metadata=channel_metadata,
+                level=scale_for_transforms,
+            )
+
+    # print(f"Voxel resolution: {voxel_resolution} - Estimating transforms in res: {res_for_transforms} - Scale: {scale_for_transforms}")
+    proteomics_stitching_params = get_stitching_dict(
+        specimen_id=proteomics_dataset_name,
+        dataset_xml_path=output_big_stitcher_xml,
+        downsample=scale_for_transforms,
+        memgb=plan["memgb"],
+        parallel=plan["parallel"],
+        plan=plan,
+    )
+
+    output_files = {
+        "dataset_xml": output_big_stitcher_xml,
+        "params_json": output_big_stitcher_json,
+    }
+    if tile_metadata_written is not None:
+        tile_metadata_written.result()
+        output_files["tile_metadata"] = str(output_json_file)
+
+    if cached_files is not None:
+        # The tile metadata json, if requested, was written
+        # from the same records that produced the cache key
+        cached_files.pop("tile_metadata", None)
+        with recorder.span("cache_restore"):
+            restored_files = result_cache.restore_entry(
+                cached_files=cached_files,
+                destinations=output_files,
+                default_folder=str(results_folder),
+            )
+        # The cached parameters may have been sized for another node
+        with open(output_big_stitcher_json, "w") as f:
+            json.dump(proteomics_stitching_params, f, indent=4)
+        notes = (
+            f"Creation of stitching parameters, restored from cache entry {cache_key}"
+        )
+
+    else:
+        restored_files = {}
+        with recorder.span("write_xml"):
+            xml_streaming.write_table_xml_streaming(
+                table=table,
+                path=output_big_stitcher_xml,
+                s3_data_path=zarr_path,
+                data_path_type="relative",
+            )
+
+        with recorder.span("write_params"):
+            with open(output_big_stitcher_json, "w") as f:
+                json.dump(proteomics_stitching_params, f, indent=4)
+
+        if cache_dir is not None:
+            with recorder.span("cache_store"):
+                result_cache.store_entry(cache_dir, cache_key, output_files)
+        notes = "Creation of stitching parameters"
+
+    if cache_dir is not None:
+        result_cache.write_record(
+            params_json=output_big_stitcher_json,
+            cache_dir=cache_dir,
+            key=cache_key,
+            restored=restored_files,
+        )
+    else:
+        result_cache.remove_record(output_big_stitcher_json)
+    end_time = time()
+
+    # Stage timings of the channel, also aggregated
+    # in the spans of the process
+    notes = f"{notes}. Timings: {recorder.format()}"
+    profiling.get_recorder().merge(recorder, prefix=f"channel_{channel_wavelength}")
+
+    from aind_data_schema.core.processing import DataProcess, ProcessName
+
+    data_process = DataProcess(
+        name=ProcessName.IMAGE_TILE_ALIGNMENT,
+        software_version="1.2.11",
+        start_date_time=start_time,
+        end_date_time=end_time,
+        input_location=str(proteomics_dataset_name),
+        output_location=str(output_big_stitcher_json),
+        outputs={"output_file": str(output_big_stitcher_json)},
+        code_url="",
+        code_version=__version__,
+        parameters=proteomics_stitching_params,
+        notes=notes,
+    )
+    return output_big_stitcher_json, data_process
 
 
 def main(
@@ -188,6 +441,9 @@ def main(
     res_for_transforms=(0.19, 0.19, 0.85),
     scale_for_transforms=None,
     full_extension=".ome.zarr",
+    cache_dir=None,
+    validate_tiles=True,
+    write_tile_metadata=True,
 ):
     """
     Computes image stitching with BigStitcher using Phase Correlation
@@ -204,88 +460,333 @@ def main(
         Results folder
     proteomics_dataset_name: str
         Proteomics dataset name
+    cache_dir: Optional[str]
+        Result cache directory. If None, it is read from the
+        STITCH_RESULT_CACHE_DIR environment variable and
+        caching is disabled when that is not set either
+    validate_tiles: bool
+        Whether to check every tile store before writing
+        the outputs
+    write_tile_metadata: bool
+        Whether to write the tile metadata json of the channel
+
+    Returns
+    -------
+    str
+        Path to the stitching parameters json
     """
-    start_time = time()
     metadata_folder = results_folder.joinpath("metadata")
     utils.create_folder(str(metadata_folder))
 
-    tile_metadata = utils.read_json_as_dict(path_to_tile_metadata)
-    channel_metadata = []
+    # Only the records of the channel are kept in memory
+    with profiling.span("read_tile_metadata"):
+        channel_metadata = metadata_reader.read_tile_metadata(
+            path_to_tile_metadata, [channel_wavelength], full_extension
+        )
 
-    for t in tile_metadata:
-        tilename = Path(t["file"]).stem.replace(full_extension, "")
-        t["file"] = f"{tilename}{full_extension}"
-        absolute_tile_path = f"{path_to_data}/{t['file']}"
-        # print(absolute_tile_path)
-        # if not absolute_tile_path.exists():
-        #     raise ValueError(f"Tile path {absolute_tile_path} does not exist!")
+    output_big_stitcher_json, data_process = write_channel_outputs(
+        channel_metadata=channel_metadata,
+        path_to_data=path_to_data,
+        channel_wavelength=channel_wavelength,
+        voxel_resolution=voxel_resolution,
+        output_json_file=output_json_file,
+        results_folder=results_folder,
+        proteomics_dataset_name=proteomics_dataset_name,
+        res_for_transforms=res_for_transforms,
+        scale_for_transforms=scale_for_transforms,
+        cache_dir=cache_dir,
+        validate_tiles=validate_tiles,
+        write_tile_metadata=write_tile_metadata,
+    )
 
-        if int(channel_wavelength) == int(t["channel_wavelength"]):
-            channel_metadata.append(t)
+    with profiling.span("generate_processing"):
+        utils.generate_processing(
+            data_processes=[data_process],
+            dest_processing=metadata_folder,
+            processor_full_name=__maintainers__[0],
+            pipeline_version=__pipeline_version__,
+        )
 
-    utils.save_dict_as_json(filename=output_json_file, dictionary=channel_metadata)
+    profiling.get_recorder().write(str(metadata_folder.joinpath(SPANS_FILE)))
 
-    tree = bigstitcher_utilities.parse_json(
-        json_path=output_json_file,
-        s3_data_path=str(path_to_data),
-        data_path_type="relative",
-        microns=True,
-    )
-    zarr_path_xml = tree.find("SequenceDescription").find("ImageLoader").find("zarr")
-    if not zarr_path_xml.text.startswith("s3://"):
-        zarr_path_xml.text = os.path.abspath(zarr_path_xml.text)
+    # Printing to get output on batch script
+    print(output_big_stitcher_json)
+    return output_big_stitcher_json
+
+
+def main_all_channels(
+    path_to_data: str,
+    path_to_tile_metadata: str,
+    voxel_resolution: List[float],
+    results_folder: Path,
+    proteomics_dataset_name: str,
+    stitching_channel: Optional[int] = None,
+    registered_xml: Optional[str] = None,
+    res_for_transforms: Tuple[float] = (0.19, 0.19, 0.85),
+    scale_for_transforms: Optional[int] = None,
+    full_extension: str = ".ome.zarr",
+    cache_dir: Optional[str] = None,
+    max_workers: Optional[int] = None,
+    validate_tiles: bool = True,
+    write_tile_metadata: bool = True,
+) -> Dict[int, str]:
+    """
+    Writes the BigStitcher XML and stitching parameters of every
+    channel in one pass. The tile metadata is read once, grouped
+    by channel and the outputs of the channels are written
+    concurrently.
 
-    output_big_stitcher_xml = f"{results_folder}/{proteomics_dataset_name}_stitching_channel_{channel_wavelength}.xml"
+    If the registered XML of the stitching channel is provided,
+    its transforms are copied to the XMLs of the other channels,
+    which are written with a _registered suffix, instead of
+    registering every channel.
+
+    Parameters
+    ----------
+    path_to_data: str
+        Path to the tiles
+    path_to_tile_metadata: str
+        Path to the tile metadata of all channels
+    voxel_resolution: List[float]
+        Voxel resolution in order XYZ
+    results_folder: Path
+        Results folder
+    proteomics_dataset_name: str
+        Proteomics dataset name
+    stitching_channel: Optional[int]
+        Channel whose registration is copied to the other ones.
+        Required if registered_xml is provided. Default: None
+    registered_xml: Optional[str]
+        Registered XML of the stitching channel. Default: None
+    res_for_transforms: Tuple[float]
+        Resolution used to estimate the transforms
+    scale_for_transforms: Optional[int]
+        Multiscale used to estimate the transforms. If
+        provided, res_for_transforms is ignored
+    full_extension: str
+        Extension of the tiles. Default: ".ome.zarr"
+    cache_dir: Optional[str]
+        Result cache directory. Default: None
+    max_workers: Optional[int]
+        Number of channels written at the same time.
+        Default: None (the CPU limit)
+    validate_tiles: bool
+        Whether to check every tile store before writing
+        the outputs. Default: True
+    write_tile_metadata: bool
+        Whether to write the tile metadata json of every
+        channel. Default: True
 
-    bigstitcher_utilities.write_xml(tree, output_big_stitcher_xml)
+    Returns
+    -------
+    Dict[int, str]
+        Path to the stitching parameters json of each channel
+    """
+    if registered_xml is not None and stitching_channel is None:
+        raise ValueError("The stitching channel is required to copy its registration")
 
-    if scale_for_transforms is None:
-        scale_for_transforms = get_estimated_downsample(
-            voxel_resolution=voxel_resolution, phase_corr_res=res_for_transforms
+    metadata_folder = results_folder.joinpath("metadata")
+    utils.create_folder(str(metadata_folder))
+
+    with profiling.span("read_tile_metadata"):
+        tile_metadata = metadata_reader.read_tile_metadata(
+            path_to_tile_metadata, full_extension=full_extension
         )
 
-    scale_for_transforms = int(scale_for_transforms)
+    with profiling.span("group_by_channel"):
+        channel_groups = group_by_channel(tile_metadata)
 
-    # print(f"Voxel resolution: {voxel_resolution} - Estimating transforms in res: {res_for_transforms} - Scale: {scale_for_transforms}")
-    proteomics_stitching_params = get_stitching_dict(
-        specimen_id=proteomics_dataset_name,
-        dataset_xml_path=output_big_stitcher_xml,
-        downsample=scale_for_transforms,
-    )
-    end_time = time()
+    if stitching_channel is not None and int(stitching_channel) not in channel_groups:
+        raise ValueError(
+            f"Stitching channel {stitching_channel} not in {list(channel_groups)}"
+        )
 
-    output_big_stitcher_json = f"{results_folder}/{proteomics_dataset_name}_stitch_channel_{channel_wavelength}_params.json"
+    if max_workers is None:
+        max_workers = utils.get_code_ocean_cpu_limit()
+
+    max_workers = max(1, min(max_workers, len(channel_groups)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            channel: executor.submit(
+                write_channel_outputs,
+                channel_metadata=channel_metadata,
+                path_to_data=path_to_data,
+                channel_wavelength=channel,
+                voxel_resolution=voxel_resolution,
+                output_json_file=results_folder.joinpath(
+                    f"{proteomics_dataset_name}_channel_{channel}_tile_metadata.json"
+                ),
+                results_folder=results_folder,
+                proteomics_dataset_name=proteomics_dataset_name,
+                res_for_transforms=res_for_transforms,
+                scale_for_transforms=scale_for_transforms,
+                cache_dir=cache_dir,
+                validate_tiles=validate_tiles,
+                write_tile_metadata=write_tile_metadata,
+            )
+            for channel, channel_metadata in channel_groups.items()
+        }
+        outputs = {channel: future.result() for channel, future in futures.items()}
+
+    if registered_xml is not None:
+        stitching_params = utils.read_json_as_dict(outputs[int(stitching_channel)][0])
+        for channel, (params_json, _) in outputs.items():
+            if channel == int(stitching_channel):
+                continue
+
+            dataset_xml = utils.read_json_as_dict(params_json)["dataset_xml"]
+            propagate_registration(
+                source_xml=stitching_params["dataset_xml"],
+                registered_xml=registered_xml,
+                target_xml=dataset_xml,
+                output_xml=str(Path(dataset_xml).with_suffix("")) + "_registered.xml",
+            )
 
-    data_processes = []
-    data_processes.append(
-        DataProcess(
-            name=ProcessName.IMAGE_TILE_ALIGNMENT,
-            software_version="1.2.11",
-            start_date_time=start_time,
-            end_date_time=end_time,
-            input_location=str(proteomics_dataset_name),
-            output_location=str(output_big_stitcher_json),
-            outputs={"output_file": str(output_big_stitcher_json)},
-            code_url="",
-            code_version=__version__,
-            parameters=proteomics_stitching_params,
-            notes="Creation of stitching parameters",
+    with profiling.span("generate_processing"):
+        utils.generate_processing(
+            data_processes=[data_process for _, data_process in outputs.values()],
+            dest_processing=metadata_folder,
+            processor_full_name=__maintainers__[0],
+            pipeline_version=__pipeline_version__,
         )
-    )
 
-    utils.generate_processing(
-        data_processes=data_processes,
-        dest_processing=metadata_folder,
-        processor_full_name=__maintainers__[0],
-        pipeline_version=__pipeline_version__,
-    )
+    profiling.get_recorder().write(str(metadata_folder.joinpath(SPANS_FILE)))
 
-    with open(output_big_stitcher_json, "w") as f:
-        json.dump(proteomics_stitching_params, f, indent=4)
+    return {channel: params_json for channel, (params_json, _) in outputs.items()}
 
-    # Printing to get output on batch script
-    print(output_big_stitcher_json)
+
+def get_tile_key(tile_name: str) -> str:
+    """
+    Name of a tile without its channel, shared by the
+    tiles of every channel acquired at the same position.
+
+    Parameters
+    ----------
+    tile_name: str
+        Name of the tile
+
+    Returns
+    -------
+    str
+        Tile name without the channel
+    """
+    if "ch" in tile_name:
+        return tile_name.rsplit("_", 1)[0]
+    return tile_name
+
+
+def propagate_registration(
+    source_xml: str, registered_xml: str, target_xml: str, output_xml: str
+) -> int:
+    """
+    Copies the transforms added by the registration of a channel
+    to the tiles of another channel at the same positions.
+
+    Parameters
+    ----------
+    source_xml: str
+        XML of the registered channel before the registration
+    registered_xml: str
+        XML of the registered channel after the registration
+    target_xml: str
+        XML of the channel that receives the transforms
+    output_xml: str
+        Path of the registered XML of the target channel
+
+    Returns
+    -------
+    int
+        Number of tiles that received a transform
+    """
+    source = bigstitcher_utilities.parse_xml(source_xml)
+    registered = bigstitcher_utilities.parse_xml(registered_xml)
+    target = bigstitcher_utilities.parse_xml(target_xml)
+
+    # Registered affine = registration @ nominal affine
+    bottom = np.array([0.0, 0.0, 0.0, 1.0])
+    registrations = {}
+    for tile, source_affine, registered_affine in zip(
+        source["tiles"], source["tile_affines"], registered["tile_affines"]
+    ):
+        registration = np.vstack([registered_affine, bottom]) @ np.linalg.inv(
+            np.vstack([source_affine, bottom])
+        )
+        registrations[get_tile_key(tile)] = registration[:3]
+
+    setup_ids = []
+    affines = []
+    for setup_id, tile in zip(target["setup_ids"], target["tiles"]):
+        registration = registrations.get(get_tile_key(tile))
+        if registration is not None:
+            setup_ids.append(setup_id)
+            affines.append(registration)
+
+    return xml_streaming.update_view_registrations(
+        xml_path=target_xml,
+        affines=np.array(affines).reshape(-1, 3, 4),
+        output_path=output_xml,
+        setup_ids=setup_ids,
+    )
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Writes the BigStitcher XML and stitching parameters"
+    )
+    parser.add_argument("--path_to_data", type=str, required=True)
+    parser.add_argument("--path_to_tile_metadata", type=str, required=True)
+    parser.add_argument("--voxel_resolution", type=float, nargs=3, required=True)
+    parser.add_argument("--results_folder", type=str, required=True)
+    parser.add_argument("--dataset_name", type=str, required=True)
+    parser.add_argument("--channel", type=int, default=None)
+    parser.add_argument("--all_channels", action="store_true")
+    parser.add_argument("--registered_xml", type=str, default=None)
+    parser.add_argument(
+        "--res_for_transforms", type=float, nargs=3, default=[0.19, 0.19, 0.85]
+    )
+    parser.add_argument("--scale_for_transforms", type=int, default=None)
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--skip_validation", action="store_true")
+    parser.add_argument("--log_level", type=str, default="INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    results_folder = Path(args.results_folder)
+
+    if args.all_channels:
+        params_jsons = main_all_channels(
+            path_to_data=args.path_to_data,
+            path_to_tile_metadata=args.path_to_tile_metadata,
+            voxel_resolution=args.voxel_resolution,
+            results_folder=results_folder,
+            proteomics_dataset_name=args.dataset_name,
+            stitching_channel=args.channel,
+            registered_xml=args.registered_xml,
+            res_for_transforms=tuple(args.res_for_transforms),
+            scale_for_transforms=args.scale_for_transforms,
+            cache_dir=args.cache_dir,
+            validate_tiles=not args.skip_validation,
+        )
+        print(json.dumps(params_jsons, indent=4))
+
+    else:
+        if args.channel is None:
+            parser.error("--channel is required without --all_channels")
+        if args.registered_xml is not None:
+            parser.error("--registered_xml requires --all_channels")
+
+        main(
+            path_to_data=args.path_to_data,
+            channel_wavelength=args.channel,
+            path_to_tile_metadata=args.path_to_tile_metadata,
+            voxel_resolution=args.voxel_resolution,
+            output_json_file=results_folder.joinpath(
+                f"{args.dataset_name}_tile_metadata.json"
+            ),
+            results_folder=results_folder,
+            proteomics_dataset_name=args.dataset_name,
+            res_for_transforms=tuple(args.res_for_transforms),
+            scale_for_transforms=args.scale_for_transforms,
+            cache_dir=args.cache_dir,
+            validate_tiles=not args.skip_validation,
+        )
@@ -4,12 +4,14 @@ This module provides functions to convert JSON metadata files into XML format
 suitable for BigStitcher, a software for stitching large image datasets.
 """
 
-import json
 import xml.etree.ElementTree as ET
 from pathlib import Path
+from typing import Iterable, Optional, Union
 
 import numpy as np
 
+from . import metadata_reader
+
 
 def get_tile_channel(tile_name: str) -> int:
     """
@@ -72,9 +74,143 @@ def extract_tile_channel_numbers(json_dict: dict) -> list[int]:
     return tile_channel_list
 
 
+# Positions closer than this fraction of the tile extent along
+# an axis are stage jitter within a row, not a grid step
+ROW_TOLERANCE = 0.1
+
+
+def infer_axis_grid(
+    positions: np.ndarray, tolerance: float = 0.0, split_ratio: float = 10.0
+) -> tuple[np.ndarray, float]:
+    """
+    Infers the grid index of every position along one axis.
+
+    Positions are sorted and split into rows wherever the gap
+    to the previous position is larger than the tolerance and
+    clearly larger than the stage jitter. The jitter/step
+    boundary is the last jump of at least split_ratio between
+    consecutive sorted gaps; without such a jump all gaps above
+    the tolerance are taken as grid steps. The spacing is fitted
+    to the row centers so missing rows are allowed.
+
+    Parameters
+    ----------
+    positions : np.ndarray
+        Positions of the tiles along one axis.
+    tolerance : float, optional
+        Largest offset between positions of the same row, in
+        the units of the positions. Positions spread less than
+        this are a single row. Defaults to 0.0.
+    split_ratio : float, optional
+        Minimum ratio between a grid step and the jitter.
+        Defaults to 10.0.
+
+    Returns
+    -------
+    tuple[np.ndarray, float]
+        Integer grid index of every position, starting at 0,
+        and the inferred grid spacing (0.0 for a single row).
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    order = np.argsort(positions, kind="stable")
+    gaps = np.diff(positions[order])
+
+    positive_gaps = np.sort(gaps[gaps > tolerance])
+    if not len(positive_gaps) or np.ptp(positions) <= tolerance:
+        return np.zeros(len(positions), dtype=int), 0.0
+
+    ratios = positive_gaps[1:] / positive_gaps[:-1]
+    jumps = np.flatnonzero(ratios >= split_ratio)
+    if len(jumps):
+        jump = jumps[-1]
+        threshold = np.sqrt(positive_gaps[jump] * positive_gaps[jump + 1])
+    elif tolerance > 0:
+        threshold = tolerance
+    else:
+        threshold = positive_gaps[0] / 2
+    threshold = max(threshold, tolerance)
+
+    # Row of every sorted position and the center of every row
+    rows = np.concatenate([[0], np.cumsum(gaps > threshold)])
+    centers = np.bincount(rows, weights=positions[order]) / np.bincount(rows)
+
+    indices = np.empty(len(positions), dtype=int)
+    if len(centers) == 1:
+        indices[order] = 0
+        return indices, 0.0
+
+    center_gaps = np.diff(centers)
+    steps = np.maximum(np.round(center_gaps / np.median(center_gaps)), 1)
+    spacing = center_gaps.sum() / steps.sum()
+
+    indices[order] = np.round((centers - centers[0]) / spacing).astype(int)[rows]
+    return indices, float(spacing)
+
+
+def positions_to_grid_indices(
+    positions: list[list[float]], tile_extents: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Computes the x, y, z grid indices of tile positions.
+
+    Parameters
+    ----------
+    positions : list[list[float]]
+        Tile positions (x, y, z).
+    tile_extents : Optional[np.ndarray], optional
+        Tile extents (x, y, z) in the units of the positions,
+        per tile or shared by all of them. Positions closer
+        than ROW_TOLERANCE of the extent along an axis share
+        a row. Defaults to None (only the gaps are used).
+
+    Returns
+    -------
+    np.ndarray
+        Array (n, 3) with the x, y, z grid index of each tile.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    grid_indices = np.zeros(positions.shape, dtype=int)
+
+    tolerances = np.zeros(3)
+    if tile_extents is not None and len(positions):
+        extents = np.asarray(tile_extents, dtype=np.float64).reshape(-1, 3)
+        tolerances = ROW_TOLERANCE * np.min(extents, axis=0)
+
+    for axis in range(3):
+        grid_indices[:, axis] = infer_axis_grid(
+            positions[:, axis], tolerance=tolerances[axis]
+        )[0]
+
+    return grid_indices
+
+
+def get_tile_grid_indices(json_dict: dict) -> np.ndarray:
+    """
+    Computes the x, y, z grid indices of every tile in one pass.
+
+    Parameters
+    ----------
+    json_dict : dict
+        Dictionary containing tile metadata.
+
+    Returns
+    -------
+    np.ndarray
+        Array (n, 3) with the x, y, z grid index of each tile.
+    """
+    if not len(json_dict):
+        return np.zeros((0, 3), dtype=int)
+
+    tile_extents = np.asarray(extract_tile_sizes(json_dict), dtype=np.float64) * (
+        np.asarray(extract_tile_resolution(json_dict, microns=True), dtype=np.float64)
+    )
+    return positions_to_grid_indices(extract_tile_translations(json_dict), tile_extents)
+
+
 def tile_number_to_position(tile_number: int, json_dict: dict) -> tuple[int, int, int]:
     """
     Converts a tile number to its x, y, z position.
+    Use get_tile_grid_indices when converting every tile.
 
     Parameters
     ----------
@@ -88,24 +224,8 @@ def tile_number_to_position(tile_number: int, json_dict: dict) -> tuple[int, int
     tuple[int, int, int]
         x, y, z position of the tile.
     """
-    position_list = [item["position"] for item in json_dict]
-    x_position_list = [item[0] for item in position_list]
-    y_position_list = [item[1] for item in position_list]
-
-    sorted_x_position_list = sorted(np.unique(x_position_list))
-    x_min = sorted_x_position_list[1]
-
-    sorted_y_position_list = sorted(np.unique(y_position_list))
-    y_min = sorted_y_position_list[1]
-
-    tile_x_pos = [np.round(item[0] / x_min) for item in position_list]
-    tile_y_pos = [np.round(item[1] / y_min) for item in position_list]
-    tile_z_pos = [0 for _ in position_list]
-
-    x_pos = int(tile_x_pos[tile_number])
-    y_pos = int(tile_y_pos[tile_number])
-    z_pos = int(tile_z_pos[tile_number])
-    return x_pos, y_pos, z_pos
+    x_pos, y_pos, z_pos = get_tile_grid_indices(json_dict)[tile_number]
+    return int(x_pos), int(y_pos), int(z_pos)
 
 
 def extract_tile_names_unaltered(json_dict: dict) -> list[str]:
@@ -422,38 +542,238 @@ def add_view_registrations(parent: ET.Element, translations: list[list[float]])
         vr.append(vt)
 
 
-def parse_json(
-    json_path: str, s3_data_path: str, data_path_type: str = "absolute", microns=False
+class TileTable:
+    """
+    Columnar tile metadata backed by NumPy arrays.
+
+    Built in a single pass over the tile metadata records, it
+    replaces the per-tile dicts and lists with one array per
+    field. Sorting, channel selection and slicing return new
+    tables and are done with array indexing.
+
+    Attributes
+    ----------
+    files : np.ndarray
+        File of every tile, as in the records.
+    channels : np.ndarray
+        Channel number parsed from every file name.
+    wavelengths : np.ndarray
+        Channel wavelength of every tile.
+    sizes : np.ndarray
+        Array (n, 3) of tile sizes in voxels (x, y, z).
+    positions : np.ndarray
+        Array (n, 3) of tile positions (x, y, z).
+    resolution : list[float]
+        Tile resolution, as returned by extract_tile_resolution.
+    """
+
+    def __init__(
+        self,
+        files: np.ndarray,
+        channels: np.ndarray,
+        wavelengths: np.ndarray,
+        sizes: np.ndarray,
+        positions: np.ndarray,
+        resolution: list[float],
+    ):
+        """
+        Class constructor
+
+        Parameters
+        ----------
+        files : np.ndarray
+            File of every tile.
+        channels : np.ndarray
+            Channel number parsed from every file name.
+        wavelengths : np.ndarray
+            Channel wavelength of every tile.
+        sizes : np.ndarray
+            Tile sizes in voxels (x, y, z).
+        positions : np.ndarray
+            Tile positions (x, y, z).
+        resolution : list[float]
+            Tile resolution.
+        """
+        self.files = np.asarray(files, dtype=object)
+        self.channels = np.asarray(channels, dtype=np.int64)
+        self.wavelengths = np.asarray(wavelengths, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 3)
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        self.resolution = list(resolution)
+
+    @classmethod
+    def from_records(cls, json_dict: Iterable[dict], microns=False) -> "TileTable":
+        """
+        Builds the table from tile metadata records.
+
+        Parameters
+        ----------
+        json_dict : Iterable[dict]
+            Tile metadata records. They are read once, so an
+            iterator such as metadata_reader.iter_tile_metadata
+            is allowed.
+        microns : bool, optional
+            Whether the pixel resolution is already in microns.
+            Defaults to False.
+
+        Returns
+        -------
+        TileTable
+            Table with the tiles in the order of the records.
+        """
+        files = []
+        channels = []
+        wavelengths = []
+        sizes = []
+        positions = []
+        first = None
+        for row in json_dict:
+            if first is None:
+                first = row
+            channel = get_tile_channel(row["file"])
+            files.append(row["file"])
+            channels.append(channel)
+            wavelengths.append(row.get("channel_wavelength", channel))
+            sizes.append(row["size"])
+            positions.append(row["position"])
+
+        resolution = [] if first is None else extract_tile_resolution([first], microns)
+        return cls(files, channels, wavelengths, sizes, positions, resolution)
+
+    @classmethod
+    def from_json(
+        cls,
+        json_path: str,
+        channels: Optional[Iterable[int]] = None,
+        full_extension: Optional[str] = None,
+        microns=False,
+    ) -> "TileTable":
+        """
+        Builds the table from a tile metadata json without
+        loading the records of other channels.
+
+        Parameters
+        ----------
+        json_path : str
+            Path to the tile metadata json.
+        channels : Iterable[int], optional
+            Channel wavelengths to keep. Defaults to every channel.
+        full_extension : str, optional
+            Extension the files are normalized to. Defaults to
+            keeping the files as they are.
+        microns : bool, optional
+            Whether the pixel resolution is already in microns.
+            Defaults to False.
+
+        Returns
+        -------
+        TileTable
+            Table with the tiles in the order of the file.
+        """
+        return cls.from_records(
+            metadata_reader.iter_tile_metadata(json_path, channels, full_extension),
+            microns=microns,
+        )
+
+    def __len__(self) -> int:
+        """
+        Number of tiles in the table.
+        """
+        return len(self.files)
+
+    def __getitem__(self, index) -> "TileTable":
+        """
+        Selects tiles with a slice, integer indices or a
+        boolean mask.
+        """
+        if isinstance(index, (int, np.integer)):
+            index = [index]
+        return TileTable(
+            self.files[index],
+            self.channels[index],
+            self.wavelengths[index],
+            self.sizes[index],
+            self.positions[index],
+            self.resolution,
+        )
+
+    def sorted(self) -> "TileTable":
+        """
+        Sorts the tiles by file, keeping the order of
+        repeated files.
+
+        Returns
+        -------
+        TileTable
+            Sorted table.
+        """
+        return self[np.argsort(self.files, kind="stable")]
+
+    def select_channels(self, wavelengths: Iterable[int]) -> "TileTable":
+        """
+        Selects the tiles of some channel wavelengths.
+
+        Parameters
+        ----------
+        wavelengths : Iterable[int]
+            Channel wavelengths to keep.
+
+        Returns
+        -------
+        TileTable
+            Tiles of the channels in their original order.
+        """
+        wavelengths = np.asarray([int(w) for w in wavelengths], dtype=np.int64)
+        return self[np.isin(self.wavelengths, wavelengths)]
+
+    def tile_names(self) -> list[str]:
+        """
+        Tile names with the .zarr extension, as written in
+        the BigStitcher XML.
+
+        Returns
+        -------
+        list[str]
+            Name of every tile.
+        """
+        return [f"{Path(file).stem}.zarr" for file in self.files]
+
+
+def build_xml_tree(
+    tiles: Union[list[dict], TileTable],
+    s3_data_path: str,
+    data_path_type: str = "absolute",
+    microns=False,
 ) -> ET.ElementTree:
     """
-    Parses a JSON file and converts it into an XML ElementTree for BigStitcher.
+    Builds the BigStitcher XML ElementTree of tiles in memory.
 
     Parameters
     ----------
-    json_path : str
-        Path to the JSON file containing tile metadata.
+    tiles : Union[list[dict], TileTable]
+        Tile metadata records or a tile table.
     s3_data_path : str
         Path to the S3 bucket or local directory where the data is stored.
+    data_path_type : str, optional
+        Type of the data path, absolute or relative. Defaults to "absolute".
     microns : bool, optional
-        Whether to return pixel resolution in microns. Defaults to False.
+        Whether the pixel resolution of the records is already in
+        microns. Ignored for a tile table. Defaults to False.
 
     Returns
     -------
     ET.ElementTree
-        An XML ElementTree representing the parsed data.
+        An XML ElementTree with the tiles sorted by file.
     """
-    # Nested helper functions are documented inline for clarity.
-
-    # Main logic of the function
-    with open(json_path, "r") as f:
-        json_dict = json.load(f)
+    if not isinstance(tiles, TileTable):
+        tiles = TileTable.from_records(tiles, microns=microns)
 
-    json_dict.sort(key=lambda e: e["file"])
-    tile_names = extract_tile_names_unaltered(json_dict)
-    tile_sizes = extract_tile_sizes(json_dict)
-    tile_resolution = extract_tile_resolution(json_dict, microns=microns)
-    tile_translations = extract_tile_translations(json_dict)
-    tile_channel_numbers = extract_tile_channel_numbers(json_dict)
+    table = tiles.sorted()
+    tile_names = table.tile_names()
+    tile_sizes = table.sizes.tolist()
+    tile_resolution = table.resolution
+    tile_translations = table.positions.tolist()
+    tile_channel_numbers = table.channels.tolist()
 
     spim_data = ET.Element("SpimData")
     spim_data.attrib["version"] = "0.2"
@@ -475,6 +795,34 @@ def parse_json(
     return spim_data
 
 
+def parse_json(
+    json_path: str, s3_data_path: str, data_path_type: str = "absolute", microns=False
+) -> ET.ElementTree:
+    """
+    Parses a JSON file and converts it into an XML ElementTree for BigStitcher.
+    Use build_xml_tree when the tile metadata is already in memory.
+
+    Parameters
+    ----------
+    json_path : str
+        Path to the JSON file containing tile metadata.
+    s3_data_path : str
+        Path to the S3 bucket or local directory where the data is stored.
+    microns : bool, optional
+        Whether to return pixel resolution in microns. Defaults to False.
+
+    Returns
+    -------
+    ET.ElementTree
+        An XML ElementTree representing the parsed data.
+    """
+    return build_xml_tree(
+        TileTable.from_json(json_path, microns=microns),
+        s3_data_path=s3_data_path,
+        data_path_type=data_path_type,
+    )
+
+
 def write_xml(tree: ET.ElementTree, path: str) -> None:
     """
     Writes an XML ElementTree to a file.
@@ -494,6 +842,87 @@ def write_xml(tree: ET.ElementTree, path: str) -> None:
     tree.write(path, encoding="utf-8", xml_declaration=True)
 
 
+def parse_affine(affine_text: str) -> np.ndarray:
+    """
+    Parses the text of a BigStitcher affine element.
+
+    Parameters
+    ----------
+    affine_text : str
+        Twelve space separated values in row-major order.
+
+    Returns
+    -------
+    np.ndarray
+        Affine transformation as a (4, 4) matrix.
+    """
+    affine = np.eye(4)
+    affine[:3, :] = np.array(affine_text.split(), dtype=np.float64).reshape(3, 4)
+    return affine
+
+
+def parse_xml(xml_path: str) -> dict:
+    """
+    Reads the tile metadata back from a BigStitcher XML.
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the BigStitcher XML.
+
+    Returns
+    -------
+    dict
+        Dictionary with the zarr path, the tile names, the tile
+        sizes in XYZ order, the tile resolution and the tile
+        translations and affines obtained by composing every
+        ViewTransform of each ViewRegistration. Entries are
+        ordered by setup id.
+    """
+    root = ET.parse(xml_path).getroot()
+    img_loader = root.find("SequenceDescription").find("ImageLoader")
+    zarr_xml = img_loader.find("zarr")
+    zarr_path = zarr_xml.text
+
+    if zarr_xml.attrib.get("type") == "relative" and not zarr_path.startswith("s3://"):
+        zarr_path = str(Path(xml_path).parent.joinpath(zarr_path).resolve())
+
+    tile_paths = {
+        int(zg.attrib["setup"]): zg.find("path").text
+        for zg in img_loader.find("zgroups")
+    }
+
+    tile_sizes = {}
+    tile_resolution = None
+    view_setups = root.find("SequenceDescription").find("ViewSetups")
+    for vs in view_setups.findall("ViewSetup"):
+        setup_id = int(vs.find("id").text)
+        tile_sizes[setup_id] = [int(s) for s in vs.find("size").text.split()]
+        if tile_resolution is None:
+            tile_resolution = [
+                float(r) for r in vs.find("voxelSize").find("size").text.split()
+            ]
+
+    tile_affines = {}
+    for vr in root.find("ViewRegistrations").findall("ViewRegistration"):
+        affine = np.eye(4)
+        for vt in vr.findall("ViewTransform"):
+            affine = affine @ parse_affine(vt.find("affine").text)
+        tile_affines[int(vr.attrib["setup"])] = affine[:3, :]
+
+    setup_ids = sorted(tile_paths)
+    affines = np.array([tile_affines[i] for i in setup_ids])
+    return {
+        "zarr_path": zarr_path,
+        "setup_ids": setup_ids,
+        "tiles": [tile_paths[i] for i in setup_ids],
+        "tile_sizes": [tile_sizes[i] for i in setup_ids],
+        "tile_resolution": tile_resolution,
+        "tile_translations": affines[:, :, 3].tolist(),
+        "tile_affines": affines,
+    }
+
+
 def convert_json_to_xml(json_loc: str, s3_data_path: str, xml_name: str = None) -> None:
     """
     Converts a JSON file to an XML file for BigStitcher.
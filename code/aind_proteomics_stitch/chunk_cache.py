@@ -0,0 +1,295 @@
+"""
+Process-wide LRU cache of encoded zarr chunks with a
+byte budget, placed in front of the tile stores so the
+chunks shared by several overlapping pairs are fetched
+only once.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from zarr.storage import Store
+
+METADATA_KEYS = (".zarray", ".zattrs", ".zgroup", ".zmetadata")
+
+
+class ChunkCache:
+    """
+    Thread-safe LRU cache with a byte budget.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Creates an empty cache.
+
+        Parameters
+        ----------
+        max_bytes: int
+            Maximum number of bytes kept in the cache
+        """
+        self.max_bytes = int(max_bytes)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """
+        Gets a value and marks it as the most recently used.
+
+        Parameters
+        ----------
+        key: Hashable
+            Cache key
+
+        Returns
+        -------
+        Optional[bytes]
+            Cached value or None on a miss
+        """
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self._values.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        """
+        Stores a value, evicting the least recently used
+        values until it fits. Values larger than the
+        budget are not stored.
+
+        Parameters
+        ----------
+        key: Hashable
+            Cache key
+        value: bytes
+            Value to store
+        """
+        size = len(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._values.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= len(previous)
+
+            while self._values and self.current_bytes + size > self.max_bytes:
+                _, evicted = self._values.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+
+            self._values[key] = value
+            self.current_bytes += size
+
+    def clear(self) -> None:
+        """
+        Removes every value and resets the counters.
+        """
+        with self._lock:
+            self._values.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the cache counters.
+
+        Returns
+        -------
+        Dict[str, int]
+            Hits, misses, evictions, entries and bytes in use
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._values),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class CachedStore(Store):
+    """
+    Read-only zarr store wrapper that serves the chunks of a
+    tile from a ChunkCache keyed by (tile, level, chunk index).
+    Misses of a batched read are fetched with a single
+    getitems call to the wrapped store when it supports it.
+    """
+
+    def __init__(self, store: MutableMapping, tile_name: str, cache: ChunkCache):
+        """
+        Wraps a store.
+
+        Parameters
+        ----------
+        store: MutableMapping
+            Store of an OME-Zarr tile
+        tile_name: str
+            Name of the tile, used in the cache keys
+        cache: ChunkCache
+            Cache shared by every tile
+        """
+        self.store = store
+        self.tile_name = tile_name
+        self.cache = cache
+        self._readable = True
+        self._writeable = False
+        self._erasable = False
+        self._listable = True
+
+    def _cache_key(self, key: str) -> Optional[Tuple[str, str, Tuple[int, ...]]]:
+        """
+        Cache key of a chunk, None for metadata keys.
+        """
+        if key.endswith(METADATA_KEYS) or "/" not in key:
+            return None
+
+        level, chunk = key.split("/", 1)
+        try:
+            chunk_index = tuple(int(c) for c in chunk.replace("/", ".").split("."))
+        except ValueError:
+            return None
+
+        return self.tile_name, level, chunk_index
+
+    def __getitem__(self, key: str) -> bytes:
+        cache_key = self._cache_key(key)
+        if cache_key is None:
+            return self.store[key]
+
+        value = self.cache.get(cache_key)
+        if value is None:
+            value = self.store[key]
+            self.cache.put(cache_key, value)
+
+        return value
+
+    def getitems(self, keys: Sequence[str], *, contexts=None) -> Dict[str, bytes]:
+        values = {}
+        missing = []
+        for key in keys:
+            cache_key = self._cache_key(key)
+            value = None if cache_key is None else self.cache.get(cache_key)
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+
+        if missing:
+            if hasattr(self.store, "getitems"):
+                fetched = self.store.getitems(missing, contexts=contexts)
+            else:
+                fetched = {key: self.store[key] for key in missing if key in self.store}
+
+            for key, value in fetched.items():
+                cache_key = self._cache_key(key)
+                if cache_key is not None:
+                    self.cache.put(cache_key, value)
+                values[key] = value
+
+        return values
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.store
+
+    def __setitem__(self, key: str, value: bytes) -> None:
+        raise PermissionError("CachedStore is read-only")
+
+    def __delitem__(self, key: str) -> None:
+        raise PermissionError("CachedStore is read-only")
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+
+_chunk_cache = None
+
+
+def get_chunk_cache() -> ChunkCache:
+    """
+    Returns the process-wide chunk cache. Its budget is read
+    from STITCH_CHUNK_CACHE_GB on first use (default 2 GB).
+
+    Returns
+    -------
+    ChunkCache
+        Chunk cache of this process
+    """
+    global _chunk_cache
+    if _chunk_cache is None:
+        max_gb = float(os.environ.get("STITCH_CHUNK_CACHE_GB", 2))
+        _chunk_cache = ChunkCache(max_bytes=int(max_gb * 1024**3))
+    return _chunk_cache
+
+
+def get_serpentine_order(grid_indices: np.ndarray) -> np.ndarray:
+    """
+    Orders tiles in a serpentine (boustrophedon) path: x goes
+    back and forth along each row, and y goes back and forth
+    along each z plane, so consecutive tiles are neighbours.
+
+    Parameters
+    ----------
+    grid_indices: np.ndarray
+        Array (n, 3) with the x, y, z grid index of each tile
+
+    Returns
+    -------
+    np.ndarray
+        Rank of each tile in the path
+    """
+    grid_indices = np.asarray(grid_indices).reshape(-1, 3)
+    x, y, z = grid_indices.T
+    y_path = np.where(z % 2 == 0, y, -y)
+    row = np.unique(np.stack([z, y_path], axis=1), axis=0, return_inverse=True)[1]
+    x_path = np.where(row.ravel() % 2 == 0, x, -x)
+
+    order = np.lexsort((x_path, y_path, z))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank
+
+
+def get_serpentine_pair_order(
+    grid_indices: np.ndarray, pairs: List[Tuple[int, int]]
+) -> np.ndarray:
+    """
+    Orders tile pairs following the serpentine path of their
+    tiles, so the chunks of a tile are reused by its pairs
+    before they are evicted from the cache.
+
+    Parameters
+    ----------
+    grid_indices: np.ndarray
+        Array (n, 3) with the x, y, z grid index of each tile
+    pairs: List[Tuple[int, int]]
+        Pairs of tile indices
+
+    Returns
+    -------
+    np.ndarray
+        Indices of the pairs in traversal order
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    rank = get_serpentine_order(grid_indices)
+    pair_ranks = np.sort(rank[pairs], axis=1)
+    return np.lexsort((pair_ranks[:, 0], pair_ranks[:, 1]))
@@ -0,0 +1,299 @@
+"""
+Computes globally consistent tile translations from
+pairwise shifts with a sparse weighted least squares
+solve and iterative rejection of inconsistent links.
+"""
+
+import argparse
+import json
+import logging
+from pathlib import Path
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import factorized
+
+from . import bigstitcher_utilities, xml_streaming
+
+logger = logging.getLogger(__name__)
+
+
+def get_links(
+    pairwise_shifts: List[Dict], setup_ids: List[int]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Converts the pairwise shifts into link arrays.
+
+    Parameters
+    ----------
+    pairwise_shifts: List[Dict]
+        Pairwise shifts as returned by
+        phase_correlation.compute_pairwise_shifts
+    setup_ids: List[int]
+        Setup ids of the tiles. Tiles are indexed
+        by their position in this list
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        Tile index pairs (m, 2), shifts (m, 3) in
+        microns (XYZ) and correlations (m,)
+    """
+    setup_to_tile = {setup_id: i for i, setup_id in enumerate(setup_ids)}
+    links = np.array(
+        [
+            [setup_to_tile[link["setup_a"]], setup_to_tile[link["setup_b"]]]
+            for link in pairwise_shifts
+        ],
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    shifts = np.array(
+        [link["shift"] for link in pairwise_shifts], dtype=np.float64
+    ).reshape(-1, 3)
+    correlations = np.array(
+        [link["correlation"] for link in pairwise_shifts], dtype=np.float64
+    )
+    return links, shifts, correlations
+
+
+def solve_translations(
+    n_tiles: int,
+    links: np.ndarray,
+    shifts: np.ndarray,
+    weights: np.ndarray,
+    anchors: Optional[List[int]] = None,
+) -> np.ndarray:
+    """
+    Solves the weighted least squares problem
+    c[b] - c[a] = shift for every link (a, b).
+
+    Every connected component of the link graph is anchored
+    at one tile, whose correction is fixed to zero. Tiles
+    without links are not moved.
+
+    Parameters
+    ----------
+    n_tiles: int
+        Number of tiles
+    links: np.ndarray
+        Tile index pairs (m, 2)
+    shifts: np.ndarray
+        Shifts (m, 3) of the second tile of each link
+    weights: np.ndarray
+        Weight (m,) of each link
+    anchors: Optional[List[int]]
+        Preferred anchor tiles. Components without one are
+        anchored at their lowest tile index. Default: None
+
+    Returns
+    -------
+    np.ndarray
+        Correction (n_tiles, 3) to apply to each tile
+    """
+    corrections = np.zeros((n_tiles, 3))
+    if not len(links):
+        return corrections
+
+    rows = np.arange(len(links))
+    incidence = sparse.csr_matrix(
+        (
+            np.concatenate([-np.ones(len(links)), np.ones(len(links))]),
+            (np.concatenate([rows, rows]), np.concatenate([links[:, 0], links[:, 1]])),
+        ),
+        shape=(len(links), n_tiles),
+    )
+
+    _, component = connected_components(incidence.T @ incidence, directed=False)
+    component_anchor = {}
+    for anchor in anchors or []:
+        component_anchor.setdefault(component[anchor], anchor)
+    for tile in range(n_tiles):
+        component_anchor.setdefault(component[tile], tile)
+
+    # Anchored and isolated tiles are removed from the unknowns
+    linked = np.zeros(n_tiles, dtype=bool)
+    linked[links.ravel()] = True
+    free = linked.copy()
+    free[list(component_anchor.values())] = False
+    free_tiles = np.flatnonzero(free)
+    if not len(free_tiles):
+        return corrections
+
+    system = incidence[:, free_tiles]
+    weighted_system = system.T @ sparse.diags(weights)
+    solve = factorized((weighted_system @ system).tocsc())
+    rhs = weighted_system @ shifts
+
+    corrections[free_tiles] = np.stack([solve(rhs[:, axis]) for axis in range(3)], 1)
+    return corrections
+
+
+def optimize_translations(
+    n_tiles: int,
+    links: np.ndarray,
+    shifts: np.ndarray,
+    correlations: np.ndarray,
+    anchors: Optional[List[int]] = None,
+    absolute_threshold: float = 3.5,
+    relative_threshold: float = 2.5,
+    max_iterations: int = 100,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Solves the tile translations and iteratively drops the links
+    whose residual is above both the absolute threshold and the
+    relative threshold times the mean residual. Only the links
+    with a residual of at least half of the worst one are dropped
+    in each iteration, so a single bad link does not take its
+    consistent neighbours with it.
+
+    Parameters
+    ----------
+    n_tiles: int
+        Number of tiles
+    links: np.ndarray
+        Tile index pairs (m, 2)
+    shifts: np.ndarray
+        Shifts (m, 3) in microns of the second tile of each link
+    correlations: np.ndarray
+        Correlation (m,) of each link, used as its weight
+    anchors: Optional[List[int]]
+        Preferred anchor tiles. Default: None
+    absolute_threshold: float
+        Residual in microns below which a link is always kept.
+        Default: 3.5
+    relative_threshold: float
+        Residual relative to the mean residual below which a link
+        is always kept. Default: 2.5
+    max_iterations: int
+        Maximum number of solve iterations. Default: 100
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Correction (n_tiles, 3) in microns to apply to each tile
+        and mask (m,) of the links kept in the final solution
+    """
+    kept = np.ones(len(links), dtype=bool)
+    weights = np.clip(correlations, 1e-3, None)
+
+    for iteration in range(max_iterations):
+        corrections = solve_translations(
+            n_tiles, links[kept], shifts[kept], weights[kept], anchors
+        )
+        if not kept.any():
+            break
+
+        residuals = np.linalg.norm(
+            corrections[links[:, 1]] - corrections[links[:, 0]] - shifts, axis=1
+        )
+        kept_residuals = np.where(kept, residuals, 0)
+        worst = kept_residuals.max()
+        threshold = max(absolute_threshold, relative_threshold * residuals[kept].mean())
+
+        if worst <= threshold:
+            break
+
+        to_drop = kept_residuals >= max(threshold, worst / 2)
+        kept &= ~to_drop
+        logger.info(
+            f"Iteration {iteration}: dropped {to_drop.sum()} links, "
+            f"worst residual {worst:.3f}, threshold {threshold:.3f}"
+        )
+    else:
+        corrections = solve_translations(
+            n_tiles, links[kept], shifts[kept], weights[kept], anchors
+        )
+
+    return corrections, kept
+
+
+def main(
+    input_json: str,
+    output_xml: Optional[str] = None,
+    absolute_threshold: float = 3.5,
+    relative_threshold: float = 2.5,
+) -> str:
+    """
+    Computes the global tile translations from a pairwise
+    shifts json and writes them as a new ViewTransform of
+    every ViewRegistration of the dataset XML.
+
+    Parameters
+    ----------
+    input_json: str
+        Pairwise shifts json written by phase_correlation.main
+    output_xml: Optional[str]
+        Path of the registered XML. Default: None
+        (dataset XML name with a _registered suffix)
+    absolute_threshold: float
+        Residual in microns below which a link is always kept.
+        Default: 3.5
+    relative_threshold: float
+        Residual relative to the mean residual below which a link
+        is always kept. Default: 2.5
+
+    Returns
+    -------
+    str
+        Path to the registered XML
+    """
+    start_time = time()
+    with open(input_json, "r") as f:
+        pairwise_data = json.load(f)
+
+    dataset_xml = pairwise_data["dataset_xml"]
+    dataset = bigstitcher_utilities.parse_xml(dataset_xml)
+    links, shifts, correlations = get_links(
+        pairwise_data["pairwise_shifts"], dataset["setup_ids"]
+    )
+
+    corrections, kept = optimize_translations(
+        n_tiles=len(dataset["setup_ids"]),
+        links=links,
+        shifts=shifts,
+        correlations=correlations,
+        absolute_threshold=absolute_threshold,
+        relative_threshold=relative_threshold,
+    )
+
+    affines = np.zeros((len(corrections), 3, 4))
+    affines[:, :, :3] = np.eye(3)
+    affines[:, :, 3] = corrections
+
+    if output_xml is None:
+        output_xml = str(Path(dataset_xml).with_suffix("")) + "_registered.xml"
+    xml_streaming.update_view_registrations(
+        xml_path=dataset_xml,
+        affines=affines,
+        output_path=output_xml,
+        setup_ids=dataset["setup_ids"],
+    )
+
+    logger.info(
+        f"Kept {kept.sum()} of {len(links)} links for {len(corrections)} tiles "
+        f"in {time() - start_time:.2f}s"
+    )
+    return output_xml
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--input_json", type=str, required=True)
+    parser.add_argument("--output_xml", type=str, default=None)
+    parser.add_argument("--absolute_threshold", type=float, default=3.5)
+    parser.add_argument("--relative_threshold", type=float, default=2.5)
+    parser.add_argument("--log_level", type=str, default="INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    print(
+        main(
+            input_json=args.input_json,
+            output_xml=args.output_xml,
+            absolute_threshold=args.absolute_threshold,
+            relative_threshold=args.relative_threshold,
+        )
+    )
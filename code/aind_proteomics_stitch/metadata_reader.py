@@ -0,0 +1,209 @@
+"""
+Streaming reader of all_channel_tile_metadata.json. The
+records are decoded one at a time, so only the tiles of the
+requested channels are kept in memory, and their files are
+normalized as they are read.
+
+ijson is used if it is installed. Otherwise the records are
+decoded from a buffered window of the file with the json
+module, which bounds the memory in the same way.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, TextIO
+
+logger = logging.getLogger(__name__)
+
+# Characters read at a time by the json decoder
+READ_CHUNK_CHARS = 1024**2
+
+_WHITESPACE = " \t\n\r"
+_NUMBER_CHARS = "0123456789+-.eE"
+
+
+def normalize_tile_file(file: str, full_extension: str) -> str:
+    """
+    Makes a tile file end with the full extension.
+
+    Parameters
+    ----------
+    file: str
+        File of the tile, possibly with a folder
+    full_extension: str
+        Extension of the tiles, e.g. ".ome.zarr"
+
+    Returns
+    -------
+    str
+        Name of the tile with the full extension
+    """
+    tilename = Path(file).name
+    if not tilename.endswith(full_extension):
+        tilename = Path(file).stem.replace(full_extension, "")
+        tilename = f"{tilename}{full_extension}"
+    return tilename
+
+
+def iter_json_array(f: TextIO, chunk_chars: int = READ_CHUNK_CHARS) -> Iterator:
+    """
+    Decodes the items of a top level json array one at a
+    time.
+
+    Parameters
+    ----------
+    f: TextIO
+        File with a json array
+    chunk_chars: int
+        Characters read at a time
+
+    Returns
+    -------
+    Iterator
+        Items of the array
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+    # Last token read: "[", "," or an item
+    last = None
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = f.read(chunk_chars)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    while True:
+        # Separators between the items
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError("Unexpected end of the json array")
+                fill()
+                continue
+            char = buffer[pos]
+            if not started:
+                if char != "[":
+                    raise ValueError("The tile metadata is not a json array")
+                started = True
+                last = "["
+                pos += 1
+            elif char == "]" and last != ",":
+                return
+            elif last == "item":
+                if char != ",":
+                    raise ValueError(f"Expected ',' or ']' at {char!r}")
+                last = ","
+                pos += 1
+            elif char in ",]":
+                raise ValueError(f"Expected an item of the json array at {char!r}")
+            else:
+                break
+
+        # Items are decoded once they are complete in the buffer
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            if (
+                not eof
+                and not isinstance(item, (dict, list))
+                and (end == len(buffer) or buffer[end] in _NUMBER_CHARS)
+            ):
+                # A number could continue in the next chunk
+                fill()
+                continue
+            pos = end
+            last = "item"
+            yield item
+            break
+
+
+def iter_tile_metadata(
+    path: str,
+    channels: Optional[Iterable[int]] = None,
+    full_extension: Optional[str] = ".ome.zarr",
+) -> Iterator[dict]:
+    """
+    Streams the tile metadata records of some channels.
+
+    Parameters
+    ----------
+    path: str
+        Path to all_channel_tile_metadata.json
+    channels: Optional[Iterable[int]]
+        Channel wavelengths to keep. Default: None (every
+        channel)
+    full_extension: Optional[str]
+        Extension the files are normalized to. Default:
+        ".ome.zarr". None keeps the files as they are
+
+    Returns
+    -------
+    Iterator[dict]
+        Records of the channels in the order of the file
+    """
+    if channels is not None:
+        channels = {int(channel) for channel in channels}
+
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+    if ijson is not None:
+        f = open(path, "rb")
+        records = ijson.items(f, "item", use_float=True)
+    else:
+        f = open(path, "r")
+        records = iter_json_array(f)
+
+    with f:
+        for record in records:
+            if (
+                channels is not None
+                and int(record["channel_wavelength"]) not in channels
+            ):
+                continue
+            if full_extension is not None:
+                record["file"] = normalize_tile_file(record["file"], full_extension)
+            yield record
+
+
+def read_tile_metadata(
+    path: str,
+    channels: Optional[Iterable[int]] = None,
+    full_extension: Optional[str] = ".ome.zarr",
+) -> List[dict]:
+    """
+    Reads the tile metadata records of some channels
+    without loading the records of the other ones.
+
+    Parameters
+    ----------
+    path: str
+        Path to all_channel_tile_metadata.json
+    channels: Optional[Iterable[int]]
+        Channel wavelengths to keep. Default: None (every
+        channel)
+    full_extension: Optional[str]
+        Extension the files are normalized to. Default:
+        ".ome.zarr". None keeps the files as they are
+
+    Returns
+    -------
+    List[dict]
+        Records of the channels in the order of the file
+    """
+    return list(iter_tile_metadata(path, channels, full_extension))
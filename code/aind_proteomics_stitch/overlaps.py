@@ -0,0 +1,279 @@
+"""
+Computes the regions where pairs of tiles overlap
+from their nominal positions and reads only the
+chunks that intersect those regions.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import zarr
+
+
+def get_level_geometry(
+    tile_translations: List[List[float]],
+    tile_sizes: List[List[int]],
+    tile_resolution: List[float],
+    level: int = 0,
+    level_scale: Optional[List[float]] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Converts the nominal tile geometry to voxel
+    coordinates of a multiscale level.
+
+    Parameters
+    ----------
+    tile_translations: List[List[float]]
+        Tile positions in microns in XYZ order
+    tile_sizes: List[List[int]]
+        Tile sizes in voxels at full resolution in XYZ order
+    tile_resolution: List[float]
+        Voxel size in microns at full resolution in XYZ order
+    level: int
+        Multiscale level. Default: 0
+    level_scale: Optional[List[float]]
+        Downsampling factor of the level in XYZ order. If None,
+        the level is assumed to be downsampled by 2 ** level
+        in every axis. Default: None
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        Tile origins (n, 3) and tile shapes (n, 3) in voxels
+        of the level, and the voxel size in microns of the level.
+        Everything in XYZ order.
+    """
+    if level_scale is None:
+        level_scale = [2**level] * 3
+
+    level_scale = np.asarray(level_scale, dtype=np.float64)
+    level_resolution = np.asarray(tile_resolution, dtype=np.float64) * level_scale
+    origins = np.asarray(tile_translations, dtype=np.float64) / level_resolution
+    shapes = np.ceil(np.asarray(tile_sizes, dtype=np.float64) / level_scale)
+
+    return origins, shapes.astype(int), level_resolution
+
+
+def get_overlap_boxes(
+    tile_translations: List[List[float]],
+    tile_sizes: List[List[int]],
+    tile_resolution: List[float],
+    pairs: List[Tuple[int, int]],
+    level: int = 0,
+    level_scale: Optional[List[float]] = None,
+    max_shift: Optional[List[int]] = None,
+) -> List[Dict]:
+    """
+    Computes the overlap boxes of a list of tile pairs
+    in voxel coordinates of a multiscale level.
+
+    Parameters
+    ----------
+    tile_translations: List[List[float]]
+        Tile positions in microns in XYZ order
+    tile_sizes: List[List[int]]
+        Tile sizes in voxels at full resolution in XYZ order
+    tile_resolution: List[float]
+        Voxel size in microns at full resolution in XYZ order
+    pairs: List[Tuple[int, int]]
+        Pairs of tile indices
+    level: int
+        Multiscale level. Default: 0
+    level_scale: Optional[List[float]]
+        Downsampling factor of the level in XYZ order. Default: None
+    max_shift: Optional[List[int]]
+        Maximum shift in voxels of the level (XYZ), used as
+        margin around the nominal overlap. Default: None
+
+    Returns
+    -------
+    List[Dict]
+        Dictionary of every overlapping pair with its indices,
+        the integer offset of the moving tile with respect to
+        the fixed tile, the sub-voxel residual of that offset
+        and the (start, end) boxes to read in the local
+        coordinates of each tile. Everything in XYZ order.
+        Pairs that do not overlap are not returned.
+    """
+    arrays = get_overlap_arrays(
+        tile_translations,
+        tile_sizes,
+        tile_resolution,
+        pairs,
+        level=level,
+        level_scale=level_scale,
+        max_shift=max_shift,
+    )
+
+    return [
+        {
+            "pair": (int(i), int(j)),
+            "offset": arrays["offset"][k],
+            "residual": arrays["residual"][k],
+            "fixed_box": (arrays["fixed_start"][k], arrays["fixed_end"][k]),
+            "moving_box": (arrays["moving_start"][k], arrays["moving_end"][k]),
+        }
+        for k, (i, j) in enumerate(arrays["pairs"])
+    ]
+
+
+def get_overlap_arrays(
+    tile_translations: List[List[float]],
+    tile_sizes: List[List[int]],
+    tile_resolution: List[float],
+    pairs: np.ndarray,
+    level: int = 0,
+    level_scale: Optional[List[float]] = None,
+    max_shift: Optional[List[int]] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Computes the overlap boxes of every overlapping pair,
+    grown by the maximum shift and clipped to each tile,
+    as arrays.
+
+    Parameters
+    ----------
+    tile_translations: List[List[float]]
+        Tile positions in microns in XYZ order
+    tile_sizes: List[List[int]]
+        Tile sizes in voxels at full resolution in XYZ order
+    tile_resolution: List[float]
+        Voxel size in microns at full resolution in XYZ order
+    pairs: np.ndarray
+        Pairs of tile indices (m, 2)
+    level: int
+        Multiscale level. Default: 0
+    level_scale: Optional[List[float]]
+        Downsampling factor of the level in XYZ order. Default: None
+    max_shift: Optional[List[int]]
+        Maximum shift in voxels of the level (XYZ), used as
+        margin around the nominal overlap. Default: None
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        Arrays (k, 3) in XYZ order with the offset, its
+        sub-voxel residual, the nominal overlap extent and
+        the start and end of the fixed and moving boxes of
+        the k overlapping pairs, and their pair indices (k, 2)
+    """
+    origins, shapes, _ = get_level_geometry(
+        tile_translations, tile_sizes, tile_resolution, level, level_scale
+    )
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    fixed, moving = pairs[:, 0], pairs[:, 1]
+    margin = np.zeros(3, dtype=int) if max_shift is None else np.asarray(max_shift)
+
+    exact_offset = origins[moving] - origins[fixed]
+    offset = np.round(exact_offset).astype(int)
+    start = np.maximum(0, offset)
+    end = np.minimum(shapes[fixed], offset + shapes[moving])
+    overlapping = np.all(end > start, axis=1)
+
+    pairs, offset = pairs[overlapping], offset[overlapping]
+    exact_offset = exact_offset[overlapping]
+    start, end = start[overlapping], end[overlapping]
+    fixed_shapes = shapes[pairs[:, 0]]
+    moving_shapes = shapes[pairs[:, 1]]
+
+    return {
+        "pairs": pairs,
+        "offset": offset,
+        "residual": exact_offset - offset,
+        "extent": end - start,
+        "fixed_start": np.maximum(start - margin, 0),
+        "fixed_end": np.minimum(end + margin, fixed_shapes),
+        "moving_start": np.maximum(start - margin - offset, 0),
+        "moving_end": np.minimum(end + margin - offset, moving_shapes),
+    }
+
+
+def box_to_region(box: Tuple[np.ndarray, np.ndarray]) -> Tuple[slice]:
+    """
+    Converts a (start, end) box in XYZ order to ZYX slices.
+
+    Parameters
+    ----------
+    box: Tuple[np.ndarray, np.ndarray]
+        Start and end of the box in XYZ order
+
+    Returns
+    -------
+    Tuple[slice]
+        Slices in ZYX order
+    """
+    start, end = box
+    return tuple(slice(int(s), int(e)) for s, e in zip(start[::-1], end[::-1]))
+
+
+def read_box(array: zarr.Array, box: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    """
+    Reads a box of a tile. Only the chunks that intersect
+    the box are fetched from the store. Leading dimensions
+    (e.g. time and channel in OME-Zarr) are indexed at 0.
+
+    Parameters
+    ----------
+    array: zarr.Array
+        Tile array
+    box: Tuple[np.ndarray, np.ndarray]
+        Start and end of the box in XYZ order
+
+    Returns
+    -------
+    np.ndarray
+        Box loaded in memory in ZYX order
+    """
+    region = box_to_region(box)
+    leading = (0,) * (array.ndim - len(region))
+    return array[leading + region]
+
+
+def get_box_chunks(
+    array: zarr.Array, box: Tuple[np.ndarray, np.ndarray]
+) -> List[Tuple[int]]:
+    """
+    Lists the ZYX chunk indices of a tile that intersect a box.
+
+    Parameters
+    ----------
+    array: zarr.Array
+        Tile array
+    box: Tuple[np.ndarray, np.ndarray]
+        Start and end of the box in XYZ order
+
+    Returns
+    -------
+    List[Tuple[int]]
+        Chunk grid indices in ZYX order
+    """
+    chunks = np.asarray(array.chunks[-3:])
+    start, end = box
+    first = np.asarray(start[::-1]) // chunks
+    last = (np.asarray(end[::-1]) - 1) // chunks
+
+    return [
+        tuple(int(c) for c in np.add(chunk, first))
+        for chunk in np.ndindex(*(last - first + 1))
+    ]
+
+
+def estimate_box_bytes(array: zarr.Array, box: Tuple[np.ndarray, np.ndarray]) -> int:
+    """
+    Estimates the uncompressed bytes fetched to read a box,
+    i.e. the size of every chunk intersecting the box.
+
+    Parameters
+    ----------
+    array: zarr.Array
+        Tile array
+    box: Tuple[np.ndarray, np.ndarray]
+        Start and end of the box in XYZ order
+
+    Returns
+    -------
+    int
+        Bytes of the chunks that intersect the box
+    """
+    chunk_bytes = int(np.prod(array.chunks[-3:])) * array.dtype.itemsize
+    return len(get_box_chunks(array, box)) * chunk_bytes
@@ -0,0 +1,508 @@
+"""
+Computes pairwise tile shifts with FFT-based phase
+correlation in process. This is an alternative to the
+BigStitcher (Fiji) phase correlation step that consumes
+the same stitching parameters.
+"""
+
+import argparse
+import json
+import logging
+from functools import lru_cache
+from pathlib import Path
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import zarr
+from scipy import fft
+
+from . import bigstitcher_utilities, chunk_cache, overlaps, s3_fetch, scheduler
+from .spatial_index import TileIndex
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=4096)
+def get_tile_array(zarr_path: str, tile_name: str, level: int) -> zarr.Array:
+    """
+    Opens a multiscale level of an OME-Zarr tile. Chunks are
+    fetched concurrently through s3_fetch and kept in the
+    process-wide chunk cache.
+
+    Parameters
+    ----------
+    zarr_path: str
+        Path to the folder (local or s3) that contains the tiles
+    tile_name: str
+        Tile name, e.g. Tile_X_0000_Y_0000_Z_0000_ch_488.ome.zarr
+    level: int
+        Multiscale level to open
+
+    Returns
+    -------
+    zarr.Array
+        Lazy array for the requested multiscale level
+    """
+    tile_path = f"{zarr_path}/{tile_name}"
+    store = chunk_cache.CachedStore(
+        s3_fetch.open_store(tile_path),
+        tile_name=tile_path,
+        cache=chunk_cache.get_chunk_cache(),
+    )
+    return zarr.open_group(store, mode="r")[str(level)]
+
+
+def get_level_scale(array: zarr.Array, tile_size: List[int]) -> np.ndarray:
+    """
+    Computes the downsampling factor of a multiscale level
+    with respect to the full resolution tile size.
+
+    Parameters
+    ----------
+    array: zarr.Array
+        Tile array at the multiscale level
+    tile_size: List[int]
+        Tile size at full resolution in XYZ order
+
+    Returns
+    -------
+    np.ndarray
+        Downsampling factor in XYZ order
+    """
+    level_shape_xyz = np.array(array.shape[-3:][::-1], dtype=np.float64)
+    return np.array(tile_size, dtype=np.float64) / level_shape_xyz
+
+
+def normalized_cross_correlation(
+    fixed: np.ndarray, moving: np.ndarray, offset: np.ndarray
+) -> Tuple[float, int]:
+    """
+    Computes the normalized cross correlation between the
+    fixed image and the moving image placed at an offset
+    from the fixed image origin, over their common support.
+
+    Parameters
+    ----------
+    fixed: np.ndarray
+        Fixed image
+    moving: np.ndarray
+        Moving image
+    offset: np.ndarray
+        Integer position of the moving image origin
+        in the fixed image coordinates
+
+    Returns
+    -------
+    Tuple[float, int]
+        Correlation coefficient and number of voxels
+        in the common support
+    """
+    offset = np.asarray(offset, dtype=int)
+    start = np.maximum(0, offset)
+    end = np.minimum(fixed.shape, offset + np.array(moving.shape))
+    if np.any(end <= start):
+        return -1.0, 0
+
+    a = fixed[tuple(slice(s, e) for s, e in zip(start, end))].astype(np.float64)
+    b = moving[tuple(slice(s, e) for s, e in zip(start - offset, end - offset))].astype(
+        np.float64
+    )
+    if a.size < 2:
+        return -1.0, a.size
+
+    a = a - a.mean()
+    b = b - b.mean()
+    denominator = np.sqrt(np.sum(a * a) * np.sum(b * b))
+    if denominator == 0:
+        return -1.0, a.size
+
+    return float(np.sum(a * b) / denominator), a.size
+
+
+def phase_correlation(
+    fixed: np.ndarray,
+    moving: np.ndarray,
+    moving_offset: Optional[np.ndarray] = None,
+    max_shift: Optional[np.ndarray] = None,
+    n_peaks: int = 5,
+    min_overlap: float = 0.1,
+    workers: int = 1,
+) -> Tuple[np.ndarray, float]:
+    """
+    Estimates the integer shift d such that the moving image placed at
+    moving_offset + d matches the fixed image, using phase correlation.
+    Both images are embedded in a common zero-mean canvas, and the
+    highest peaks of the phase correlation matrix (including their
+    periodic aliases) are resolved by the normalized cross correlation
+    of the images at that shift.
+
+    Parameters
+    ----------
+    fixed: np.ndarray
+        Fixed image
+    moving: np.ndarray
+        Moving image
+    moving_offset: Optional[np.ndarray]
+        Nominal position of the moving image origin in the fixed
+        image coordinates. Default: None (both images aligned)
+    max_shift: Optional[np.ndarray]
+        Maximum absolute shift allowed per axis. Default: None
+    n_peaks: int
+        Number of phase correlation peaks to check. Default: 5
+    min_overlap: float
+        Minimum fraction of voxels of the smallest image that
+        must overlap for a shift to be considered. Default: 0.1
+    workers: int
+        Number of threads used by the FFTs. Default: 1
+
+    Returns
+    -------
+    Tuple[np.ndarray, float]
+        Best shift per axis and its normalized cross correlation.
+        The correlation is -1 if no valid shift was found.
+    """
+    if moving_offset is None:
+        moving_offset = np.zeros(fixed.ndim, dtype=int)
+
+    moving_offset = np.asarray(moving_offset, dtype=int)
+    canvas_start = np.minimum(0, moving_offset)
+    canvas_end = np.maximum(fixed.shape, moving_offset + np.array(moving.shape))
+    shape = canvas_end - canvas_start
+
+    ffts = []
+    for image, origin in (
+        (fixed, -canvas_start),
+        (moving, moving_offset - canvas_start),
+    ):
+        canvas = np.zeros(shape, dtype=np.float32)
+        image = image.astype(np.float32)
+        canvas[tuple(slice(o, o + n) for o, n in zip(origin, image.shape))] = (
+            image - image.mean()
+        )
+        ffts.append(fft.rfftn(canvas, workers=workers))
+
+    cross_power = ffts[0] * np.conj(ffts[1])
+    cross_power /= np.abs(cross_power) + np.finfo(np.float32).eps
+    pcm = fft.irfftn(cross_power, s=tuple(shape), workers=workers)
+
+    n_peaks = min(n_peaks, pcm.size)
+    peaks = np.argpartition(pcm, -n_peaks, axis=None)[-n_peaks:]
+    peaks = np.array(np.unravel_index(peaks, pcm.shape)).T
+
+    min_voxels = min_overlap * min(fixed.size, moving.size)
+    best_shift = np.zeros(len(shape), dtype=int)
+    best_corr = -1.0
+
+    for peak in peaks:
+        # Each peak is ambiguous up to the period of the FFT
+        candidates = [[p] if p == 0 else [p, p - n] for p, n in zip(peak, shape)]
+        for shift in (
+            np.array(np.meshgrid(*candidates, indexing="ij")).reshape(len(shape), -1).T
+        ):
+            if max_shift is not None and np.any(np.abs(shift) > max_shift):
+                continue
+
+            corr, n_voxels = normalized_cross_correlation(
+                fixed, moving, moving_offset + shift
+            )
+            if n_voxels >= min_voxels and corr > best_corr:
+                best_corr = corr
+                best_shift = shift.astype(int)
+
+    return best_shift, best_corr
+
+
+def register_pair(
+    fixed_array: zarr.Array,
+    moving_array: zarr.Array,
+    overlap_box: Dict,
+    level_resolution: np.ndarray,
+    max_shift: np.ndarray,
+    workers: int = 1,
+) -> Tuple[np.ndarray, float]:
+    """
+    Registers two tiles reading only the region
+    where they nominally overlap.
+
+    Parameters
+    ----------
+    fixed_array: zarr.Array
+        Fixed tile at the registration level
+    moving_array: zarr.Array
+        Moving tile at the registration level
+    overlap_box: Dict
+        Overlap of the pair as returned by
+        overlaps.get_overlap_boxes
+    level_resolution: np.ndarray
+        Voxel size in microns at the registration level (XYZ)
+    max_shift: np.ndarray
+        Maximum shift in voxels at the registration level (XYZ)
+    workers: int
+        Number of threads used by the FFTs. Default: 1
+
+    Returns
+    -------
+    Tuple[np.ndarray, float]
+        Shift in microns (XYZ) of the moving tile with respect to
+        its nominal position relative to the fixed tile, and the
+        correlation of the match.
+    """
+    fixed_box = overlap_box["fixed_box"]
+    moving_box = overlap_box["moving_box"]
+    moving_offset = overlap_box["offset"] + moving_box[0] - fixed_box[0]
+
+    shift_zyx, correlation = phase_correlation(
+        fixed=overlaps.read_box(fixed_array, fixed_box),
+        moving=overlaps.read_box(moving_array, moving_box),
+        moving_offset=moving_offset[::-1],
+        max_shift=max_shift[::-1],
+        workers=workers,
+    )
+
+    shift = (shift_zyx[::-1] - overlap_box["residual"]) * level_resolution
+    return shift, correlation
+
+
+def register_pairs_task(
+    zarr_path: str,
+    level: int,
+    pairs: List[Tuple[str, str, Dict]],
+    level_resolution: np.ndarray,
+    max_shift: np.ndarray,
+    workers: int = 1,
+) -> np.ndarray:
+    """
+    Registers a batch of tile pairs given by name, in order.
+    Used by the worker processes of the scheduler.
+
+    Parameters
+    ----------
+    zarr_path: str
+        Path to the folder (local or s3) that contains the tiles
+    level: int
+        Registration level
+    pairs: List[Tuple[str, str, Dict]]
+        Fixed tile name, moving tile name and overlap box
+        (as returned by overlaps.get_overlap_boxes) of each pair
+    level_resolution: np.ndarray
+        Voxel size in microns at the registration level (XYZ)
+    max_shift: np.ndarray
+        Maximum shift in voxels at the registration level (XYZ)
+    workers: int
+        Number of threads used by the FFTs. Default: 1
+
+    Returns
+    -------
+    np.ndarray
+        Array (n_pairs, 4) with the shift in microns (XYZ)
+        followed by the correlation of each pair
+    """
+    results = []
+    for fixed_tile, moving_tile, overlap_box in pairs:
+        shift, correlation = register_pair(
+            fixed_array=get_tile_array(zarr_path, fixed_tile, level),
+            moving_array=get_tile_array(zarr_path, moving_tile, level),
+            overlap_box=overlap_box,
+            level_resolution=level_resolution,
+            max_shift=max_shift,
+            workers=workers,
+        )
+        results.append(np.append(shift, correlation))
+
+    logger.debug(f"Chunk cache: {chunk_cache.get_chunk_cache().stats()}")
+    return np.array(results).reshape(-1, 4)
+
+
+def compute_pairwise_shifts(stitching_dict: dict) -> List[Dict]:
+    """
+    Computes the phase correlation shifts for every pair
+    of overlapping tiles in a BigStitcher dataset.
+
+    Parameters
+    ----------
+    stitching_dict: dict
+        Stitching parameters as returned by
+        bigstitcher.get_stitching_dict
+
+    Returns
+    -------
+    List[Dict]
+        Pairwise shifts with the setup ids of both tiles,
+        the shift in microns (XYZ) of the second tile and
+        the correlation of the match. Only pairs with a
+        correlation above min_correlation are returned.
+    """
+    params = stitching_dict["phase_correlation_params"]
+    level = int(params["downsample"])
+    max_shift = np.array(
+        [
+            params["max_shift_in_x"],
+            params["max_shift_in_y"],
+            params["max_shift_in_z"],
+        ]
+    )
+    min_correlation = float(params["min_correlation"])
+    workers = int(stitching_dict.get("parallel", 1))
+
+    dataset = bigstitcher_utilities.parse_xml(stitching_dict["dataset_xml"])
+    tile_translations = dataset["tile_translations"]
+    tile_sizes = dataset["tile_sizes"]
+
+    arrays = [
+        get_tile_array(dataset["zarr_path"], tile, level) for tile in dataset["tiles"]
+    ]
+    level_scale = get_level_scale(arrays[0], tile_sizes[0])
+
+    pairs = TileIndex(
+        tile_translations, tile_sizes, dataset["tile_resolution"]
+    ).overlapping_pairs()
+    overlap_boxes = overlaps.get_overlap_boxes(
+        tile_translations=tile_translations,
+        tile_sizes=tile_sizes,
+        tile_resolution=dataset["tile_resolution"],
+        pairs=pairs,
+        level_scale=level_scale,
+        max_shift=max_shift,
+    )
+    level_resolution = np.asarray(dataset["tile_resolution"]) * level_scale
+
+    bytes_read = sum(
+        overlaps.estimate_box_bytes(arrays[box["pair"][0]], box["fixed_box"])
+        + overlaps.estimate_box_bytes(arrays[box["pair"][1]], box["moving_box"])
+        for box in overlap_boxes
+    )
+    logger.info(
+        f"Registering {len(overlap_boxes)} overlapping pairs at level {level}, "
+        f"reading {bytes_read / 1024 ** 2:.2f} MiB of chunks"
+    )
+
+    # Pairs follow a serpentine path over the tile grid and are split in
+    # contiguous batches, so each worker reuses the chunks it has cached
+    tiles = dataset["tiles"]
+    pair_order = chunk_cache.get_serpentine_pair_order(
+        grid_indices=bigstitcher_utilities.positions_to_grid_indices(
+            tile_translations,
+            np.asarray(tile_sizes) * np.asarray(dataset["tile_resolution"]),
+        ),
+        pairs=[box["pair"] for box in overlap_boxes],
+    )
+    batches = [
+        batch for batch in np.array_split(pair_order, max(1, workers) * 4) if len(batch)
+    ]
+    pair_memory = [
+        scheduler.estimate_pair_memory(box, arrays[0].dtype.itemsize)
+        for box in overlap_boxes
+    ]
+    cache_bytes = chunk_cache.get_chunk_cache().max_bytes
+
+    # Threads go to the FFTs when pairs run one at a time
+    fft_workers = workers if len(batches) == 1 else 1
+    results = scheduler.run_with_memory_budget(
+        task=register_pairs_task,
+        task_args=[
+            (
+                dataset["zarr_path"],
+                level,
+                [
+                    (
+                        tiles[overlap_boxes[k]["pair"][0]],
+                        tiles[overlap_boxes[k]["pair"][1]],
+                        overlap_boxes[k],
+                    )
+                    for k in batch
+                ],
+                level_resolution,
+                max_shift,
+                fft_workers,
+            )
+            for batch in batches
+        ],
+        memory_estimates=[
+            max(pair_memory[k] for k in batch) + cache_bytes for batch in batches
+        ],
+        n_outputs=4,
+        memory_budget=int(float(stitching_dict.get("memgb", 1)) * 1024**3),
+        max_workers=workers,
+        task_rows=[batch.tolist() for batch in batches],
+    )
+
+    pairwise_shifts = []
+    for overlap_box, result in zip(overlap_boxes, results):
+        i, j = overlap_box["pair"]
+        shift, correlation = result[:3], float(result[3])
+
+        if correlation < min_correlation:
+            logger.info(
+                f"Discarding pair {tiles[i]} - {tiles[j]} "
+                f"with correlation {correlation:.3f}"
+            )
+            continue
+
+        pairwise_shifts.append(
+            {
+                "setup_a": dataset["setup_ids"][i],
+                "setup_b": dataset["setup_ids"][j],
+                "tile_a": tiles[i],
+                "tile_b": tiles[j],
+                "shift": shift.tolist(),
+                "correlation": correlation,
+            }
+        )
+
+    return pairwise_shifts
+
+
+def main(input_json: str, results_path: str) -> str:
+    """
+    Computes the pairwise shifts of a dataset and
+    writes them to a json file in the results folder.
+
+    Parameters
+    ----------
+    input_json: str
+        Path to the stitching parameters json
+        written by bigstitcher.main
+    results_path: str
+        Folder where the pairwise shifts are written
+
+    Returns
+    -------
+    str
+        Path to the pairwise shifts json
+    """
+    start_time = time()
+    with open(input_json, "r") as f:
+        stitching_dict = json.load(f)
+
+    pairwise_shifts = compute_pairwise_shifts(stitching_dict)
+
+    output_json = Path(results_path).joinpath(
+        f"{stitching_dict['session_id']}_pairwise_shifts.json"
+    )
+    with open(output_json, "w") as f:
+        json.dump(
+            {
+                "dataset_xml": stitching_dict["dataset_xml"],
+                "phase_correlation_params": stitching_dict["phase_correlation_params"],
+                "pairwise_shifts": pairwise_shifts,
+            },
+            f,
+            indent=4,
+        )
+
+    logger.info(
+        f"Computed {len(pairwise_shifts)} pairwise shifts in {time() - start_time:.2f}s"
+    )
+    return str(output_json)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--input_json", type=str, required=True)
+    parser.add_argument("--results_path", type=str, default="../results")
+    parser.add_argument("--log_level", type=str, default="INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    print(main(input_json=args.input_json, results_path=args.results_path))
@@ -0,0 +1,211 @@
+"""
+Stitching of a dataset from its capsule data folder: the
+inputs are validated, the tile metadata, BigStitcher XML and
+stitching parameters are written and the registration can
+be computed in process. Shared by run_capsule.py and the
+worker, which runs many datasets in one process.
+"""
+
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+
+from . import bigstitcher, global_optimization, phase_correlation, result_cache
+from .utils import profiling, utils
+
+logger = logging.getLogger(__name__)
+
+# Files expected in the data folder
+REQUIRED_INPUTS = [
+    "processing_manifest.json",
+    "all_channel_tile_metadata.json",
+    "data_description.json",
+    "acquisition.json",
+    "processed/data_description.json",
+    "radial_correction_parameters.json",
+]
+
+# Coarsest resolution in microns (XYZ) used for the transforms
+RES_FOR_TRANSFORMS = (0.76, 0.76, 3.4)
+
+# Parameters of a dataset that can be overridden
+OVERRIDES = (
+    "channel",
+    "path_to_data",
+    "scale_for_transforms",
+    "res_for_transforms",
+    "cache_dir",
+    "validate_tiles",
+    "write_tile_metadata",
+    "all_channels",
+)
+
+
+def get_dataset_config(data_folder: str, overrides: Optional[Dict] = None) -> Dict:
+    """
+    Reads the stitching configuration of a dataset.
+
+    Parameters
+    ----------
+    data_folder: str
+        Capsule data folder of the dataset
+    overrides: Optional[Dict]
+        Values replacing the ones of the data folder, with
+        keys in OVERRIDES. Default: None
+
+    Returns
+    -------
+    Dict
+        Dataset name, voxel resolution, stitching channel,
+        data and tile metadata paths, the parameters passed
+        to bigstitcher and whether every channel is written
+    """
+    overrides = dict(overrides or {})
+    unknown = sorted(set(overrides) - set(OVERRIDES))
+    if len(unknown):
+        raise ValueError(f"Unknown overrides {unknown}, use any of {OVERRIDES}")
+
+    data_folder = Path(data_folder)
+    required_input_elements = [f"{data_folder}/{name}" for name in REQUIRED_INPUTS]
+    missing_files = utils.validate_capsule_inputs(required_input_elements)
+
+    if len(missing_files):
+        raise ValueError(
+            f"We miss the following files in the capsule input: {missing_files}"
+        )
+
+    pipeline_config, proteomics_dataset_name, acquisition_dict = utils.get_data_config(
+        data_folder=data_folder,
+        processing_manifest_path="processing_manifest.json",
+        data_description_path="data_description.json",
+        acquisition_path="acquisition.json",
+    )
+    stitching_config = pipeline_config["pipeline_processing"]["stitching"]
+
+    path_to_data = overrides.get("path_to_data")
+    if path_to_data is None:
+        processed_data_description = utils.read_json_as_dict(required_input_elements[4])
+        radial_parameters = utils.read_json_as_dict(required_input_elements[5])
+
+        processed_asset_name = processed_data_description.get("name", None)
+        bucket_name = radial_parameters.get("bucket_name", None)
+
+        if processed_asset_name is None or bucket_name is None:
+            raise ValueError("Stitching requires S3 paths in Code Ocean at the moment.")
+
+        path_to_data = (
+            f"s3://{bucket_name}/{processed_asset_name}/image_radial_correction"
+        )
+
+    return {
+        "proteomics_dataset_name": proteomics_dataset_name,
+        "voxel_resolution": utils.get_resolution(acquisition_dict),
+        "channel_wavelength": overrides.get("channel", stitching_config["channel"]),
+        "path_to_data": path_to_data,
+        "path_to_tile_metadata": required_input_elements[1],
+        "res_for_transforms": tuple(
+            overrides.get("res_for_transforms", RES_FOR_TRANSFORMS)
+        ),
+        # If this is provided, res for
+        # transforms is ignored and the
+        # planner only picks memory and workers
+        "scale_for_transforms": overrides.get(
+            "scale_for_transforms", stitching_config.get("scale_for_transforms")
+        ),
+        "cache_dir": overrides.get("cache_dir"),
+        "validate_tiles": bool(overrides.get("validate_tiles", True)),
+        "write_tile_metadata": bool(overrides.get("write_tile_metadata", True)),
+        "all_channels": bool(overrides.get("all_channels", False)),
+    }
+
+
+def stitch_dataset(
+    data_folder: str, results_folder: str, overrides: Optional[Dict] = None
+) -> str:
+    """
+    Writes the tile metadata, BigStitcher XML and stitching
+    parameters of a dataset, for the stitching channel or for
+    every channel with the all_channels override. The path to
+    the parameters of the stitching channel is printed for the
+    run script.
+
+    Parameters
+    ----------
+    data_folder: str
+        Capsule data folder of the dataset
+    results_folder: str
+        Folder where the outputs are written
+    overrides: Optional[Dict]
+        Values replacing the ones of the data folder, with
+        keys in OVERRIDES. Default: None
+
+    Returns
+    -------
+    str
+        Path to the stitching parameters json of the
+        stitching channel
+    """
+    config = get_dataset_config(data_folder, overrides)
+    results_folder = Path(results_folder)
+
+    if config.pop("all_channels"):
+        # The outputs of every channel are written in one pass
+        # and the stitching channel is the one registered
+        stitching_channel = int(config.pop("channel_wavelength"))
+        params_jsons = bigstitcher.main_all_channels(
+            results_folder=results_folder,
+            stitching_channel=stitching_channel,
+            **config,
+        )
+        # Printing to get output on batch script
+        print(params_jsons[stitching_channel])
+        return params_jsons[stitching_channel]
+
+    output_json_file = results_folder.joinpath(
+        f"{config['proteomics_dataset_name']}_tile_metadata.json"
+    )
+
+    # Computing image transformations with bigtstitcher
+    return bigstitcher.main(
+        output_json_file=output_json_file,
+        results_folder=results_folder,
+        **config,
+    )
+
+
+def register_dataset(params_json: str, results_folder: str) -> Dict[str, str]:
+    """
+    Computes the registration of a dataset in process, as
+    the run script does with REGISTRATION_ENGINE=python.
+    Outputs restored from the result cache are reused.
+
+    Parameters
+    ----------
+    params_json: str
+        Path to the stitching parameters json
+    results_folder: str
+        Folder where the outputs are written
+
+    Returns
+    -------
+    Dict[str, str]
+        Path of each registration output, keyed by the roles
+        in result_cache.REGISTRATION_ROLES whether they were
+        computed or restored
+    """
+    restored = result_cache.get_restored_outputs(params_json)
+    if len(restored):
+        logger.info(f"Registration outputs restored from the cache: {restored}")
+        return restored
+
+    with profiling.span("pairwise_shifts"):
+        pairwise_shifts_json = phase_correlation.main(
+            input_json=params_json, results_path=str(results_folder)
+        )
+
+    with profiling.span("global_optimization"):
+        registered_xml = global_optimization.main(input_json=pairwise_shifts_json)
+
+    outputs = [pairwise_shifts_json, registered_xml]
+    result_cache.main("store", params_json, outputs)
+    return dict(zip(result_cache.REGISTRATION_ROLES, outputs))
@@ -0,0 +1,416 @@
+"""
+Chooses the multiscale level, the memory and the number of
+parallel workers of the registration from a cost model of
+the pairwise phase correlation over the dataset geometry,
+the tile pyramid and the resources of the container.
+"""
+
+import json
+import logging
+import math
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from . import bigstitcher_utilities, overlaps, s3_fetch, scheduler
+from .spatial_index import TileIndex
+from .utils import resources
+
+logger = logging.getLogger(__name__)
+
+# Levels assumed when the pyramid of the tiles can not be read
+DEFAULT_N_LEVELS = 5
+DEFAULT_ITEMSIZE = 2
+
+# Rough per-worker costs of registering a pair: FFT time per canvas
+# voxel and log2(voxels), and read throughput of the overlap chunks
+FFT_SECONDS_PER_VOXEL = 5e-9
+READ_BYTES_PER_SECOND = 200 * 1024**2
+
+# The JVM heap holds the pairs in flight with this overhead
+# over their estimated memory, on top of a fixed base
+JVM_BASE_GB = 4
+JVM_OVERHEAD = 2.0
+
+
+def get_max_shift(level: int) -> int:
+    """
+    Maximum shift in voxels of a level, as used by
+    bigstitcher.get_stitching_dict.
+
+    Parameters
+    ----------
+    level: int
+        Multiscale level
+
+    Returns
+    -------
+    int
+        Maximum shift in voxels in every axis
+    """
+    return 100 // (level + 1)
+
+
+def get_pyramid(tile_path: str) -> Optional[Tuple[List[List[int]], int]]:
+    """
+    Reads the shape of every multiscale level of a tile.
+
+    Parameters
+    ----------
+    tile_path: str
+        Local or s3 path of an OME-Zarr tile
+
+    Returns
+    -------
+    Optional[Tuple[List[List[int]], int]]
+        Shapes of the levels in XYZ order and bytes per
+        voxel, or None if the tile can not be read
+    """
+    fetcher = s3_fetch.get_fetcher()
+    backend = s3_fetch.get_backend(tile_path)
+    try:
+        zattrs = fetcher.get(backend, ".zattrs")
+        if zattrs is None:
+            # Levels without multiscales metadata are numbered
+            keys = [f"{level}/.zarray" for level in range(DEFAULT_N_LEVELS)]
+        else:
+            datasets = json.loads(zattrs)["multiscales"][0]["datasets"]
+            keys = [f"{dataset['path']}/.zarray" for dataset in datasets]
+        zarrays = fetcher.get_many(backend, keys)
+    except Exception as e:
+        logger.warning(f"Could not read the pyramid of {tile_path}: {e}")
+        return None
+
+    shapes = []
+    itemsize = DEFAULT_ITEMSIZE
+    for key in keys:
+        if key not in zarrays:
+            break
+        zarray = json.loads(zarrays[key])
+        shapes.append([int(s) for s in zarray["shape"][-3:][::-1]])
+        itemsize = np.dtype(zarray["dtype"]).itemsize
+    return (shapes, itemsize) if shapes else None
+
+
+def get_available_resources() -> Tuple[int, int]:
+    """
+    CPUs and memory in bytes available to the container.
+
+    Returns
+    -------
+    Tuple[int, int]
+        Number of CPUs and memory in bytes
+    """
+    available = resources.get_resources()
+    return available.cpus, available.memory_bytes
+
+
+def estimate_level_cost(
+    tile_translations: List[List[float]],
+    tile_sizes: List[List[int]],
+    tile_resolution: List[float],
+    pairs: np.ndarray,
+    level_scale: np.ndarray,
+    max_shift: int,
+    itemsize: int,
+) -> Dict:
+    """
+    Estimates the cost of registering every pair at a level.
+
+    Parameters
+    ----------
+    tile_translations: List[List[float]]
+        Tile positions in microns in XYZ order
+    tile_sizes: List[List[int]]
+        Tile sizes in voxels at full resolution in XYZ order
+    tile_resolution: List[float]
+        Voxel size in microns at full resolution in XYZ order
+    pairs: np.ndarray
+        Overlapping tile pairs (m, 2)
+    level_scale: np.ndarray
+        Downsampling factor of the level in XYZ order
+    max_shift: int
+        Maximum shift in voxels of the level
+    itemsize: int
+        Bytes per voxel
+
+    Returns
+    -------
+    Dict
+        Median overlap thickness in voxels, peak memory of a
+        pair in bytes, bytes read and single worker seconds
+    """
+    boxes = overlaps.get_overlap_arrays(
+        tile_translations,
+        tile_sizes,
+        tile_resolution,
+        pairs,
+        level_scale=level_scale,
+        max_shift=np.full(3, max_shift),
+    )
+    if not len(boxes["pairs"]):
+        return {"thickness": 0, "pair_memory": 0, "bytes_read": 0, "seconds": 0.0}
+
+    thickness = np.median(np.min(boxes["extent"], axis=1))
+
+    fixed_voxels = np.prod(
+        boxes["fixed_end"] - boxes["fixed_start"], axis=1, dtype=np.int64
+    )
+    moving_voxels = np.prod(
+        boxes["moving_end"] - boxes["moving_start"], axis=1, dtype=np.int64
+    )
+    canvas_voxels = 2 * np.maximum(fixed_voxels, moving_voxels).astype(np.float64)
+    pair_bytes = (fixed_voxels + moving_voxels) * itemsize
+
+    pair_memory = scheduler.estimate_pairs_memory(
+        boxes["fixed_start"],
+        boxes["fixed_end"],
+        boxes["moving_start"],
+        boxes["moving_end"],
+        boxes["offset"],
+        itemsize,
+    )
+    seconds = np.sum(
+        FFT_SECONDS_PER_VOXEL * canvas_voxels * np.log2(np.maximum(canvas_voxels, 2))
+        + pair_bytes / READ_BYTES_PER_SECOND
+    )
+
+    return {
+        "thickness": float(thickness),
+        "pair_memory": int(pair_memory.max()),
+        "bytes_read": int(pair_bytes.sum()),
+        "seconds": float(seconds),
+    }
+
+
+def get_workers(pair_memory: int, cpus: int, memory_budget: int) -> Tuple[int, int]:
+    """
+    Number of parallel workers and JVM heap of a registration.
+
+    Parameters
+    ----------
+    pair_memory: int
+        Estimated peak memory in bytes of a pair
+    cpus: int
+        Available CPUs
+    memory_budget: int
+        Memory in bytes the registration can use
+
+    Returns
+    -------
+    Tuple[int, int]
+        Workers that fit in the memory budget and the JVM
+        heap in GB that covers the pairs they hold
+    """
+    parallel = int(max(1, min(cpus, memory_budget // max(pair_memory, 1))))
+    memgb = math.ceil(JVM_BASE_GB + JVM_OVERHEAD * parallel * pair_memory / 1024**3)
+    memgb = int(max(1, min(memgb, memory_budget // 1024**3)))
+    return parallel, memgb
+
+
+def plan_registration(
+    tile_metadata: Union[List[Dict], bigstitcher_utilities.TileTable],
+    res_for_transforms: Optional[Tuple[float]] = None,
+    level: Optional[int] = None,
+    pyramid: Optional[Tuple[List[List[int]], int]] = None,
+    cpus: Optional[int] = None,
+    memory_bytes: Optional[int] = None,
+    memory_fraction: float = 0.8,
+    target_runtime: Optional[float] = None,
+    min_overlap_voxels: int = 16,
+) -> Dict:
+    """
+    Chooses the registration level, the JVM heap and the number
+    of parallel workers.
+
+    The coarsest level whose resolution is within res_for_transforms
+    is preferred, moving to finer levels while the median overlap
+    is thinner than min_overlap_voxels. Coarser levels are then used
+    while a single pair does not fit in memory or the estimated
+    runtime is above the target, as long as the overlap stays thick
+    enough. The workers are the CPUs that fit in the memory budget
+    and the heap covers the pairs they hold.
+
+    Parameters
+    ----------
+    tile_metadata: Union[List[Dict], bigstitcher_utilities.TileTable]
+        Tile metadata records or table. Its resolution, the
+        one written to the XML and used by the registration,
+        must be in microns
+    res_for_transforms: Optional[Tuple[float]]
+        Coarsest resolution in microns (XYZ) wanted for the
+        registration. Default: None (no limit)
+    level: Optional[int]
+        Level to use instead of choosing one. Default: None
+    pyramid: Optional[Tuple[List[List[int]], int]]
+        Level shapes (XYZ) and bytes per voxel as returned by
+        get_pyramid. Default: None (levels downsampled by 2)
+    cpus: Optional[int]
+        Available CPUs. Default: None (the container limit)
+    memory_bytes: Optional[int]
+        Available memory in bytes. Default: None (the container
+        memory)
+    memory_fraction: float
+        Fraction of the memory used by the registration. Default: 0.8
+    target_runtime: Optional[float]
+        Target runtime in seconds. Default: None
+    min_overlap_voxels: int
+        Minimum median overlap thickness in voxels. Default: 16
+
+    Returns
+    -------
+    Dict
+        Chosen level, parallel and memgb with the estimates
+        and inputs that led to them
+    """
+    if cpus is None or memory_bytes is None:
+        available_cpus, available_memory = get_available_resources()
+        cpus = available_cpus if cpus is None else cpus
+        memory_bytes = available_memory if memory_bytes is None else memory_bytes
+
+    memory_budget = int(memory_bytes * memory_fraction)
+    if not isinstance(tile_metadata, bigstitcher_utilities.TileTable):
+        tile_metadata = bigstitcher_utilities.TileTable.from_records(
+            tile_metadata, microns=True
+        )
+    tile_translations = tile_metadata.positions
+    tile_sizes = tile_metadata.sizes
+    tile_resolution = tile_metadata.resolution
+    pairs = TileIndex(
+        tile_translations, tile_sizes, tile_resolution
+    ).overlapping_pairs()
+
+    if pyramid is None:
+        scales = [np.full(3, 2.0**i) for i in range(DEFAULT_N_LEVELS)]
+        itemsize = DEFAULT_ITEMSIZE
+    else:
+        shapes, itemsize = pyramid
+        scales = [np.asarray(shapes[0], float) / np.asarray(s, float) for s in shapes]
+
+    costs = [
+        estimate_level_cost(
+            tile_translations,
+            tile_sizes,
+            tile_resolution,
+            pairs,
+            scale,
+            get_max_shift(i),
+            itemsize,
+        )
+        for i, scale in enumerate(scales)
+    ]
+    thick_enough = [
+        cost["thickness"] >= min_overlap_voxels or i == 0
+        for i, cost in enumerate(costs)
+    ]
+    reasons = []
+
+    if level is not None:
+        chosen = min(int(level), len(scales) - 1)
+        reasons.append(f"level {level} requested")
+    else:
+        chosen = 0
+        if res_for_transforms is not None:
+            for i, scale in enumerate(scales):
+                resolution = np.asarray(tile_resolution) * scale
+                if np.all(resolution <= np.asarray(res_for_transforms) + 1e-9):
+                    chosen = i
+            reasons.append(
+                f"level {chosen} is the coarsest within {res_for_transforms}"
+            )
+
+        while chosen > 0 and not thick_enough[chosen]:
+            chosen -= 1
+            reasons.append(f"overlap too thin, moved to level {chosen}")
+
+        def can_coarsen(i):
+            return i + 1 < len(scales) and thick_enough[i + 1]
+
+        while costs[chosen]["pair_memory"] > memory_budget and can_coarsen(chosen):
+            chosen += 1
+            reasons.append(f"a pair does not fit in memory, moved to level {chosen}")
+
+        if target_runtime is not None:
+            while can_coarsen(chosen):
+                workers = max(
+                    1,
+                    min(cpus, memory_budget // max(costs[chosen]["pair_memory"], 1)),
+                )
+                if costs[chosen]["seconds"] / workers <= target_runtime:
+                    break
+                chosen += 1
+                reasons.append(f"above the target runtime, moved to level {chosen}")
+
+    cost = costs[chosen]
+    parallel, memgb = get_workers(cost["pair_memory"], cpus, memory_budget)
+
+    plan = {
+        "level": int(chosen),
+        "parallel": parallel,
+        "memgb": memgb,
+        "n_pairs": int(len(pairs)),
+        "overlap_thickness_voxels": cost["thickness"],
+        "estimated_pair_memory_gb": round(cost["pair_memory"] / 1024**3, 4),
+        "estimated_bytes_read_gb": round(cost["bytes_read"] / 1024**3, 4),
+        "estimated_runtime_s": round(cost["seconds"] / parallel, 2),
+        "cpus": int(cpus),
+        "memory_gb": round(memory_bytes / 1024**3, 2),
+        "target_runtime_s": target_runtime,
+        "reasons": reasons,
+    }
+    logger.info(f"Registration plan: {plan}")
+    return plan
+
+
+def resize_plan(
+    plan: Dict,
+    cpus: Optional[int] = None,
+    memory_bytes: Optional[int] = None,
+    memory_fraction: float = 0.8,
+) -> Dict:
+    """
+    Sizes the workers and the JVM heap of a plan made on
+    another node to the available resources, from its
+    estimated pair memory. The level is kept.
+
+    Parameters
+    ----------
+    plan: Dict
+        Plan returned by plan_registration
+    cpus: Optional[int]
+        Available CPUs. Default: None (the container limit)
+    memory_bytes: Optional[int]
+        Available memory in bytes. Default: None (the container
+        memory)
+    memory_fraction: float
+        Fraction of the memory used by the registration. Default: 0.8
+
+    Returns
+    -------
+    Dict
+        Plan with parallel, memgb and the resources replaced
+    """
+    if cpus is None or memory_bytes is None:
+        available_cpus, available_memory = get_available_resources()
+        cpus = available_cpus if cpus is None else cpus
+        memory_bytes = available_memory if memory_bytes is None else memory_bytes
+
+    pair_memory = int(plan["estimated_pair_memory_gb"] * 1024**3)
+    parallel, memgb = get_workers(
+        pair_memory, cpus, int(memory_bytes * memory_fraction)
+    )
+    resized = dict(plan)
+    resized.update(
+        {
+            "parallel": parallel,
+            "memgb": memgb,
+            "estimated_runtime_s": round(
+                plan["estimated_runtime_s"] * plan["parallel"] / parallel, 2
+            ),
+            "cpus": int(cpus),
+            "memory_gb": round(memory_bytes / 1024**3, 2),
+            "reasons": plan["reasons"] + ["resized to the resources of this node"],
+        }
+    )
+    logger.info(f"Registration plan: {resized}")
+    return resized
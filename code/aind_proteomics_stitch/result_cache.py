@@ -0,0 +1,363 @@
+"""
+Content-addressed cache of the stitching stage outputs.
+Entries are keyed by a hash of the inputs that determine
+them, so reruns with the same inputs restore the dataset
+XML, the stitching parameters and the registration
+results instead of recomputing them.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import __version__
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_ENV = "STITCH_RESULT_CACHE_DIR"
+MANIFEST_NAME = "manifest.json"
+
+# Outputs of the XML and parameters creation
+BASE_ROLES = ("tile_metadata", "dataset_xml", "params_json")
+
+# Registration outputs, in the order the run script stores them
+REGISTRATION_ROLES = ("pairwise_shifts", "registered_xml")
+
+# Stitching parameters sized to the node the planner ran on,
+# which do not change the outputs and are left out of the key
+RESOURCE_PARAMS = ("planner", "memgb", "parallel")
+
+
+def get_cache_dir(cache_dir: Optional[str] = None) -> Optional[str]:
+    """
+    Resolves the cache directory.
+
+    Parameters
+    ----------
+    cache_dir: Optional[str]
+        Cache directory. Default: None (read from the
+        STITCH_RESULT_CACHE_DIR environment variable)
+
+    Returns
+    -------
+    Optional[str]
+        Cache directory or None if caching is disabled
+    """
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+    return str(cache_dir) if cache_dir else None
+
+
+def compute_cache_key(
+    channel_metadata: List[Dict],
+    path_to_data: str,
+    channel_wavelength: int,
+    scale_for_transforms: int,
+    stitching_dict: Dict,
+) -> str:
+    """
+    Computes the key of the stitching outputs as the SHA-256
+    of the canonical JSON of their inputs and the package
+    version. The parameters in RESOURCE_PARAMS are left out,
+    so the same dataset has the same key on any node.
+
+    Parameters
+    ----------
+    channel_metadata: List[Dict]
+        Tile metadata records of the stitching channel
+    path_to_data: str
+        Path to the tiles
+    channel_wavelength: int
+        Stitching channel
+    scale_for_transforms: int
+        Multiscale level used to compute the transforms
+    stitching_dict: Dict
+        Stitching parameters
+
+    Returns
+    -------
+    str
+        Hexadecimal cache key
+    """
+    inputs = {
+        "version": __version__,
+        "tile_metadata": sorted(channel_metadata, key=lambda e: e["file"]),
+        "path_to_data": str(path_to_data),
+        "channel_wavelength": int(channel_wavelength),
+        "scale_for_transforms": int(scale_for_transforms),
+        "stitching_dict": {
+            name: value
+            for name, value in stitching_dict.items()
+            if name not in RESOURCE_PARAMS
+        },
+    }
+    canonical = json.dumps(inputs, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def load_entry(cache_dir: str, key: str) -> Optional[Dict[str, str]]:
+    """
+    Reads the files of a cache entry.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Cache directory
+    key: str
+        Cache key
+
+    Returns
+    -------
+    Optional[Dict[str, str]]
+        Path of the cached file of each role, or None if
+        the entry does not exist or is incomplete
+    """
+    entry_dir = Path(cache_dir).joinpath(key)
+    manifest_path = entry_dir.joinpath(MANIFEST_NAME)
+    if not manifest_path.exists():
+        return None
+
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+
+    files = {role: str(entry_dir.joinpath(name)) for role, name in manifest.items()}
+    if not all(os.path.exists(path) for path in files.values()):
+        logger.warning(f"Ignoring incomplete cache entry {entry_dir}")
+        return None
+
+    return files
+
+
+def _atomic_copy(source: str, destination: Path) -> None:
+    """
+    Copies a file through a temporary file in the
+    destination folder, so readers never see a
+    partially written file.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=destination.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(source, temp_path)
+        os.replace(temp_path, destination)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def store_entry(cache_dir: str, key: str, files: Dict[str, str]) -> None:
+    """
+    Adds files to a cache entry, creating it if needed.
+    Files are stored under their basename and the manifest
+    is written last, so an interrupted store leaves the
+    previous state of the entry.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Cache directory
+    key: str
+        Cache key
+    files: Dict[str, str]
+        Path of the file of each role
+    """
+    entry_dir = Path(cache_dir).joinpath(key)
+    entry_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest_path = entry_dir.joinpath(MANIFEST_NAME)
+    manifest = {}
+    if manifest_path.exists():
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    for role, path in files.items():
+        name = Path(path).name
+        _atomic_copy(str(path), entry_dir.joinpath(name))
+        manifest[role] = name
+
+    fd, temp_path = tempfile.mkstemp(dir=entry_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(temp_path, manifest_path)
+    logger.info(f"Stored {sorted(files)} in cache entry {entry_dir}")
+
+
+def restore_entry(
+    cached_files: Dict[str, str],
+    destinations: Dict[str, str],
+    default_folder: str,
+) -> Dict[str, str]:
+    """
+    Copies the files of a cache entry to their destinations.
+
+    Parameters
+    ----------
+    cached_files: Dict[str, str]
+        Path of the cached file of each role, as returned
+        by load_entry
+    destinations: Dict[str, str]
+        Destination path of known roles
+    default_folder: str
+        Folder where the files of any other role are
+        restored under their cached name
+
+    Returns
+    -------
+    Dict[str, str]
+        Restored path of each role
+    """
+    restored = {}
+    for role, cached_path in cached_files.items():
+        destination = destinations.get(role)
+        if destination is None:
+            destination = Path(default_folder).joinpath(Path(cached_path).name)
+        shutil.copyfile(cached_path, destination)
+        restored[role] = str(destination)
+    return restored
+
+
+def get_record_path(params_json: str) -> str:
+    """
+    Path of the cache record written next to a stitching
+    parameters json, used by the later stages to find
+    the cache entry of the run.
+
+    Parameters
+    ----------
+    params_json: str
+        Path to the stitching parameters json
+
+    Returns
+    -------
+    str
+        Path to the cache record
+    """
+    return str(Path(params_json).with_suffix("")) + "_cache.json"
+
+
+def write_record(
+    params_json: str, cache_dir: str, key: str, restored: Dict[str, str]
+) -> None:
+    """
+    Writes the cache record of a run.
+
+    Parameters
+    ----------
+    params_json: str
+        Path to the stitching parameters json
+    cache_dir: str
+        Cache directory
+    key: str
+        Cache key
+    restored: Dict[str, str]
+        Files restored from the cache, empty on a miss
+    """
+    record = {"cache_dir": cache_dir, "key": key, "restored": restored}
+    with open(get_record_path(params_json), "w") as f:
+        json.dump(record, f, indent=4)
+
+
+def remove_record(params_json: str) -> None:
+    """
+    Removes the cache record of a previous run, so a run
+    without caching is not reported as restored.
+
+    Parameters
+    ----------
+    params_json: str
+        Path to the stitching parameters json
+    """
+    record_path = get_record_path(params_json)
+    if os.path.exists(record_path):
+        os.remove(record_path)
+        logger.info(f"Removed the cache record {record_path}")
+
+
+def get_restored_outputs(params_json: str) -> Dict[str, str]:
+    """
+    Registration outputs of a run that were restored from
+    the cache.
+
+    Parameters
+    ----------
+    params_json: str
+        Path to the stitching parameters json
+
+    Returns
+    -------
+    Dict[str, str]
+        Restored path of each role in REGISTRATION_ROLES, empty
+        if caching is disabled or the entry did not have all
+        of them
+    """
+    record_path = get_record_path(params_json)
+    if not os.path.exists(record_path):
+        return {}
+
+    with open(record_path, "r") as f:
+        record = json.load(f)
+
+    restored = record["restored"]
+    if not all(role in restored for role in REGISTRATION_ROLES):
+        return {}
+    return {role: restored[role] for role in REGISTRATION_ROLES}
+
+
+def main(command: str, params_json: str, outputs: Optional[List[str]] = None) -> int:
+    """
+    Entry point used by the run script after the XML and
+    parameters were created.
+
+    Parameters
+    ----------
+    command: str
+        "restored" returns 0 if the registration outputs of
+        the run were restored from the cache and 1 otherwise.
+        "store" adds the outputs to the cache entry of the run
+    params_json: str
+        Path to the stitching parameters json
+    outputs: Optional[List[str]]
+        Registration outputs to store, in the order of
+        REGISTRATION_ROLES. Default: None
+
+    Returns
+    -------
+    int
+        Exit code
+    """
+    record_path = get_record_path(params_json)
+    if not os.path.exists(record_path):
+        # Caching is disabled for this run
+        return 1 if command == "restored" else 0
+
+    with open(record_path, "r") as f:
+        record = json.load(f)
+
+    if command == "restored":
+        return 0 if get_restored_outputs(params_json) else 1
+
+    outputs = list(outputs or [])
+    if len(outputs) != len(REGISTRATION_ROLES):
+        raise ValueError(f"Expected the outputs {REGISTRATION_ROLES}, got {outputs}")
+
+    store_entry(
+        record["cache_dir"], record["key"], dict(zip(REGISTRATION_ROLES, outputs))
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=["restored", "store"])
+    parser.add_argument("--params_json", type=str, required=True)
+    parser.add_argument("--outputs", type=str, nargs="*", default=[])
+    parser.add_argument("--log_level", type=str, default="INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    sys.exit(main(args.command, args.params_json, args.outputs))
@@ -0,0 +1,563 @@
+"""
+Asynchronous chunk fetch layer for the tile stores.
+
+Requests are issued from an event loop running in a
+background thread with bounded concurrency over a shared
+connection pool, retried with exponential backoff and
+coalesced when the same key is already in flight. A local
+filesystem backend with optional simulated latency stands
+in for S3 in offline runs and benchmarks.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from zarr.storage import Store
+
+logger = logging.getLogger(__name__)
+
+
+def get_concurrency() -> int:
+    """
+    Maximum number of requests in flight per process, read
+    from STITCH_FETCH_CONCURRENCY (default 64).
+
+    Returns
+    -------
+    int
+        Maximum number of requests in flight
+    """
+    return int(os.environ.get("STITCH_FETCH_CONCURRENCY", 64))
+
+
+class TransientFetchError(Exception):
+    """
+    Error of a request that can be retried.
+    """
+
+
+class LocalBackend:
+    """
+    Reads objects from a local folder. An optional latency
+    is added to each request to simulate object storage.
+    """
+
+    def __init__(self, root: str, latency: float = 0.0):
+        """
+        Creates the backend.
+
+        Parameters
+        ----------
+        root: str
+            Folder that contains the objects
+        latency: float
+            Seconds added to each request. Default: 0.0
+        """
+        self.root = str(root)
+        self.latency = latency
+        self.name = self.root
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Reads an object.
+
+        Parameters
+        ----------
+        key: str
+            Key of the object relative to the root
+
+        Returns
+        -------
+        Optional[bytes]
+            Content of the object or None if it does not exist
+        """
+        if self.latency:
+            threading.Event().wait(self.latency)
+
+        try:
+            with open(os.path.join(self.root, key), "rb") as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+        except OSError as e:
+            raise TransientFetchError(str(e)) from e
+
+    def exists(self, key: str) -> bool:
+        """
+        Checks if an object or folder exists.
+        """
+        return os.path.exists(os.path.join(self.root, key))
+
+    def list(self) -> List[str]:
+        """
+        Lists the keys of every object under the root.
+        """
+        keys = []
+        for folder, _, files in os.walk(self.root):
+            relative = os.path.relpath(folder, self.root)
+            for name in files:
+                keys.append(name if relative == "." else f"{relative}/{name}")
+        return keys
+
+
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Returns the S3 client of this process. Its connection pool
+    holds STITCH_FETCH_CONCURRENCY connections (default 64).
+    Clients are created again in forked workers, since they
+    can not be shared across processes.
+
+    Returns
+    -------
+    botocore.client.S3
+        S3 client
+    """
+    global _s3_client, _s3_client_pid
+    with _s3_client_lock:
+        if _s3_client is None or _s3_client_pid != os.getpid():
+            import botocore.session
+            from botocore.config import Config
+
+            _s3_client = botocore.session.get_session().create_client(
+                "s3",
+                config=Config(
+                    max_pool_connections=get_concurrency(),
+                    # Retries are handled by the fetcher
+                    retries={"max_attempts": 1, "mode": "standard"},
+                ),
+            )
+            _s3_client_pid = os.getpid()
+        return _s3_client
+
+
+class S3Backend:
+    """
+    Reads objects from S3 with a botocore client whose
+    connection pool is shared by every request.
+    """
+
+    # Error codes of the requests that can be retried
+    TRANSIENT_CODES = (
+        "500",
+        "502",
+        "503",
+        "504",
+        "InternalError",
+        "RequestTimeout",
+        "SlowDown",
+        "Throttling",
+        "ThrottlingException",
+    )
+
+    def __init__(self, bucket: str, prefix: str):
+        """
+        Creates the backend.
+
+        Parameters
+        ----------
+        bucket: str
+            Bucket name
+        prefix: str
+            Prefix of the objects in the bucket
+        """
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.name = f"s3://{bucket}/{self.prefix}"
+
+    @property
+    def client(self):
+        """
+        S3 client shared by every backend of this process.
+        """
+        return get_s3_client()
+
+    def _object_key(self, key: str) -> str:
+        """
+        Key of an object in the bucket.
+        """
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Reads an object.
+
+        Parameters
+        ----------
+        key: str
+            Key of the object relative to the prefix
+
+        Returns
+        -------
+        Optional[bytes]
+            Content of the object or None if it does not exist
+        """
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self._object_key(key)
+            )
+            return response["Body"].read()
+        except ClientError as e:
+            code = str(e.response.get("Error", {}).get("Code"))
+            if code in ("NoSuchKey", "404"):
+                return None
+            if code in self.TRANSIENT_CODES:
+                raise TransientFetchError(code) from e
+            raise
+        except BotoCoreError as e:
+            raise TransientFetchError(str(e)) from e
+
+    def exists(self, key: str) -> bool:
+        """
+        Checks if an object exists.
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except ClientError as e:
+            code = str(e.response.get("Error", {}).get("Code"))
+            if code in ("NoSuchKey", "404"):
+                return False
+            if code in self.TRANSIENT_CODES:
+                raise TransientFetchError(code) from e
+            raise
+
+    def list(self) -> List[str]:
+        """
+        Lists the keys of every object under the prefix.
+        """
+        keys = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        prefix = f"{self.prefix}/" if self.prefix else ""
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(obj["Key"][len(prefix) :] for obj in page.get("Contents", []))
+        return keys
+
+
+class _EventLoopThread:
+    """
+    Event loop running in a daemon thread, so coroutines
+    can be awaited from synchronous code and from threads.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine in the loop and waits for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+_event_loop = None
+_event_loop_pid = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop_thread() -> _EventLoopThread:
+    """
+    Returns the fetch event loop of this process, which is
+    created again in forked workers.
+
+    Returns
+    -------
+    _EventLoopThread
+        Event loop thread of this process
+    """
+    global _event_loop, _event_loop_pid
+    with _event_loop_lock:
+        if _event_loop is None or _event_loop_pid != os.getpid():
+            _event_loop = _EventLoopThread()
+            _event_loop_pid = os.getpid()
+        return _event_loop
+
+
+class AsyncFetcher:
+    """
+    Fetches objects with bounded concurrency, retries with
+    exponential backoff and coalescing of the requests for
+    keys that are already in flight. A single fetcher is
+    shared by the stores of every tile.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 64,
+        max_retries: int = 5,
+        backoff: float = 0.1,
+    ):
+        """
+        Creates the fetcher.
+
+        Parameters
+        ----------
+        max_concurrency: int
+            Maximum number of requests in flight. Default: 64
+        max_retries: int
+            Maximum number of retries of a request. Default: 5
+        backoff: float
+            Seconds before the first retry, doubled on each
+            retry with up to 100% jitter. Default: 0.1
+        """
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.requests = 0
+        self.coalesced = 0
+        self.retries = 0
+        self._pid = None
+
+    def _setup(self) -> None:
+        """
+        Creates the per-process state inside the event loop.
+        """
+        if self._pid != os.getpid():
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+            self._in_flight = {}
+            self._pid = os.getpid()
+
+    async def _request(self, backend, key: str, method: str = "get"):
+        """
+        Requests a key with a blocking method of the
+        backend, retrying transient errors.
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                try:
+                    self.requests += 1
+                    return await loop.run_in_executor(
+                        self._executor, getattr(backend, method), key
+                    )
+                except TransientFetchError as e:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.backoff * 2**attempt * (1 + random.random())
+                    logger.debug(f"Retrying {backend.name}/{key} in {delay:.2f}s: {e}")
+                    self.retries += 1
+
+            await asyncio.sleep(delay)
+
+    async def fetch(self, backend, key: str) -> Optional[bytes]:
+        """
+        Fetches a key. Requests for a key that is already in
+        flight wait for the same response.
+
+        Parameters
+        ----------
+        backend: LocalBackend or S3Backend
+            Backend with a blocking get(key) method
+        key: str
+            Key of the object
+
+        Returns
+        -------
+        Optional[bytes]
+            Content of the object or None if it does not exist
+        """
+        self._setup()
+        request_key = (backend.name, key)
+        future = self._in_flight.get(request_key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(self._request(backend, key))
+        self._in_flight[request_key] = future
+        future.add_done_callback(lambda _: self._in_flight.pop(request_key, None))
+        return await asyncio.shield(future)
+
+    async def fetch_many(self, backend, keys: Sequence[str]) -> Dict[str, bytes]:
+        """
+        Fetches keys concurrently. Keys are issued in sorted
+        order, so neighbouring chunks are requested together.
+
+        Parameters
+        ----------
+        backend: LocalBackend or S3Backend
+            Backend with a blocking get(key) method
+        keys: Sequence[str]
+            Keys of the objects
+
+        Returns
+        -------
+        Dict[str, bytes]
+            Content of each key that exists
+        """
+        keys = sorted(set(keys))
+        values = await asyncio.gather(*(self.fetch(backend, key) for key in keys))
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    async def exists(self, backend, key: str) -> bool:
+        """
+        Checks if a key exists, sharing the concurrency
+        limit of the fetches.
+
+        Parameters
+        ----------
+        backend: LocalBackend or S3Backend
+            Backend with a blocking exists(key) method
+        key: str
+            Key of the object
+
+        Returns
+        -------
+        bool
+            Whether the object exists
+        """
+        self._setup()
+        return await self._request(backend, key, method="exists")
+
+    def get(self, backend, key: str) -> Optional[bytes]:
+        """
+        Blocking version of fetch.
+        """
+        return get_event_loop_thread().run(self.fetch(backend, key))
+
+    def get_many(self, backend, keys: Sequence[str]) -> Dict[str, bytes]:
+        """
+        Blocking version of fetch_many.
+        """
+        return get_event_loop_thread().run(self.fetch_many(backend, keys))
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the request counters.
+        """
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+        }
+
+
+_fetcher = None
+
+
+def get_fetcher() -> AsyncFetcher:
+    """
+    Returns the process-wide fetcher.
+
+    Returns
+    -------
+    AsyncFetcher
+        Fetcher shared by every store
+    """
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = AsyncFetcher(max_concurrency=get_concurrency())
+    return _fetcher
+
+
+class FetchStore(Store):
+    """
+    Read-only zarr store that reads through an AsyncFetcher.
+    Zarr reads the chunks of each selection with getitems,
+    so they are fetched concurrently.
+    """
+
+    def __init__(self, backend, fetcher: Optional[AsyncFetcher] = None):
+        """
+        Creates the store.
+
+        Parameters
+        ----------
+        backend: LocalBackend or S3Backend
+            Backend of the zarr
+        fetcher: Optional[AsyncFetcher]
+            Fetcher used for the requests. Default: None
+            (the process-wide fetcher)
+        """
+        self.backend = backend
+        self.fetcher = fetcher
+        self._readable = True
+        self._writeable = False
+        self._erasable = False
+        self._listable = True
+
+    def _get_fetcher(self) -> AsyncFetcher:
+        return self.fetcher or get_fetcher()
+
+    def __getitem__(self, key: str) -> bytes:
+        value = self._get_fetcher().get(self.backend, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def getitems(self, keys: Sequence[str], *, contexts=None) -> Dict[str, bytes]:
+        return self._get_fetcher().get_many(self.backend, keys)
+
+    def __contains__(self, key: str) -> bool:
+        return self.backend.exists(key)
+
+    def __setitem__(self, key: str, value: bytes) -> None:
+        raise PermissionError("FetchStore is read-only")
+
+    def __delitem__(self, key: str) -> None:
+        raise PermissionError("FetchStore is read-only")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.backend.list())
+
+    def __len__(self) -> int:
+        return len(self.backend.list())
+
+
+def get_backend(path: str, latency: Optional[float] = None):
+    """
+    Creates the backend of a local or s3 path.
+
+    Parameters
+    ----------
+    path: str
+        Local path or s3://bucket/prefix
+    latency: Optional[float]
+        Simulated latency of local reads. Default: None
+        (read from STITCH_FETCH_LATENCY, 0 seconds if unset)
+
+    Returns
+    -------
+    LocalBackend or S3Backend
+        Backend of the path
+    """
+    if path.startswith("s3://"):
+        bucket, _, prefix = path[len("s3://") :].partition("/")
+        return S3Backend(bucket, prefix)
+
+    if latency is None:
+        latency = float(os.environ.get("STITCH_FETCH_LATENCY", 0))
+    return LocalBackend(path, latency=latency)
+
+
+def open_store(path: str) -> FetchStore:
+    """
+    Opens a read-only store of a local or s3 path.
+
+    Parameters
+    ----------
+    path: str
+        Local path or s3://bucket/prefix of a zarr
+
+    Returns
+    -------
+    FetchStore
+        Store of the path
+    """
+    return FetchStore(get_backend(path))
@@ -0,0 +1,217 @@
+"""
+Runs independent tasks on a process pool keeping the
+estimated memory of the tasks in flight under a budget.
+Task results are written to a shared memory array
+instead of being pickled back to the parent process.
+"""
+
+import logging
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+from typing import Callable, Dict, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_pairs_memory(
+    fixed_start: np.ndarray,
+    fixed_end: np.ndarray,
+    moving_start: np.ndarray,
+    moving_end: np.ndarray,
+    offset: np.ndarray,
+    itemsize: int,
+) -> np.ndarray:
+    """
+    Estimates the peak memory in bytes of registering pairs.
+
+    It accounts for both crops in their dtype, their float32
+    copies, the float32 canvases, their real FFTs, the cross
+    power spectrum and the phase correlation matrix over the
+    canvas covering both crops, and the float64 copies made
+    to compute the normalized cross correlation.
+
+    Parameters
+    ----------
+    fixed_start: np.ndarray
+        Start of the fixed boxes (m, 3)
+    fixed_end: np.ndarray
+        End of the fixed boxes (m, 3)
+    moving_start: np.ndarray
+        Start of the moving boxes (m, 3)
+    moving_end: np.ndarray
+        End of the moving boxes (m, 3)
+    offset: np.ndarray
+        Offset of the moving tiles (m, 3)
+    itemsize: int
+        Bytes per voxel of the tiles
+
+    Returns
+    -------
+    np.ndarray
+        Estimated peak memory in bytes of each pair (m,)
+    """
+    fixed_voxels = np.prod(fixed_end - fixed_start, axis=-1, dtype=np.int64)
+    moving_voxels = np.prod(moving_end - moving_start, axis=-1, dtype=np.int64)
+
+    canvas_voxels = np.prod(
+        np.maximum(fixed_end, moving_end + offset)
+        - np.minimum(fixed_start, moving_start + offset),
+        axis=-1,
+        dtype=np.int64,
+    )
+
+    crops = (fixed_voxels + moving_voxels) * (itemsize + 4)
+    # 2 canvases, 2 half spectra (complex64), cross power, correlation matrix
+    spectra = canvas_voxels * 4 * 6
+    correlation = 2 * np.minimum(fixed_voxels, moving_voxels) * 8
+    return crops + spectra + correlation
+
+
+def estimate_pair_memory(overlap_box: Dict, itemsize: int) -> int:
+    """
+    Estimates the peak memory in bytes of registering a pair,
+    as estimate_pairs_memory.
+
+    Parameters
+    ----------
+    overlap_box: Dict
+        Overlap of the pair as returned by
+        overlaps.get_overlap_boxes
+    itemsize: int
+        Bytes per voxel of the tiles
+
+    Returns
+    -------
+    int
+        Estimated peak memory in bytes
+    """
+    fixed_start, fixed_end = overlap_box["fixed_box"]
+    moving_start, moving_end = overlap_box["moving_box"]
+    return int(
+        estimate_pairs_memory(
+            np.asarray(fixed_start),
+            np.asarray(fixed_end),
+            np.asarray(moving_start),
+            np.asarray(moving_end),
+            np.asarray(overlap_box["offset"]),
+            itemsize,
+        )
+    )
+
+
+def _run_task(
+    task: Callable,
+    shm_name: str,
+    shape: tuple,
+    rows: Sequence[int],
+    args: tuple,
+) -> None:
+    """
+    Runs a task in a worker and writes its result
+    in rows of the shared results array.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        results = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        results[rows] = task(*args)
+        del results
+    finally:
+        shm.close()
+
+
+def run_with_memory_budget(
+    task: Callable,
+    task_args: Sequence[tuple],
+    memory_estimates: Sequence[int],
+    n_outputs: int,
+    memory_budget: int,
+    max_workers: int = 1,
+    task_rows: Optional[Sequence[Sequence[int]]] = None,
+) -> np.ndarray:
+    """
+    Runs tasks on a process pool. A task is only submitted if
+    the estimated memory of the tasks in flight plus its own
+    stays within the budget, or if nothing else is running.
+    Tasks are submitted in the order of task_args.
+
+    Parameters
+    ----------
+    task: Callable
+        Picklable function returning n_outputs floats
+        for each of its rows
+    task_args: Sequence[tuple]
+        Arguments of each task
+    memory_estimates: Sequence[int]
+        Estimated peak memory in bytes of each task
+    n_outputs: int
+        Number of floats returned by each task
+    memory_budget: int
+        Maximum estimated memory in bytes of the tasks in flight
+    max_workers: int
+        Number of worker processes. Default: 1
+    task_rows: Optional[Sequence[Sequence[int]]]
+        Rows of the results written by each task. Default: None
+        (task k writes row k)
+
+    Returns
+    -------
+    np.ndarray
+        Results (n_rows, n_outputs)
+    """
+    if task_rows is None:
+        task_rows = [[k] for k in range(len(task_args))]
+
+    shape = (sum(len(rows) for rows in task_rows), n_outputs)
+    if not len(task_args):
+        return np.empty(shape, dtype=np.float64)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 8))
+    try:
+        results = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        results[:] = np.nan
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = list(range(len(task_args)))[::-1]
+            in_flight = {}
+            memory_in_flight = 0
+            peak_memory = 0
+
+            while pending or in_flight:
+                while (
+                    pending
+                    and len(in_flight) < max_workers
+                    and (
+                        not in_flight
+                        or memory_in_flight + memory_estimates[pending[-1]]
+                        <= memory_budget
+                    )
+                ):
+                    k = pending.pop()
+                    future = executor.submit(
+                        _run_task, task, shm.name, shape, task_rows[k], task_args[k]
+                    )
+                    in_flight[future] = k
+                    memory_in_flight += memory_estimates[k]
+                    peak_memory = max(peak_memory, memory_in_flight)
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    k = in_flight.pop(future)
+                    memory_in_flight -= memory_estimates[k]
+                    # Raises the exception of a failed task
+                    future.result()
+
+        logger.info(
+            f"Ran {len(task_args)} tasks with {max_workers} workers, "
+            f"peak estimated memory {peak_memory / 1024 ** 3:.2f} GiB "
+            f"of {memory_budget / 1024 ** 3:.2f} GiB"
+        )
+        output = results.copy()
+        del results
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return output
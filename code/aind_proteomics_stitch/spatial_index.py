@@ -0,0 +1,242 @@
+"""
+Spatial index over tile bounding boxes used to find
+overlapping tiles without comparing every pair.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import bigstitcher_utilities
+
+
+class TileIndex:
+    """
+    Uniform grid hash over the tile bounding boxes in microns.
+
+    The cell size defaults to the largest tile extent per axis,
+    so every tile covers at most two cells per axis and only
+    tiles sharing a cell are compared. Building the index and
+    enumerating the overlapping pairs takes O(n log n).
+    """
+
+    def __init__(
+        self,
+        tile_translations: List[List[float]],
+        tile_sizes: List[List[int]],
+        tile_resolution: List[float],
+        cell_size: Optional[List[float]] = None,
+    ):
+        """
+        Builds the index.
+
+        Parameters
+        ----------
+        tile_translations: List[List[float]]
+            Tile positions in microns in XYZ order
+        tile_sizes: List[List[int]]
+            Tile sizes in voxels in XYZ order
+        tile_resolution: List[float]
+            Voxel size in microns in XYZ order
+        cell_size: Optional[List[float]]
+            Size of the grid cells in microns in XYZ order. Cells
+            smaller than the tiles are allowed but make the index
+            larger. Default: None (largest tile extent per axis)
+        """
+        self.starts = np.asarray(tile_translations, dtype=np.float64).reshape(-1, 3)
+        self.ends = self.starts + np.asarray(tile_sizes, dtype=np.float64).reshape(
+            -1, 3
+        ) * np.asarray(tile_resolution, dtype=np.float64)
+
+        if cell_size is None:
+            cell_size = (self.ends - self.starts).max(axis=0, initial=1.0)
+        self.cell_size = np.maximum(np.asarray(cell_size, dtype=np.float64), 1e-9)
+
+        self.cells = self._build_cells()
+
+    @classmethod
+    def from_json(cls, json_dict: List[Dict], microns: bool = True) -> "TileIndex":
+        """
+        Builds the index from the tile metadata records.
+
+        Parameters
+        ----------
+        json_dict: List[Dict]
+            Tile metadata as read from the tile metadata json
+        microns: bool
+            Whether the pixel resolution is already in microns.
+            Default: True
+
+        Returns
+        -------
+        TileIndex
+            Index over the tiles in the order of the records
+        """
+        return cls.from_table(
+            bigstitcher_utilities.TileTable.from_records(json_dict, microns=microns)
+        )
+
+    @classmethod
+    def from_table(cls, table: bigstitcher_utilities.TileTable) -> "TileIndex":
+        """
+        Builds the index from a tile table.
+
+        Parameters
+        ----------
+        table: bigstitcher_utilities.TileTable
+            Tile table
+
+        Returns
+        -------
+        TileIndex
+            Index over the tiles in the order of the table
+        """
+        return cls(
+            tile_translations=table.positions,
+            tile_sizes=table.sizes,
+            tile_resolution=table.resolution,
+        )
+
+    def __len__(self) -> int:
+        """
+        Number of tiles in the index.
+        """
+        return len(self.starts)
+
+    def _cell_range(
+        self, box_min: np.ndarray, box_max: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        First and last grid cells covered by boxes.
+        """
+        first = np.floor(box_min / self.cell_size).astype(np.int64)
+        last = np.floor(box_max / self.cell_size).astype(np.int64)
+        # A box ending exactly on a cell border does not enter the next cell
+        on_border = (last > first) & (last * self.cell_size >= box_max)
+        return first, last - on_border
+
+    def _build_cells(self) -> Dict[Tuple[int, int, int], np.ndarray]:
+        """
+        Assigns every tile to the grid cells it covers.
+        """
+        if not len(self.starts):
+            self.cell_bounds = (
+                np.zeros(3, dtype=np.int64),
+                -np.ones(3, dtype=np.int64),
+            )
+            return {}
+
+        first, last = self._cell_range(self.starts, self.ends)
+
+        tile_ids = []
+        cell_ids = []
+        span = last - first
+        for offset in np.ndindex(*(span.max(axis=0, initial=0) + 1)):
+            valid = np.all(np.asarray(offset) <= span, axis=1)
+            tile_ids.append(np.flatnonzero(valid))
+            cell_ids.append(first[valid] + np.asarray(offset))
+
+        tile_ids = np.concatenate(tile_ids)
+        cell_ids = np.concatenate(cell_ids).reshape(-1, 3)
+
+        order = np.lexsort(cell_ids.T[::-1])
+        tile_ids = tile_ids[order]
+        cell_ids = cell_ids[order]
+
+        self.cell_bounds = (cell_ids.min(axis=0), cell_ids.max(axis=0))
+
+        boundaries = np.flatnonzero(np.any(np.diff(cell_ids, axis=0) != 0, axis=1)) + 1
+        return {
+            tuple(int(c) for c in cell_ids[group[0]]): tile_ids[group]
+            for group in np.split(np.arange(len(tile_ids)), boundaries)
+            if len(group)
+        }
+
+    def _intersects(
+        self, tiles: np.ndarray, box_min: np.ndarray, box_max: np.ndarray
+    ) -> np.ndarray:
+        """
+        Mask of the tiles whose boxes intersect a box.
+        """
+        overlap = np.minimum(self.ends[tiles], box_max) - np.maximum(
+            self.starts[tiles], box_min
+        )
+        return np.all(overlap > 0, axis=1)
+
+    def query(self, box_min: List[float], box_max: List[float]) -> np.ndarray:
+        """
+        Finds the tiles intersecting a box.
+
+        Parameters
+        ----------
+        box_min: List[float]
+            Lower corner of the box in microns in XYZ order
+        box_max: List[float]
+            Upper corner of the box in microns in XYZ order
+
+        Returns
+        -------
+        np.ndarray
+            Sorted indices of the tiles intersecting the box
+        """
+        box_min = np.asarray(box_min, dtype=np.float64)
+        box_max = np.asarray(box_max, dtype=np.float64)
+        first, last = self._cell_range(box_min, box_max)
+
+        # Cells outside the mosaic are empty
+        first = np.maximum(first, self.cell_bounds[0])
+        last = np.minimum(last, self.cell_bounds[1])
+
+        candidates = []
+        for cell in np.ndindex(*np.maximum(last - first + 1, 0)):
+            cell = tuple(int(c) for c in np.add(cell, first))
+            if cell in self.cells:
+                candidates.append(self.cells[cell])
+
+        if not candidates:
+            return np.array([], dtype=np.int64)
+
+        candidates = np.unique(np.concatenate(candidates))
+        return candidates[self._intersects(candidates, box_min, box_max)]
+
+    def neighbors(self, tile: int) -> np.ndarray:
+        """
+        Finds the tiles overlapping a tile.
+
+        Parameters
+        ----------
+        tile: int
+            Index of the tile
+
+        Returns
+        -------
+        np.ndarray
+            Sorted indices of the overlapping tiles
+        """
+        tiles = self.query(self.starts[tile], self.ends[tile])
+        return tiles[tiles != tile]
+
+    def overlapping_pairs(self) -> np.ndarray:
+        """
+        Enumerates the pairs of tiles whose boxes overlap.
+
+        Returns
+        -------
+        np.ndarray
+            Array (m, 2) with the overlapping pairs (i, j), i < j,
+            sorted lexicographically
+        """
+        pairs = []
+        for tiles in self.cells.values():
+            if len(tiles) > 1:
+                i, j = np.triu_indices(len(tiles), k=1)
+                pairs.append(np.stack([tiles[i], tiles[j]], axis=1))
+
+        if not pairs:
+            return np.empty((0, 2), dtype=np.int64)
+
+        pairs = np.unique(np.sort(np.concatenate(pairs), axis=1), axis=0)
+        overlap = np.minimum(
+            self.ends[pairs[:, 0]], self.ends[pairs[:, 1]]
+        ) - np.maximum(self.starts[pairs[:, 0]], self.starts[pairs[:, 1]])
+        return pairs[np.all(overlap > 0, axis=1)]
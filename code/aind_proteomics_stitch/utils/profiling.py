@@ -0,0 +1,353 @@
+"""
+Lightweight instrumentation of the stitching stage.
+
+Spans time named stages with a context manager or a
+decorator and aggregate their count and duration. Nested
+spans are named after their parents, e.g. "channel/write_xml".
+
+Setting STITCH_PROFILE to "cprofile" or "sampling" profiles
+the code run under profiled(). The profile is written to
+files and a summary to stderr, since the stdout of the run
+is parsed by the run script.
+"""
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ENV = "STITCH_PROFILE"
+SAMPLING_INTERVAL_ENV = "STITCH_PROFILE_INTERVAL"
+
+
+class SpanRecorder:
+    """
+    Aggregates the count and duration of named spans.
+    Spans can be recorded from several threads, each one
+    with its own nesting.
+    """
+
+    def __init__(self):
+        """
+        Class constructor
+        """
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._spans: Dict[str, Dict[str, float]] = {}
+
+    def _stack(self):
+        """
+        Names of the open spans of the calling thread.
+        """
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """
+        Times the enclosed block.
+
+        Parameters
+        ----------
+        name: str
+            Name of the span
+        """
+        stack = self._stack()
+        stack.append(name)
+        full_name = "/".join(stack)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(full_name, time.perf_counter() - start_time)
+            stack.pop()
+
+    def record(self, name: str, seconds: float, count: int = 1) -> None:
+        """
+        Adds a duration to a span.
+
+        Parameters
+        ----------
+        name: str
+            Full name of the span
+        seconds: float
+            Duration in seconds
+        count: int
+            Number of calls. Default: 1
+        """
+        with self._lock:
+            entry = self._spans.setdefault(
+                name, {"count": 0, "total_s": 0.0, "max_s": 0.0}
+            )
+            entry["count"] += count
+            entry["total_s"] += seconds
+            entry["max_s"] = max(entry["max_s"], seconds / max(count, 1))
+
+    def merge(self, other: "SpanRecorder", prefix: Optional[str] = None) -> None:
+        """
+        Adds the spans of another recorder.
+
+        Parameters
+        ----------
+        other: SpanRecorder
+            Recorder to merge
+        prefix: Optional[str]
+            Parent name of the merged spans. Default: None
+        """
+        for name, entry in other.summary().items():
+            name = f"{prefix}/{name}" if prefix else name
+            with self._lock:
+                current = self._spans.setdefault(
+                    name, {"count": 0, "total_s": 0.0, "max_s": 0.0}
+                )
+                current["count"] += entry["count"]
+                current["total_s"] += entry["total_s"]
+                current["max_s"] = max(current["max_s"], entry["max_s"])
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Count, total and maximum duration of every span.
+
+        Returns
+        -------
+        Dict[str, Dict[str, float]]
+            Statistics of each span in the order they
+            were first recorded
+        """
+        with self._lock:
+            return {
+                name: {
+                    "count": int(entry["count"]),
+                    "total_s": round(entry["total_s"], 6),
+                    "max_s": round(entry["max_s"], 6),
+                }
+                for name, entry in self._spans.items()
+            }
+
+    def format(self) -> str:
+        """
+        One line summary of the spans.
+
+        Returns
+        -------
+        str
+            Total duration and count of each span
+        """
+        return ", ".join(
+            f"{name} {entry['total_s']:.3f}s"
+            + (f" (x{entry['count']})" if entry["count"] > 1 else "")
+            for name, entry in self.summary().items()
+        )
+
+    def write(self, output_path: str) -> None:
+        """
+        Writes the summary as json.
+
+        Parameters
+        ----------
+        output_path: str
+            Path of the json
+        """
+        with open(output_path, "w") as f:
+            json.dump(self.summary(), f, indent=4)
+
+    def reset(self) -> None:
+        """
+        Removes every span.
+        """
+        with self._lock:
+            self._spans = {}
+
+
+_recorder = SpanRecorder()
+
+
+def get_recorder() -> SpanRecorder:
+    """
+    Recorder of the process.
+
+    Returns
+    -------
+    SpanRecorder
+        Process-wide recorder
+    """
+    return _recorder
+
+
+def span(name: str, recorder: Optional[SpanRecorder] = None):
+    """
+    Times the enclosed block.
+
+    Parameters
+    ----------
+    name: str
+        Name of the span
+    recorder: Optional[SpanRecorder]
+        Recorder of the span. Default: None (the
+        process-wide recorder)
+    """
+    return (recorder or _recorder).span(name)
+
+
+def traced(
+    name: Optional[str] = None, recorder: Optional[SpanRecorder] = None
+) -> Callable:
+    """
+    Decorator that times every call of a function.
+
+    Parameters
+    ----------
+    name: Optional[str]
+        Name of the span. Default: None (the function name)
+    recorder: Optional[SpanRecorder]
+        Recorder of the span. Default: None (the
+        process-wide recorder)
+    """
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, recorder):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class StackSampler:
+    """
+    Sampling profiler that records the stacks of every
+    thread at a fixed interval from a daemon thread. The
+    stacks are written in the collapsed format read by
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        """
+        Class constructor
+
+        Parameters
+        ----------
+        interval: float
+            Sampling interval in seconds. Default: 0.01
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Starts sampling.
+        """
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops sampling.
+        """
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        """
+        Samples the stacks until stopped.
+        """
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, output_path: str) -> None:
+        """
+        Writes the collapsed stacks.
+
+        Parameters
+        ----------
+        output_path: str
+            Path of the collapsed stacks
+        """
+        with open(output_path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profiled(output_prefix: str, mode: Optional[str] = None) -> Iterator[None]:
+    """
+    Profiles the enclosed block if requested.
+
+    Parameters
+    ----------
+    output_prefix: str
+        Prefix of the profile files. cProfile writes
+        <prefix>.prof and the sampling profiler writes
+        <prefix>.collapsed
+    mode: Optional[str]
+        "cprofile", "sampling" or None to read it from the
+        STITCH_PROFILE environment variable. Profiling is
+        disabled if it is empty
+    """
+    mode = (mode if mode is not None else os.environ.get(PROFILE_ENV, "")).lower()
+    if not mode:
+        yield
+        return
+
+    if mode not in ("cprofile", "sampling"):
+        raise ValueError(f"Unknown profiler {mode}, use cprofile or sampling")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_prefix)), exist_ok=True)
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f"{output_prefix}.prof")
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(
+                30
+            )
+            sys.stderr.write(stream.getvalue())
+            logger.info(f"Wrote cProfile stats to {output_prefix}.prof")
+    else:
+        sampler = StackSampler(
+            interval=float(os.environ.get(SAMPLING_INTERVAL_ENV, 0.01))
+        )
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.write(f"{output_prefix}.collapsed")
+            logger.info(
+                f"Wrote {sum(sampler.stacks.values())} stack samples "
+                f"to {output_prefix}.collapsed"
+            )
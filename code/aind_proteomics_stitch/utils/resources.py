@@ -0,0 +1,358 @@
+"""
+Discovery of the compute resources available to the
+container: CPU quota and memory limit from cgroup v1 or
+v2, the CPU affinity and NUMA layout of the process, and
+the Code Ocean overrides.
+"""
+
+import logging
+import math
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+NUMA_ROOT = "/sys/devices/system/node"
+
+# Environment overrides of the number of cores and bytes of memory
+CPUS_ENV = "CO_CPUS"
+MEMORY_ENV = "CO_MEMORY"
+
+# cgroup v1 reports no memory limit as a value close to 2**63
+UNLIMITED_BYTES = 2**60
+
+
+@dataclass
+class SystemResources:
+    """
+    Compute resources available to the process.
+
+    Attributes
+    ----------
+    cpus: int
+        Cores to size the workers with
+    memory_bytes: int
+        Memory in bytes to size the workers with
+    cpu_quota: Optional[float]
+        Cores allowed by the cgroup CPU quota, None if unlimited
+    memory_limit: Optional[int]
+        Bytes allowed by the cgroup memory limit, None if unlimited
+    affinity_cpus: int
+        Cores the process can be scheduled on
+    logical_cpus: int
+        Logical cores of the node
+    total_memory: int
+        Physical memory of the node in bytes
+    numa_nodes: List[List[int]]
+        Cores of each NUMA node the process can be scheduled on
+    sources: Dict[str, str]
+        Where cpus and memory_bytes were read from
+    """
+
+    cpus: int
+    memory_bytes: int
+    cpu_quota: Optional[float]
+    memory_limit: Optional[int]
+    affinity_cpus: int
+    logical_cpus: int
+    total_memory: int
+    numa_nodes: List[List[int]] = field(default_factory=list)
+    sources: Dict[str, str] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict:
+        """
+        Dictionary with the resources.
+        """
+        return asdict(self)
+
+
+def _read_text(path: str) -> Optional[str]:
+    """
+    Reads a small text file, returning None if it
+    does not exist or can not be read.
+    """
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _parse_cpu_list(cpu_list: str) -> List[int]:
+    """
+    Parses a kernel cpu list such as "0-3,8,10-11".
+    """
+    cpus = []
+    for part in cpu_list.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def get_cgroup_paths(proc_cgroup: str = "/proc/self/cgroup") -> Dict[str, str]:
+    """
+    Reads the cgroup of the process for each controller.
+
+    Parameters
+    ----------
+    proc_cgroup: str
+        Path to the cgroup file of the process
+
+    Returns
+    -------
+    Dict[str, str]
+        Cgroup path of each cgroup v1 controller. The
+        cgroup v2 path is stored under the empty key
+    """
+    content = _read_text(proc_cgroup) or ""
+    paths = {}
+    for line in content.splitlines():
+        parts = line.split(":", 2)
+        if len(parts) != 3:
+            continue
+        _, controllers, path = parts
+        for controller in controllers.split(","):
+            paths[controller] = path
+    return paths
+
+
+def _get_cgroup_files(
+    controller: Optional[str], name: str, cgroup_root: str, paths: Dict[str, str]
+) -> List[str]:
+    """
+    Candidate paths of a cgroup file, from the cgroup of
+    the process to the root of the hierarchy. A controller
+    of None refers to the cgroup v2 unified hierarchy.
+    """
+    if controller is None:
+        root = cgroup_root
+        path = paths.get("", "/")
+    else:
+        root = os.path.join(cgroup_root, controller)
+        path = paths.get(controller, "/")
+
+    candidates = []
+    parts = [p for p in path.split("/") if p]
+    for i in range(len(parts), -1, -1):
+        candidates.append(os.path.join(root, *parts[:i], name))
+    return candidates
+
+
+def get_cgroup_cpu_quota(cgroup_root: str = CGROUP_ROOT) -> Optional[float]:
+    """
+    Reads the CPU quota of the cgroup of the process from
+    cpu.max (v2) or cpu.cfs_quota_us and cpu.cfs_period_us (v1).
+
+    Parameters
+    ----------
+    cgroup_root: str
+        Mount point of the cgroup filesystem
+
+    Returns
+    -------
+    Optional[float]
+        Cores allowed by the quota, None if unlimited
+    """
+    paths = get_cgroup_paths()
+
+    # Nested cgroups can be stricter than their parents, and
+    # the quota is often set on a parent slice only
+    quotas = []
+    for candidate in _get_cgroup_files(None, "cpu.max", cgroup_root, paths):
+        value = _read_text(candidate)
+        if value is None:
+            continue
+        quota, _, period = value.partition(" ")
+        if quota != "max":
+            quotas.append(int(quota) / int(period or 100000))
+
+    for candidate in _get_cgroup_files("cpu", "cpu.cfs_quota_us", cgroup_root, paths):
+        quota = _read_text(candidate)
+        period = _read_text(
+            os.path.join(os.path.dirname(candidate), "cpu.cfs_period_us")
+        )
+        if quota is not None and period is not None and int(quota) > 0:
+            quotas.append(int(quota) / int(period))
+
+    return min(quotas) if quotas else None
+
+
+def get_cgroup_memory_limit(cgroup_root: str = CGROUP_ROOT) -> Optional[int]:
+    """
+    Reads the memory limit of the cgroup of the process from
+    memory.max (v2) or memory.limit_in_bytes (v1).
+
+    Parameters
+    ----------
+    cgroup_root: str
+        Mount point of the cgroup filesystem
+
+    Returns
+    -------
+    Optional[int]
+        Bytes allowed by the limit, None if unlimited
+    """
+    paths = get_cgroup_paths()
+
+    # Nested cgroups can be stricter than their parents
+    limits = []
+    for candidate in _get_cgroup_files(None, "memory.max", cgroup_root, paths):
+        value = _read_text(candidate)
+        if value is not None and value != "max":
+            limits.append(int(value))
+
+    for candidate in _get_cgroup_files(
+        "memory", "memory.limit_in_bytes", cgroup_root, paths
+    ):
+        value = _read_text(candidate)
+        if value is not None and int(value) < UNLIMITED_BYTES:
+            limits.append(int(value))
+
+    return min(limits) if limits else None
+
+
+def get_affinity_cpus() -> List[int]:
+    """
+    Cores the process can be scheduled on.
+
+    Returns
+    -------
+    List[int]
+        Core ids
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_numa_nodes(
+    affinity: Optional[List[int]] = None, numa_root: str = NUMA_ROOT
+) -> List[List[int]]:
+    """
+    Cores of each NUMA node that the process can be
+    scheduled on.
+
+    Parameters
+    ----------
+    affinity: Optional[List[int]]
+        Cores the process can be scheduled on. Default: None
+        (read from the process)
+    numa_root: str
+        Folder with the NUMA nodes of the system
+
+    Returns
+    -------
+    List[List[int]]
+        Cores of each node, empty if the layout is unknown
+    """
+    affinity = set(get_affinity_cpus() if affinity is None else affinity)
+    if not os.path.isdir(numa_root):
+        return []
+
+    nodes = []
+    names = [
+        n for n in os.listdir(numa_root) if n.startswith("node") and n[4:].isdigit()
+    ]
+    for name in sorted(names, key=lambda n: int(n[4:])):
+        cpu_list = _read_text(os.path.join(numa_root, name, "cpulist"))
+        if cpu_list is None:
+            continue
+        cpus = [cpu for cpu in _parse_cpu_list(cpu_list) if cpu in affinity]
+        if cpus:
+            nodes.append(cpus)
+    return nodes
+
+
+def get_resources(cgroup_root: str = CGROUP_ROOT) -> SystemResources:
+    """
+    Discovers the resources available to the process.
+
+    The cores are the CO_CPUS override if set, otherwise the
+    smallest of the cgroup quota (rounded down) and the cores
+    in the affinity of the process. The memory is the CO_MEMORY
+    override if set, otherwise the smallest of the cgroup limit
+    and the physical memory.
+
+    Parameters
+    ----------
+    cgroup_root: str
+        Mount point of the cgroup filesystem
+
+    Returns
+    -------
+    SystemResources
+        Available resources
+    """
+    import psutil
+
+    affinity = get_affinity_cpus()
+    cpu_quota = get_cgroup_cpu_quota(cgroup_root)
+    memory_limit = get_cgroup_memory_limit(cgroup_root)
+    total_memory = int(psutil.virtual_memory().total)
+    sources = {}
+
+    co_cpus = os.environ.get(CPUS_ENV)
+    if co_cpus:
+        cpus = int(co_cpus)
+        sources["cpus"] = CPUS_ENV
+    elif cpu_quota is not None and cpu_quota < len(affinity):
+        cpus = math.floor(cpu_quota)
+        sources["cpus"] = "cgroup"
+    else:
+        cpus = len(affinity)
+        sources["cpus"] = "affinity"
+
+    co_memory = os.environ.get(MEMORY_ENV)
+    if co_memory:
+        memory_bytes = int(co_memory)
+        sources["memory_bytes"] = MEMORY_ENV
+    elif memory_limit is not None and memory_limit < total_memory:
+        memory_bytes = memory_limit
+        sources["memory_bytes"] = "cgroup"
+    else:
+        memory_bytes = total_memory
+        sources["memory_bytes"] = "physical"
+
+    return SystemResources(
+        cpus=max(1, cpus),
+        memory_bytes=int(memory_bytes),
+        cpu_quota=cpu_quota,
+        memory_limit=memory_limit,
+        affinity_cpus=len(affinity),
+        logical_cpus=int(psutil.cpu_count(logical=True) or len(affinity)),
+        total_memory=total_memory,
+        numa_nodes=get_numa_nodes(affinity),
+        sources=sources,
+    )
+
+
+def get_cpu_limit() -> int:
+    """
+    Cores available to the process.
+
+    Returns
+    -------
+    int
+        Number of cores
+    """
+    return get_resources().cpus
+
+
+def get_memory_limit() -> int:
+    """
+    Memory available to the process.
+
+    Returns
+    -------
+    int
+        Memory in bytes
+    """
+    return get_resources().memory_bytes
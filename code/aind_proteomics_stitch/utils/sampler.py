@@ -0,0 +1,414 @@
+"""
+Background sampler of the resources used by a process tree.
+Each sample records the CPU, resident memory and I/O bytes
+summed over a process and its descendants, including the
+Fiji JVM launched by the run script, and the network bytes
+of the container. The timeline is written as JSONL or as a
+Chrome trace that can be opened in chrome://tracing or
+Perfetto and aggregated across runs.
+
+Attach to a running process tree from the command line:
+    python -m aind_proteomics_stitch.utils.sampler --pid 1234 \
+        --output ../results/metadata/stitching_resources.jsonl
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Dict, List, Optional
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 1.0
+INTERVAL_ENV = "STITCH_SAMPLER_INTERVAL"
+
+# Fields of a sample exported as Chrome trace counters
+COUNTERS = {
+    "cpu": ["cpu_percent"],
+    "memory": ["rss_bytes"],
+    "io": ["read_bytes", "write_bytes"],
+    "network": ["net_bytes_sent", "net_bytes_recv"],
+    "processes": ["n_processes"],
+}
+
+
+def get_interval(interval: Optional[float] = None) -> float:
+    """
+    Resolves the sampling interval.
+
+    Parameters
+    ----------
+    interval: Optional[float]
+        Interval in seconds. Default: None (read from the
+        STITCH_SAMPLER_INTERVAL environment variable)
+
+    Returns
+    -------
+    float
+        Interval in seconds
+    """
+    if interval is None:
+        interval = float(os.environ.get(INTERVAL_ENV, DEFAULT_INTERVAL))
+    return max(float(interval), 0.01)
+
+
+class ResourceSampler:
+    """
+    Samples a process tree from a background thread.
+
+    The sampler can be used as a context manager or through
+    start and stop. Samples are appended to the output as
+    they are taken when it is a JSONL file, so a killed run
+    keeps its timeline up to the last sample.
+    """
+
+    def __init__(
+        self,
+        pid: Optional[int] = None,
+        interval: Optional[float] = None,
+        output_path: Optional[str] = None,
+        output_format: Optional[str] = None,
+    ):
+        """
+        Class constructor
+
+        Parameters
+        ----------
+        pid: Optional[int]
+            Root of the process tree. Default: None (this process)
+        interval: Optional[float]
+            Sampling interval in seconds. Default: None
+            (STITCH_SAMPLER_INTERVAL or 1 second)
+        output_path: Optional[str]
+            File where the timeline is written. Default: None
+            (the samples are only kept in memory)
+        output_format: Optional[str]
+            "jsonl" or "chrome". Default: None (chrome if the
+            output path ends with .json, jsonl otherwise)
+        """
+        self.pid = os.getpid() if pid is None else int(pid)
+        self.interval = get_interval(interval)
+        self.output_path = None if output_path is None else str(output_path)
+        if output_format is None:
+            output_format = (
+                "chrome"
+                if self.output_path is not None and self.output_path.endswith(".json")
+                else "jsonl"
+            )
+        if output_format not in ("jsonl", "chrome"):
+            raise ValueError(f"Unknown timeline format: {output_format}")
+        self.output_format = output_format
+
+        self.samples: List[Dict] = []
+        self._own_pid = os.getpid()
+        self._processes: Dict[int, psutil.Process] = {}
+        # Last I/O counters of every process seen, so the
+        # totals do not drop when a process exits
+        self._io: Dict[int, Dict[str, int]] = {}
+        self._net_start = None
+        self._start_time = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._file = None
+
+    def __enter__(self) -> "ResourceSampler":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    @property
+    def running(self) -> bool:
+        """
+        Whether the sampler thread is running.
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> "ResourceSampler":
+        """
+        Starts sampling in a daemon thread.
+
+        Returns
+        -------
+        ResourceSampler
+            The sampler
+        """
+        if self.running:
+            return self
+
+        self._start_time = time.time()
+        self._net_start = self._get_net_counters()
+        self._stop_event.clear()
+        if self.output_path is not None and self.output_format == "jsonl":
+            self._file = open(self.output_path, "w")
+
+        self._thread = threading.Thread(
+            target=self._run, name="resource-sampler", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Sampling resources of process {self.pid} every {self.interval}s")
+        return self
+
+    def stop(self) -> List[Dict]:
+        """
+        Stops sampling and writes the timeline.
+
+        Returns
+        -------
+        List[Dict]
+            Samples taken
+        """
+        if self._thread is None:
+            return self.samples
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        elif self.output_path is not None:
+            self.write(self.output_path, self.output_format)
+
+        logger.info(f"Took {len(self.samples)} resource samples")
+        return self.samples
+
+    def request_stop(self) -> None:
+        """
+        Asks the sampler thread to stop after the current
+        sample, without waiting for it.
+        """
+        self._stop_event.set()
+
+    def wait(self) -> None:
+        """
+        Blocks until the root process exits or the
+        sampler is stopped.
+        """
+        while self.running:
+            self._thread.join(timeout=self.interval)
+
+    def _run(self) -> None:
+        """
+        Samples on a fixed schedule until stopped or
+        until the root process exits.
+        """
+        next_time = time.monotonic()
+        while not self._stop_event.is_set():
+            sample = self.sample()
+            if sample is None:
+                break
+
+            self.samples.append(sample)
+            if self._file is not None:
+                self._file.write(json.dumps(sample) + "\n")
+                self._file.flush()
+
+            next_time += self.interval
+            self._stop_event.wait(max(0.0, next_time - time.monotonic()))
+
+    def _get_tree(self) -> Optional[List[psutil.Process]]:
+        """
+        Processes of the tree, reusing the objects of known
+        processes so their CPU percentages are measured
+        since the previous sample.
+        """
+        root = self._processes.get(self.pid)
+        try:
+            if root is None:
+                root = psutil.Process(self.pid)
+            tree = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return None
+
+        processes = {}
+        for process in tree:
+            if process.pid == self._own_pid and self.pid != self._own_pid:
+                continue
+            processes[process.pid] = self._processes.get(process.pid, process)
+        self._processes = processes
+        return list(processes.values())
+
+    @staticmethod
+    def _get_net_counters() -> Dict[str, int]:
+        """
+        Network bytes of the container.
+        """
+        counters = psutil.net_io_counters()
+        if counters is None:
+            return {"bytes_sent": 0, "bytes_recv": 0}
+        return {"bytes_sent": counters.bytes_sent, "bytes_recv": counters.bytes_recv}
+
+    def sample(self) -> Optional[Dict]:
+        """
+        Takes one sample of the process tree.
+
+        Returns
+        -------
+        Optional[Dict]
+            Sample, or None if the root process exited
+        """
+        tree = self._get_tree()
+        if tree is None:
+            return None
+
+        cpu_percent = 0.0
+        rss_bytes = 0
+        n_processes = 0
+        for process in tree:
+            try:
+                with process.oneshot():
+                    cpu_percent += process.cpu_percent()
+                    rss_bytes += process.memory_info().rss
+                    try:
+                        io = process.io_counters()
+                        self._io[process.pid] = {
+                            "read_bytes": io.read_bytes,
+                            "write_bytes": io.write_bytes,
+                        }
+                    except (psutil.AccessDenied, AttributeError):
+                        pass
+                n_processes += 1
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                continue
+            except psutil.AccessDenied:
+                continue
+
+        net = self._get_net_counters()
+        return {
+            "time": round(time.time() - self._start_time, 3),
+            "timestamp": time.time(),
+            "n_processes": n_processes,
+            "cpu_percent": round(cpu_percent, 1),
+            "rss_bytes": int(rss_bytes),
+            "read_bytes": int(sum(io["read_bytes"] for io in self._io.values())),
+            "write_bytes": int(sum(io["write_bytes"] for io in self._io.values())),
+            "net_bytes_sent": int(net["bytes_sent"] - self._net_start["bytes_sent"]),
+            "net_bytes_recv": int(net["bytes_recv"] - self._net_start["bytes_recv"]),
+        }
+
+    def write(self, output_path: str, output_format: str = "jsonl") -> None:
+        """
+        Writes the samples taken so far.
+
+        Parameters
+        ----------
+        output_path: str
+            Path of the timeline
+        output_format: str
+            "jsonl" or "chrome". Default: "jsonl"
+        """
+        with open(output_path, "w") as f:
+            if output_format == "chrome":
+                json.dump(to_chrome_trace(self.samples, self.pid), f)
+            else:
+                for sample in self.samples:
+                    f.write(json.dumps(sample) + "\n")
+
+
+def to_chrome_trace(samples: List[Dict], pid: int) -> Dict:
+    """
+    Converts samples to Chrome trace counter events.
+
+    Parameters
+    ----------
+    samples: List[Dict]
+        Samples of a ResourceSampler
+    pid: int
+        Root process of the sampled tree
+
+    Returns
+    -------
+    Dict
+        Chrome trace
+    """
+    events = []
+    for sample in samples:
+        for name, fields in COUNTERS.items():
+            events.append(
+                {
+                    "name": name,
+                    "ph": "C",
+                    "ts": int(sample["timestamp"] * 1e6),
+                    "pid": int(pid),
+                    "args": {field: sample[field] for field in fields},
+                }
+            )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def read_timeline(path: str) -> List[Dict]:
+    """
+    Reads a JSONL timeline.
+
+    Parameters
+    ----------
+    path: str
+        Path of the timeline
+
+    Returns
+    -------
+    List[Dict]
+        Samples
+    """
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main(
+    pid: int,
+    output_path: str,
+    interval: Optional[float] = None,
+    output_format: Optional[str] = None,
+) -> None:
+    """
+    Samples a process tree until the root process exits
+    or the sampler receives SIGTERM or SIGINT.
+
+    Parameters
+    ----------
+    pid: int
+        Root of the process tree
+    output_path: str
+        Path of the timeline
+    interval: Optional[float]
+        Sampling interval in seconds. Default: None
+    output_format: Optional[str]
+        "jsonl" or "chrome". Default: None
+    """
+    sampler = ResourceSampler(
+        pid=pid,
+        interval=interval,
+        output_path=output_path,
+        output_format=output_format,
+    )
+
+    def handle_signal(signum, frame):
+        sampler.request_stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    sampler.start()
+    sampler.wait()
+    sampler.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pid", type=int, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--interval", type=float, default=None)
+    parser.add_argument("--format", type=str, default=None, choices=["jsonl", "chrome"])
+    parser.add_argument("--log_level", type=str, default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    main(args.pid, args.output, args.interval, args.format)
@@ -13,42 +13,32 @@ import subprocess
 import time
 from datetime import datetime
 from pathlib import Path
-from typing import Any, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Any, List, Optional, Tuple, Union
 
-import matplotlib.pyplot as plt
-import psutil
-from aind_data_schema.base import AindCoreModel
-from aind_data_schema.core.processing import (DataProcess, PipelineProcess,
-                                              Processing)
+from . import resources
+
+# matplotlib, psutil and aind_data_schema take most of the
+# import time of the package, so they are imported by the
+# functions that use them
+if TYPE_CHECKING:
+    from aind_data_schema.core.processing import DataProcess
 
 # IO types
 PathLike = Union[str, Path]
 
 
-def get_code_ocean_cpu_limit():
+def get_code_ocean_cpu_limit() -> int:
     """
-    Gets the Code Ocean capsule CPU limit
+    Gets the Code Ocean capsule CPU limit from the CO_CPUS
+    override, the cgroup (v1 or v2) CPU quota or the CPU
+    affinity of the process
 
     Returns
     -------
     int:
         number of cores available for compute
     """
-    # Checks for environmental variables
-    co_cpus = os.environ.get("CO_CPUS")
-    aws_batch_job_id = os.environ.get("AWS_BATCH_JOB_ID")
-
-    if co_cpus:
-        return co_cpus
-    if aws_batch_job_id:
-        return 1
-    with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as fp:
-        cfs_quota_us = int(fp.read())
-    with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as fp:
-        cfs_period_us = int(fp.read())
-    container_cpus = cfs_quota_us // cfs_period_us
-    # For physical machine, the `cfs_quota_us` could be '-1'
-    return psutil.cpu_count(logical=False) if container_cpus < 1 else container_cpus
+    return resources.get_cpu_limit()
 
 
 def create_folder(dest_dir: PathLike, verbose: Optional[bool] = False) -> None:
@@ -342,7 +332,7 @@ def save_string_to_txt(txt: str, filepath: PathLike, mode="w") -> None:
 
 
 def generate_processing(
-    data_processes: List[DataProcess],
+    data_processes: List["DataProcess"],
     dest_processing: str,
     processor_full_name: str,
     pipeline_version: str,
@@ -367,6 +357,8 @@ def generate_processing(
         Terastitcher pipeline version
 
     """
+    from aind_data_schema.core.processing import PipelineProcess, Processing
+
     # flake8: noqa: E501
     processing_pipeline = PipelineProcess(
         data_processes=data_processes,
@@ -485,6 +477,8 @@ def copy_available_metadata(
         were copied
     """
 
+    from aind_data_schema.base import AindCoreModel
+
     # We get all the valid filenames from the aind core model
     metadata_to_find = [
         cls.default_filename() for cls in AindCoreModel.__subclasses__()
@@ -619,7 +613,10 @@ def profile_resources(
     monitoring_interval: int,
 ):
     """
-    Profiles compute resources usage.
+    Profiles compute resources usage. The CPU percentage
+    call blocks for the monitoring interval, so a sample is
+    taken every interval. See sampler.ResourceSampler for a
+    per-process timeline.
 
     Parameters
     ----------
@@ -638,6 +635,8 @@ def profile_resources(
     monitoring_interval: int
         Monitoring interval in seconds
     """
+    import psutil
+
     start_time = time.time()
 
     while True:
@@ -652,8 +651,6 @@ def profile_resources(
         memory_info = psutil.virtual_memory()
         memory_usages.append(memory_info.percent)
 
-        time.sleep(monitoring_interval)
-
 
 def generate_resources_graphs(
     time_points: List,
@@ -693,6 +690,8 @@ def generate_resources_graphs(
     if not min_len:
         return
 
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(10, 6))
 
     plt.subplot(2, 1, 1)
@@ -759,12 +758,22 @@ def print_system_information(logger: logging.Logger):
     logger: logging.Logger
         Logger object
     """
-    co_memory = int(os.environ.get("CO_MEMORY"))
+    import psutil
+
+    available = resources.get_resources()
     # System info
     sep = "=" * 40
     logger.info(f"{sep} Code Ocean Information {sep}")
-    logger.info(f"Code Ocean assigned cores: {get_code_ocean_cpu_limit()}")
-    logger.info(f"Code Ocean assigned memory: {get_size(co_memory)}")
+    logger.info(
+        f"Code Ocean assigned cores: {available.cpus} "
+        f"(from {available.sources['cpus']})"
+    )
+    logger.info(
+        f"Code Ocean assigned memory: {get_size(available.memory_bytes)} "
+        f"(from {available.sources['memory_bytes']})"
+    )
+    logger.info(f"CPU affinity cores: {available.affinity_cpus}")
+    logger.info(f"NUMA nodes: {len(available.numa_nodes)}")
     logger.info(f"Computation ID: {os.environ.get('CO_COMPUTATION_ID')}")
     logger.info(f"Capsule ID: {os.environ.get('CO_CAPSULE_ID')}")
     logger.info(f"Is pipeline execution?: {bool(os.environ.get('AWS_BATCH_JOB_ID'))}")
@@ -0,0 +1,195 @@
+"""
+Pre-flight validation of the tile stores. Every tile is
+checked concurrently before stitching is launched, so
+missing or truncated tiles are reported at once instead
+of failing deep inside the registration.
+"""
+
+import asyncio
+import json
+import logging
+from time import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from . import s3_fetch
+
+logger = logging.getLogger(__name__)
+
+
+def get_last_chunk_key(zarray: Dict, level: int) -> str:
+    """
+    Key of the last chunk of a zarr array, which is the
+    last one written when a tile is uploaded in order.
+
+    Parameters
+    ----------
+    zarray: Dict
+        Zarr array metadata
+    level: int
+        Multiscale level of the array
+
+    Returns
+    -------
+    str
+        Key of the chunk relative to the tile
+    """
+    n_chunks = -(-np.array(zarray["shape"]) // np.array(zarray["chunks"]))
+    separator = zarray.get("dimension_separator", ".")
+    return f"{level}/" + separator.join(str(int(n - 1)) for n in n_chunks)
+
+
+async def validate_tile(
+    fetcher: s3_fetch.AsyncFetcher,
+    tile_path: str,
+    size: List[int],
+    level: int,
+) -> List[str]:
+    """
+    Checks that a tile store exists, that its full resolution
+    shape matches the tile size in the metadata and that the
+    requested multiscale level exists and is complete.
+
+    Parameters
+    ----------
+    fetcher: s3_fetch.AsyncFetcher
+        Fetcher of the tile objects
+    tile_path: str
+        Local or s3 path of the tile
+    size: List[int]
+        Tile size in XYZ order from the metadata
+    level: int
+        Multiscale level used for stitching
+
+    Returns
+    -------
+    List[str]
+        Problems found in the tile, empty if it is valid
+    """
+    backend = s3_fetch.get_backend(tile_path)
+    keys = [".zgroup", "0/.zarray", f"{level}/.zarray"]
+    try:
+        metadata = await fetcher.fetch_many(backend, keys)
+    except Exception as e:
+        return [f"could not be read: {e}"]
+
+    if ".zgroup" not in metadata:
+        return ["does not exist or is not a zarr group"]
+
+    errors = []
+    for key in keys[1:]:
+        if key not in metadata:
+            errors.append(f"is missing {key}")
+    if errors:
+        return errors
+
+    zarray = json.loads(metadata["0/.zarray"])
+    shape_xyz = [int(s) for s in zarray["shape"][-3:][::-1]]
+    if shape_xyz != [int(s) for s in size]:
+        errors.append(f"has shape {shape_xyz} (XYZ) but the metadata size is {size}")
+
+    level_zarray = json.loads(metadata[f"{level}/.zarray"])
+    last_chunk = get_last_chunk_key(level_zarray, level)
+    try:
+        if not await fetcher.exists(backend, last_chunk):
+            errors.append(f"is truncated, chunk {last_chunk} is missing")
+    except Exception as e:
+        errors.append(f"could not check chunk {last_chunk}: {e}")
+
+    return errors
+
+
+async def _validate_tiles(
+    fetcher: s3_fetch.AsyncFetcher,
+    path_to_data: str,
+    tile_metadata: List[Dict],
+    level: int,
+) -> Dict[str, List[str]]:
+    """
+    Validates every tile concurrently.
+    """
+    results = await asyncio.gather(
+        *(
+            validate_tile(fetcher, f"{path_to_data}/{t['file']}", t["size"], level)
+            for t in tile_metadata
+        )
+    )
+    return {
+        t["file"]: errors for t, errors in zip(tile_metadata, results) if len(errors)
+    }
+
+
+def validate_tiles(
+    path_to_data: str,
+    tile_metadata: List[Dict],
+    level: int = 0,
+    fetcher: Optional[s3_fetch.AsyncFetcher] = None,
+) -> Dict[str, List[str]]:
+    """
+    Validates the stores of every tile concurrently. The
+    number of requests in flight is bounded by the fetcher.
+
+    Parameters
+    ----------
+    path_to_data: str
+        Local or s3 path of the folder with the tiles
+    tile_metadata: List[Dict]
+        Tile metadata records
+    level: int
+        Multiscale level used for stitching. Default: 0
+    fetcher: Optional[s3_fetch.AsyncFetcher]
+        Fetcher of the tile objects. Default: None
+        (the process-wide fetcher)
+
+    Returns
+    -------
+    Dict[str, List[str]]
+        Problems found in each invalid tile
+    """
+    start_time = time()
+    fetcher = fetcher or s3_fetch.get_fetcher()
+    invalid_tiles = s3_fetch.get_event_loop_thread().run(
+        _validate_tiles(fetcher, str(path_to_data), tile_metadata, int(level))
+    )
+    logger.info(
+        f"Validated {len(tile_metadata)} tiles in {time() - start_time:.2f}s, "
+        f"{len(invalid_tiles)} invalid"
+    )
+    return invalid_tiles
+
+
+def check_tiles(
+    path_to_data: str,
+    tile_metadata: List[Dict],
+    level: int = 0,
+) -> None:
+    """
+    Validates the stores of every tile and raises an error
+    that lists every problem found.
+
+    Parameters
+    ----------
+    path_to_data: str
+        Local or s3 path of the folder with the tiles
+    tile_metadata: List[Dict]
+        Tile metadata records
+    level: int
+        Multiscale level used for stitching. Default: 0
+
+    Raises
+    ------
+    ValueError
+        If any tile is invalid
+    """
+    invalid_tiles = validate_tiles(path_to_data, tile_metadata, level)
+    if len(invalid_tiles):
+        report = "\n".join(
+            f"{tile}: {error}"
+            for tile, errors in sorted(invalid_tiles.items())
+            for error in errors
+        )
+        raise ValueError(
+            f"{len(invalid_tiles)} of {len(tile_metadata)} tiles in "
+            f"{path_to_data} are invalid:\n{report}"
+        )
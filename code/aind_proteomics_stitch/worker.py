@@ -0,0 +1,550 @@
+"""
+Long-lived stitching worker. Datasets are served one after
+the other by the same process, so the imports, the opened
+tile stores, the S3 client and the chunk cache stay warm
+across jobs instead of being paid by a new interpreter for
+every dataset.
+
+A job is a json object with the data folder of a dataset,
+its results folder, the overrides of pipeline.OVERRIDES and
+whether the registration is computed in process:
+    {"job_id": "...", "data_folder": "...", "results_folder": "...",
+     "overrides": {"channel": 488}, "registration": true}
+
+Jobs are read from a spool directory, where any number of
+workers can claim them, or from a local socket:
+    python -m aind_proteomics_stitch.worker serve --spool /scratch/spool
+    python -m aind_proteomics_stitch.worker submit --spool /scratch/spool \
+        --data_folder ../data --results_folder ../results --registration --wait
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, Optional, Tuple
+
+from . import pipeline
+from .utils import profiling, utils
+
+logger = logging.getLogger(__name__)
+
+# Job files move from incoming to running when a worker
+# claims them, and their result is written to done or failed
+SPOOL_DIRS = ("incoming", "running", "done", "failed")
+
+# Keys every job must have, as non-empty strings
+REQUIRED_KEYS = ("data_folder", "results_folder")
+
+# Set by SIGTERM or SIGINT. The job in progress is finished
+# before the worker stops
+_stop = threading.Event()
+
+
+def warm_up() -> None:
+    """
+    Imports the dependencies that the first job would
+    otherwise load.
+    """
+    with profiling.span("warm_up"):
+        from aind_data_schema.core.processing import DataProcess  # noqa: F401
+
+
+def get_job_id(job: Dict) -> str:
+    """
+    Identifier of a job, generated if the job has none.
+    """
+    if not job.get("job_id"):
+        job["job_id"] = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    return str(job["job_id"])
+
+
+def validate_job(job: Any) -> None:
+    """
+    Checks that a job can be run.
+
+    Parameters
+    ----------
+    job: Any
+        Job as decoded from json
+
+    Raises
+    ------
+    ValueError
+        If the job is not an object, its job_id is not a
+        plain file name, it misses one of the REQUIRED_KEYS
+        or its overrides are not an object
+    """
+    if not isinstance(job, dict):
+        raise ValueError(f"A job must be a json object, got {job!r}")
+
+    # The job_id names the job log and the spool files
+    job_id = str(job.get("job_id") or "")
+    if job_id and (Path(job_id).name != job_id or job_id == ".."):
+        raise ValueError(f"The job_id must be a plain file name, got {job_id!r}")
+
+    missing = [
+        key
+        for key in REQUIRED_KEYS
+        if not isinstance(job.get(key), str) or not job[key]
+    ]
+    if missing:
+        raise ValueError(f"The job misses {missing}")
+
+    if not isinstance(job.get("overrides") or {}, dict):
+        raise ValueError(
+            f"The overrides must be a json object, got {job['overrides']!r}"
+        )
+
+
+def run_job(job: Dict, default_job_id: Optional[str] = None) -> Dict:
+    """
+    Stitches a dataset in this process. Invalid jobs are
+    reported as failed instead of raising, so the worker
+    keeps serving.
+
+    Parameters
+    ----------
+    job: Dict
+        Job with the data_folder and results_folder of the
+        dataset, and optionally its job_id, overrides and
+        whether to compute the registration
+    default_job_id: Optional[str]
+        Identifier of the job if it is not an object.
+        Default: None (generated)
+
+    Returns
+    -------
+    Dict
+        Job id, status ("done" or "failed"), paths of the
+        outputs, wall time, timings of the stages and the
+        traceback of the error if the job failed
+    """
+    if isinstance(job, dict):
+        job_id = get_job_id(job)
+    else:
+        job_id = get_job_id({"job_id": default_job_id})
+
+    recorder = profiling.get_recorder()
+    recorder.reset()
+
+    outputs = {}
+    error = None
+    handler = None
+    start = perf_counter()
+    try:
+        validate_job(job)
+        results_folder = Path(job["results_folder"])
+        metadata_folder = results_folder.joinpath("metadata")
+        utils.create_folder(str(metadata_folder))
+
+        # Log of the job next to its outputs
+        handler = logging.FileHandler(metadata_folder.joinpath(f"worker_{job_id}.log"))
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+        )
+        logging.getLogger().addHandler(handler)
+
+        logger.info(f"Starting job {job_id}: {job}")
+        with profiling.span("stitch_dataset"):
+            params_json = pipeline.stitch_dataset(
+                data_folder=job["data_folder"],
+                results_folder=results_folder,
+                overrides=job.get("overrides"),
+            )
+        outputs["params_json"] = str(params_json)
+
+        if job.get("registration", False):
+            with profiling.span("register_dataset"):
+                outputs.update(
+                    pipeline.register_dataset(params_json, str(results_folder))
+                )
+
+    except Exception:
+        error = traceback.format_exc()
+        logger.error(f"Job {job_id} failed: {error}")
+
+    finally:
+        seconds = perf_counter() - start
+        logger.info(f"Job {job_id} took {seconds:.2f}s: {recorder.format()}")
+        if handler is not None:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+
+    return {
+        "job_id": job_id,
+        "status": "failed" if error else "done",
+        "outputs": outputs,
+        "seconds": seconds,
+        "timings": recorder.summary(),
+        "error": error,
+    }
+
+
+def write_json_atomic(path: str, data: Dict) -> None:
+    """
+    Writes a json through a temporary file in the same
+    folder, so readers never see it partially written.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def create_spool(spool_dir: str) -> None:
+    """
+    Creates the folders of a spool directory.
+    """
+    for name in SPOOL_DIRS:
+        os.makedirs(os.path.join(spool_dir, name), exist_ok=True)
+
+
+def claim_next_job(spool_dir: str) -> Optional[Tuple[str, Dict]]:
+    """
+    Claims the oldest job of a spool directory by moving it
+    to the running folder. The rename is atomic, so a job is
+    claimed by a single worker.
+
+    Returns
+    -------
+    Optional[Tuple[str, Dict]]
+        Path of the claimed job file and the job, or None if
+        there are no jobs. The job is None if the file is not
+        valid json
+    """
+    incoming = os.path.join(spool_dir, "incoming")
+    for name in sorted(os.listdir(incoming)):
+        if not name.endswith(".json"):
+            continue
+
+        running_path = os.path.join(spool_dir, "running", name)
+        try:
+            os.rename(os.path.join(incoming, name), running_path)
+        except FileNotFoundError:
+            # Claimed by another worker
+            continue
+
+        try:
+            with open(running_path, "r") as f:
+                job = json.load(f)
+        except ValueError as e:
+            # Recorded as a failed job by run_job
+            logger.error(f"Invalid job file {name}: {e}")
+            job = None
+
+        if isinstance(job, dict):
+            job.setdefault("job_id", name[: -len(".json")])
+        return running_path, job
+
+    return None
+
+
+def serve_spool(
+    spool_dir: str,
+    poll_interval: float = 1.0,
+    max_jobs: Optional[int] = None,
+    idle_timeout: Optional[float] = None,
+) -> int:
+    """
+    Runs the jobs of a spool directory until the worker is
+    stopped.
+
+    Parameters
+    ----------
+    spool_dir: str
+        Spool directory
+    poll_interval: float
+        Seconds between checks for new jobs. Default: 1.0
+    max_jobs: Optional[int]
+        Number of jobs after which the worker stops.
+        Default: None
+    idle_timeout: Optional[float]
+        Seconds without jobs after which the worker stops.
+        Default: None
+
+    Returns
+    -------
+    int
+        Number of jobs run
+    """
+    create_spool(spool_dir)
+    n_jobs = 0
+    idle_since = time.monotonic()
+
+    while not _stop.is_set() and (max_jobs is None or n_jobs < max_jobs):
+        claimed = claim_next_job(spool_dir)
+        if claimed is None:
+            if (
+                idle_timeout is not None
+                and time.monotonic() - idle_since > idle_timeout
+            ):
+                logger.info(f"No jobs for {idle_timeout}s, stopping")
+                break
+            _stop.wait(poll_interval)
+            continue
+
+        running_path, job = claimed
+        result = run_job(job, Path(running_path).stem)
+
+        # Results are named after the claimed file, which is a
+        # plain file name whatever the job_id is
+        name = os.path.basename(running_path)
+        try:
+            write_json_atomic(
+                os.path.join(spool_dir, result["status"], name),
+                {"job": job, **result},
+            )
+            os.remove(running_path)
+        except OSError as e:
+            logger.error(f"Could not write the result of {name}: {e}")
+            os.replace(running_path, os.path.join(spool_dir, "failed", name))
+
+        n_jobs += 1
+        idle_since = time.monotonic()
+
+    return n_jobs
+
+
+def submit_spool(spool_dir: str, job: Dict) -> str:
+    """
+    Adds a job to a spool directory.
+
+    Returns
+    -------
+    str
+        Job id
+
+    Raises
+    ------
+    ValueError
+        If the job is not valid, see validate_job
+    """
+    create_spool(spool_dir)
+    job_id = get_job_id(job)
+    validate_job(job)
+    write_json_atomic(os.path.join(spool_dir, "incoming", f"{job_id}.json"), job)
+    return job_id
+
+
+def wait_spool_result(
+    spool_dir: str,
+    job_id: str,
+    poll_interval: float = 1.0,
+    timeout: Optional[float] = None,
+) -> Optional[Dict]:
+    """
+    Waits for the result of a spool job.
+
+    Returns
+    -------
+    Optional[Dict]
+        Result written by the worker, or None if the
+        timeout expired
+    """
+    start = time.monotonic()
+    while timeout is None or time.monotonic() - start < timeout:
+        for status in ("done", "failed"):
+            path = os.path.join(spool_dir, status, f"{job_id}.json")
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    return json.load(f)
+        time.sleep(poll_interval)
+    return None
+
+
+def read_message(connection: socket.socket) -> Dict:
+    """
+    Reads a json message terminated by a newline.
+    """
+    with connection.makefile("r") as f:
+        return json.loads(f.readline())
+
+
+def send_message(connection: socket.socket, message: Dict) -> None:
+    """
+    Sends a json message terminated by a newline.
+    """
+    connection.sendall((json.dumps(message) + "\n").encode())
+
+
+def reply(connection: socket.socket, message: Dict) -> None:
+    """
+    Sends a message to a client. A client that disconnected
+    is logged instead of stopping the worker.
+    """
+    try:
+        send_message(connection, message)
+    except OSError as e:
+        logger.warning(f"Could not reply to the client: {e}")
+
+
+def serve_socket(socket_path: str, max_jobs: Optional[int] = None) -> int:
+    """
+    Runs the jobs received on a unix socket until the
+    worker is stopped or receives {"command": "shutdown"}.
+    Every connection sends one job and receives its result.
+
+    Parameters
+    ----------
+    socket_path: str
+        Path of the socket
+    max_jobs: Optional[int]
+        Number of jobs after which the worker stops.
+        Default: None
+
+    Returns
+    -------
+    int
+        Number of jobs run
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    # Wakes up to check whether the worker was stopped
+    server.settimeout(1.0)
+
+    n_jobs = 0
+    try:
+        while not _stop.is_set() and (max_jobs is None or n_jobs < max_jobs):
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                continue
+
+            with connection:
+                connection.settimeout(None)
+                try:
+                    job = read_message(connection)
+                except (OSError, ValueError) as e:
+                    reply(connection, {"status": "failed", "error": str(e)})
+                    continue
+
+                if isinstance(job, dict) and job.get("command") == "shutdown":
+                    reply(connection, {"status": "stopped", "jobs": n_jobs})
+                    break
+
+                result = run_job(job)
+                n_jobs += 1
+                reply(connection, result)
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+    return n_jobs
+
+
+def submit_socket(socket_path: str, job: Dict) -> Dict:
+    """
+    Sends a job to a worker listening on a unix socket and
+    waits for its result.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        send_message(connection, job)
+        return read_message(connection)
+
+
+def serve(
+    spool_dir: Optional[str] = None,
+    socket_path: Optional[str] = None,
+    **kwargs,
+) -> int:
+    """
+    Warms up the worker and serves jobs from a spool
+    directory or a unix socket until SIGTERM or SIGINT.
+    """
+    if (spool_dir is None) == (socket_path is None):
+        raise ValueError("Provide either a spool directory or a socket path")
+
+    def handle_signal(signum, frame):
+        logger.info(f"Received signal {signum}, stopping after the current job")
+        _stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    warm_up()
+    if spool_dir is not None:
+        n_jobs = serve_spool(spool_dir, **kwargs)
+    else:
+        n_jobs = serve_socket(socket_path, **kwargs)
+
+    logger.info(f"Worker stopped after {n_jobs} jobs")
+    return n_jobs
+
+
+def parse_overrides(values) -> Dict:
+    """
+    Parses key=value overrides, with json values when
+    they can be decoded.
+    """
+    overrides = {}
+    for value in values or []:
+        key, _, raw = value.partition("=")
+        try:
+            overrides[key] = json.loads(raw)
+        except json.JSONDecodeError:
+            overrides[key] = raw
+    return overrides
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", type=str, choices=["serve", "submit"])
+    parser.add_argument("--spool", type=str, default=None)
+    parser.add_argument("--socket", type=str, default=None)
+    parser.add_argument("--poll_interval", type=float, default=1.0)
+    parser.add_argument("--max_jobs", type=int, default=None)
+    parser.add_argument("--idle_timeout", type=float, default=None)
+    parser.add_argument("--job_id", type=str, default=None)
+    parser.add_argument("--data_folder", type=str, default="../data")
+    parser.add_argument("--results_folder", type=str, default="../results")
+    parser.add_argument("--set", type=str, nargs="*", default=None)
+    parser.add_argument("--registration", action="store_true")
+    parser.add_argument("--wait", action="store_true")
+    parser.add_argument("--log_level", type=str, default="INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    if args.command == "serve":
+        kwargs = {"max_jobs": args.max_jobs}
+        if args.spool is not None:
+            kwargs.update(
+                poll_interval=args.poll_interval, idle_timeout=args.idle_timeout
+            )
+        serve(spool_dir=args.spool, socket_path=args.socket, **kwargs)
+        sys.exit(0)
+
+    job = {
+        "job_id": args.job_id,
+        "data_folder": os.path.abspath(args.data_folder),
+        "results_folder": os.path.abspath(args.results_folder),
+        "overrides": parse_overrides(args.set),
+        "registration": args.registration,
+    }
+    if args.socket is not None:
+        result = submit_socket(args.socket, job)
+    else:
+        job_id = submit_spool(args.spool, job)
+        if not args.wait:
+            print(job_id)
+            sys.exit(0)
+        result = wait_spool_result(args.spool, job_id, args.poll_interval)
+
+    print(json.dumps(result, indent=4))
+    sys.exit(0 if result and result["status"] == "done" else 1)
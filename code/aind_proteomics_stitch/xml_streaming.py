@@ -0,0 +1,598 @@
+"""
+Streaming writer for BigStitcher XMLs. The output is
+byte-identical to building the tree with
+bigstitcher_utilities.parse_json and writing it with
+bigstitcher_utilities.write_xml, without keeping the
+ElementTree in memory.
+
+Registrations of an existing XML can be updated in
+place, rewriting only its ViewRegistrations section.
+"""
+
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+from typing import (BinaryIO, Dict, Iterable, Iterator, List, Optional,
+                    Sequence, Tuple)
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from . import bigstitcher_utilities
+
+# Tile name, size (XYZ), channel number and translation (XYZ)
+Tile = Tuple[str, List[int], int, List[float]]
+
+ATTRIBUTE_ENTITIES = {'"': "&quot;", "\r": "&#13;", "\n": "&#10;", "\t": "&#09;"}
+
+# Spooled sections stay in memory up to this size
+SPOOL_MAX_BYTES = 16 * 1024**2
+
+# Bytes read at a time when scanning or copying an XML
+READ_CHUNK_BYTES = 1024**2
+
+# Tiles of a TileTable converted to Python objects at a time
+TABLE_BLOCK_TILES = 4096
+
+# Per-tile blocks as serialized by write_xml with tab indentation
+ZGROUP_TEMPLATE = (
+    '\t\t\t\t<zgroup setup="{i}" timepoint="0">\n'
+    "\t\t\t\t\t<path>{name}</path>\n"
+    "\t\t\t\t</zgroup>\n"
+)
+VIEW_SETUP_TEMPLATE = (
+    "\t\t\t<ViewSetup>\n"
+    "\t\t\t\t<id>{i}</id>\n"
+    "\t\t\t\t<name>{name}</name>\n"
+    "\t\t\t\t<size>{size}</size>\n"
+    "\t\t\t\t<voxelSize>\n"
+    "\t\t\t\t\t<unit>µm</unit>\n"
+    "\t\t\t\t\t<size>{voxel_size}</size>\n"
+    "\t\t\t\t</voxelSize>\n"
+    "\t\t\t\t<attributes>\n"
+    "\t\t\t\t\t<illumination>0</illumination>\n"
+    "\t\t\t\t\t<channel>{channel}</channel>\n"
+    "\t\t\t\t\t<tile>{tile_count}</tile>\n"
+    "\t\t\t\t\t<angle>0</angle>\n"
+    "\t\t\t\t</attributes>\n"
+    "\t\t\t</ViewSetup>\n"
+)
+TILE_TEMPLATE = (
+    "\t\t\t\t<Tile>\n"
+    "\t\t\t\t\t<id>{i}</id>\n"
+    "\t\t\t\t\t<name>{name}</name>\n"
+    "\t\t\t\t</Tile>\n"
+)
+VIEW_REGISTRATION_TEMPLATE = (
+    '\t\t<ViewRegistration timepoint="0" setup="{i}">\n'
+    '\t\t\t<ViewTransform type="affine">\n'
+    "\t\t\t\t<Name>Translation to Nominal Grid</Name>\n"
+    "\t\t\t\t<affine>{affine}</affine>\n"
+    "\t\t\t</ViewTransform>\n"
+    "\t\t</ViewRegistration>\n"
+)
+
+
+def iter_table_tiles(table: bigstitcher_utilities.TileTable) -> Iterator[Tile]:
+    """
+    Yields the tiles of a tile table in its order.
+
+    Parameters
+    ----------
+    table: bigstitcher_utilities.TileTable
+        Tile table
+
+    Yields
+    ------
+    Tile
+        Tile name, size, channel number and translation
+    """
+    # Columns are converted a block at a time to keep
+    # the Python objects of the whole table out of memory
+    for start in range(0, len(table), TABLE_BLOCK_TILES):
+        block = table[start : start + TABLE_BLOCK_TILES]
+        yield from zip(
+            block.tile_names(),
+            block.sizes.tolist(),
+            block.channels.tolist(),
+            block.positions.tolist(),
+        )
+
+
+def iter_json_tiles(json_dict: List[Dict]) -> Iterator[Tile]:
+    """
+    Yields the tiles of the tile metadata records in the
+    order used by bigstitcher_utilities.parse_json.
+
+    Parameters
+    ----------
+    json_dict: List[Dict]
+        Tile metadata records
+
+    Yields
+    ------
+    Tile
+        Tile name, size, channel number and translation
+    """
+    table = bigstitcher_utilities.TileTable.from_records(json_dict)
+    yield from iter_table_tiles(table.sorted())
+
+
+def _element(
+    level: int,
+    tag: str,
+    text: Optional[str] = None,
+    attrib: Optional[Dict[str, str]] = None,
+) -> bytes:
+    """
+    Serializes a leaf element on its own indented line.
+    """
+    attributes = "".join(
+        f' {key}="{escape(str(value), ATTRIBUTE_ENTITIES)}"'
+        for key, value in (attrib or {}).items()
+    )
+    if text:
+        line = f"{level * chr(9)}<{tag}{attributes}>{escape(text)}</{tag}>\n"
+    else:
+        line = f"{level * chr(9)}<{tag}{attributes} />\n"
+    return line.encode("utf-8")
+
+
+def _open(level: int, tag: str, attrib: Optional[Dict[str, str]] = None) -> bytes:
+    """
+    Serializes the opening tag of an element with children.
+    """
+    attributes = "".join(
+        f' {key}="{escape(str(value), ATTRIBUTE_ENTITIES)}"'
+        for key, value in (attrib or {}).items()
+    )
+    return f"{level * chr(9)}<{tag}{attributes}>\n".encode("utf-8")
+
+
+def _close(level: int, tag: str) -> bytes:
+    """
+    Serializes the closing tag of an element with children.
+    """
+    return f"{level * chr(9)}</{tag}>\n".encode("utf-8")
+
+
+def _write_container(
+    f: BinaryIO,
+    level: int,
+    tag: str,
+    body: BinaryIO,
+    attrib: Optional[Dict[str, str]] = None,
+) -> None:
+    """
+    Writes an element whose children were spooled to a file.
+    """
+    if body.tell():
+        f.write(_open(level, tag, attrib))
+        body.seek(0)
+        shutil.copyfileobj(body, f)
+        f.write(_close(level, tag))
+    else:
+        f.write(_element(level, tag, attrib=attrib))
+
+
+def write_xml_streaming(
+    path: str,
+    tiles: Iterable[Tile],
+    tile_resolution: List[float],
+    s3_data_path: str,
+    data_path_type: str = "absolute",
+) -> int:
+    """
+    Writes a BigStitcher XML from an iterator of tiles in a single
+    pass. The zgroups, ViewSetups, tile attributes and
+    ViewRegistrations of each tile are spooled to temporary files
+    and copied to the output in document order at the end.
+
+    Parameters
+    ----------
+    path: str
+        Path to the output XML file
+    tiles: Iterable[Tile]
+        Tile name, size (XYZ), channel number and translation
+        (XYZ) of each tile, in setup order
+    tile_resolution: List[float]
+        Resolution of the tiles in microns
+    s3_data_path: str
+        Path to the S3 bucket or local directory where the data is stored
+    data_path_type: str
+        Type of the data path, absolute or relative. Default: "absolute"
+
+    Returns
+    -------
+    int
+        Number of tiles written
+    """
+    channels = set()
+    n_tiles = 0
+
+    with open(path, "wb") as f, tempfile.SpooledTemporaryFile(
+        SPOOL_MAX_BYTES
+    ) as view_setups, tempfile.SpooledTemporaryFile(
+        SPOOL_MAX_BYTES
+    ) as tile_attributes, tempfile.SpooledTemporaryFile(
+        SPOOL_MAX_BYTES
+    ) as view_registrations, tempfile.SpooledTemporaryFile(
+        SPOOL_MAX_BYTES
+    ) as zgroups:
+        f.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+        f.write(_open(0, "SpimData", {"version": "0.2"}))
+        f.write(_element(1, "BasePath", ".", {"type": "relative"}))
+        f.write(_open(1, "SequenceDescription"))
+        f.write(
+            _open(2, "ImageLoader", {"format": "bdv.multimg.zarr", "version": "1.0"})
+        )
+        f.write(_element(3, "zarr", s3_data_path, {"type": data_path_type}))
+
+        voxel_size = escape(
+            f"{tile_resolution[0]} {tile_resolution[1]} {tile_resolution[2]}"
+        )
+        for i, (tile, t_size, channel, tr) in enumerate(tiles):
+            name = escape(str(tile))
+            zgroups.write(ZGROUP_TEMPLATE.format(i=i, name=name).encode("utf-8"))
+            view_setups.write(
+                VIEW_SETUP_TEMPLATE.format(
+                    i=i,
+                    name=name,
+                    size=escape(f"{t_size[0]} {t_size[1]} {t_size[2]}"),
+                    voxel_size=voxel_size,
+                    channel=escape(f"{channel}"),
+                    tile_count=i + 1,
+                ).encode("utf-8")
+            )
+            tile_attributes.write(TILE_TEMPLATE.format(i=i, name=name).encode("utf-8"))
+            view_registrations.write(
+                VIEW_REGISTRATION_TEMPLATE.format(
+                    i=i,
+                    affine=f"1.0 0.0 0.0 {str(float(tr[0]))} "
+                    + f"0.0 1.0 0.0 {str(float(tr[1]))} "
+                    + f"0.0 0.0 1.0 {str(float(tr[2]))}",
+                ).encode("utf-8")
+            )
+
+            channels.add(channel)
+            n_tiles += 1
+
+        _write_container(f, 3, "zgroups", zgroups)
+        f.write(_close(2, "ImageLoader"))
+
+        f.write(_open(2, "ViewSetups"))
+        view_setups.seek(0)
+        shutil.copyfileobj(view_setups, f)
+
+        f.write(_open(3, "Attributes", {"name": "illumination"}))
+        f.write(_open(4, "Illumination"))
+        f.write(_element(5, "id", "0"))
+        f.write(_element(5, "name", "0"))
+        f.write(_close(4, "Illumination"))
+        f.write(_close(3, "Attributes"))
+
+        channel_attributes = tempfile.SpooledTemporaryFile(SPOOL_MAX_BYTES)
+        for channel in channels:
+            channel_attributes.write(_open(4, "Channel"))
+            channel_attributes.write(_element(5, "id", f"{channel}"))
+            channel_attributes.write(_element(5, "name", f"{channel}"))
+            channel_attributes.write(_close(4, "Channel"))
+        _write_container(f, 3, "Attributes", channel_attributes, {"name": "channel"})
+        channel_attributes.close()
+
+        _write_container(f, 3, "Attributes", tile_attributes, {"name": "tile"})
+
+        f.write(_open(3, "Attributes", {"name": "angle"}))
+        f.write(_open(4, "Angle"))
+        f.write(_element(5, "id", "0"))
+        f.write(_element(5, "name", "0"))
+        f.write(_close(4, "Angle"))
+        f.write(_close(3, "Attributes"))
+        f.write(_close(2, "ViewSetups"))
+
+        f.write(_open(2, "Timepoints", {"type": "pattern"}))
+        f.write(_element(3, "integerpattern", "0"))
+        f.write(_close(2, "Timepoints"))
+        f.write(_element(2, "MissingViews"))
+        f.write(_close(1, "SequenceDescription"))
+
+        _write_container(f, 1, "ViewRegistrations", view_registrations)
+        f.write(b"</SpimData>")
+
+    return n_tiles
+
+
+def write_table_xml_streaming(
+    table: bigstitcher_utilities.TileTable,
+    path: str,
+    s3_data_path: str,
+    data_path_type: str = "absolute",
+) -> int:
+    """
+    Writes the BigStitcher XML of a tile table, with the
+    tiles sorted by file as in bigstitcher_utilities.parse_json.
+
+    Parameters
+    ----------
+    table: bigstitcher_utilities.TileTable
+        Tile table
+    path: str
+        Path to the output XML file
+    s3_data_path: str
+        Path to the S3 bucket or local directory where the data is stored
+    data_path_type: str
+        Type of the data path, absolute or relative. Default: "absolute"
+
+    Returns
+    -------
+    int
+        Number of tiles written
+    """
+    return write_xml_streaming(
+        path=path,
+        tiles=iter_table_tiles(table.sorted()),
+        tile_resolution=table.resolution,
+        s3_data_path=s3_data_path,
+        data_path_type=data_path_type,
+    )
+
+
+def write_json_xml_streaming(
+    json_dict: List[Dict],
+    path: str,
+    s3_data_path: str,
+    data_path_type: str = "absolute",
+    microns: bool = False,
+) -> int:
+    """
+    Streaming equivalent of writing the tree returned by
+    bigstitcher_utilities.parse_json with write_xml.
+
+    Parameters
+    ----------
+    json_dict: List[Dict]
+        Tile metadata records
+    path: str
+        Path to the output XML file
+    s3_data_path: str
+        Path to the S3 bucket or local directory where the data is stored
+    data_path_type: str
+        Type of the data path, absolute or relative. Default: "absolute"
+    microns: bool
+        Whether the pixel resolution is already in microns. Default: False
+
+    Returns
+    -------
+    int
+        Number of tiles written
+    """
+    return write_table_xml_streaming(
+        table=bigstitcher_utilities.TileTable.from_records(json_dict, microns=microns),
+        path=path,
+        s3_data_path=s3_data_path,
+        data_path_type=data_path_type,
+    )
+
+
+def _find_bytes(f: BinaryIO, pattern: bytes, start: int = 0) -> int:
+    """
+    Offset of the first occurrence of a pattern at or
+    after start, reading the file in chunks. -1 if the
+    pattern is not found.
+    """
+    f.seek(start)
+    position = start
+    overlap = b""
+    while True:
+        chunk = f.read(READ_CHUNK_BYTES)
+        if not chunk:
+            return -1
+
+        data = overlap + chunk
+        index = data.find(pattern)
+        if index >= 0:
+            return position - len(overlap) + index
+
+        overlap = data[-(len(pattern) - 1) :]
+        position += len(chunk)
+
+
+def _iter_bytes(source: BinaryIO, start: int, end: int) -> Iterator[bytes]:
+    """
+    Yields the bytes [start, end) of a file in chunks.
+    """
+    source.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = source.read(min(READ_CHUNK_BYTES, remaining))
+        if not chunk:
+            break
+        yield chunk
+        remaining -= len(chunk)
+
+
+def _copy_bytes(source: BinaryIO, target: BinaryIO, start: int, end: int) -> None:
+    """
+    Copies the bytes [start, end) of a file.
+    """
+    for chunk in _iter_bytes(source, start, end):
+        target.write(chunk)
+
+
+def _affine_text(affine: np.ndarray) -> str:
+    """
+    Text of a BigStitcher affine element from a (3, 4) matrix.
+    """
+    return " ".join(str(float(value)) for value in np.ravel(affine))
+
+
+def _update_view_registration(
+    vr: ET.Element, affine_text: str, name: str, mode: str
+) -> None:
+    """
+    Adds the ViewTransform of a setup to its ViewRegistration.
+    """
+    vt = ET.Element("ViewTransform")
+    vt.attrib["type"] = "affine"
+    x = ET.SubElement(vt, "Name")
+    x.text = name
+    x = ET.SubElement(vt, "affine")
+    x.text = affine_text
+
+    if mode == "replace":
+        for previous in vr.findall("ViewTransform"):
+            if previous.findtext("Name") == name:
+                index = list(vr).index(previous)
+                vr.remove(previous)
+                vr.insert(index, vt)
+                return
+
+    vr.insert(0, vt)
+
+
+def update_view_registrations(
+    xml_path: str,
+    affines: np.ndarray,
+    output_path: Optional[str] = None,
+    setup_ids: Optional[Sequence[int]] = None,
+    name: str = "Stitching Transform",
+    mode: str = "append",
+) -> int:
+    """
+    Adds an affine ViewTransform to the ViewRegistrations of an
+    existing BigStitcher XML. The file is streamed: the bytes
+    before and after the ViewRegistrations section are copied
+    unchanged and only that section is parsed and rewritten,
+    one ViewRegistration at a time.
+
+    Following BigStitcher, where the first transform is the last
+    one applied, new transforms are inserted first.
+
+    Parameters
+    ----------
+    xml_path: str
+        Path to the BigStitcher XML
+    affines: np.ndarray
+        Affine transformations (n, 3, 4) in microns (XYZ)
+    output_path: Optional[str]
+        Path of the updated XML. Default: None (the input
+        XML is replaced)
+    setup_ids: Optional[Sequence[int]]
+        Setup id of each affine. Setups that are not listed
+        are left unchanged. Default: None (affine i belongs
+        to setup i)
+    name: str
+        Name of the new transforms. Default: "Stitching Transform"
+    mode: str
+        "append" adds the transform to the existing ones,
+        "replace" overwrites the transform with the same name
+        if a setup has one and adds it otherwise.
+        Default: "append"
+
+    Returns
+    -------
+    int
+        Number of ViewRegistrations updated
+    """
+    if mode not in ("append", "replace"):
+        raise ValueError(f"Unknown mode {mode}, expected append or replace")
+
+    affines = np.asarray(affines, dtype=np.float64).reshape(-1, 3, 4)
+    if setup_ids is None:
+        setup_ids = range(len(affines))
+    if len(setup_ids) != len(affines):
+        raise ValueError(f"Got {len(affines)} affines for {len(setup_ids)} setup ids")
+    affine_texts = {
+        int(setup_id): _affine_text(affine)
+        for setup_id, affine in zip(setup_ids, affines)
+    }
+
+    if output_path is None:
+        output_path = xml_path
+
+    n_updated = 0
+    n_written = 0
+    output_folder = os.path.dirname(os.path.abspath(output_path))
+    with open(xml_path, "rb") as source, tempfile.NamedTemporaryFile(
+        dir=output_folder, suffix=".xml", delete=False
+    ) as target:
+        try:
+            section_start = _find_bytes(source, b"<ViewRegistrations")
+            if section_start < 0:
+                raise ValueError(f"No ViewRegistrations in {xml_path}")
+
+            tag_end = _find_bytes(source, b">", section_start)
+            source.seek(tag_end - 1)
+            if source.read(1) == b"/":
+                section_end = tag_end + 1
+            else:
+                section_end = _find_bytes(
+                    source, b"</ViewRegistrations>", section_start
+                )
+                if section_end < 0:
+                    raise ValueError(f"Unclosed ViewRegistrations in {xml_path}")
+                section_end += len(b"</ViewRegistrations>")
+
+            # Indentation of the section, taken from its opening line
+            line_start = max(0, section_start - READ_CHUNK_BYTES)
+            source.seek(line_start)
+            before = source.read(section_start - line_start)
+            indent = before[before.rfind(b"\n") + 1 :].decode("utf-8")
+            level = indent.count("\t") + 1
+
+            _copy_bytes(source, target, 0, section_start)
+
+            parser = ET.XMLPullParser(events=("start", "end"))
+            section = None
+            depth = 0
+            for chunk in _iter_bytes(source, section_start, section_end):
+                parser.feed(chunk)
+                for event, element in parser.read_events():
+                    if event == "start":
+                        depth += 1
+                        if depth == 1:
+                            section = element
+                        continue
+
+                    depth -= 1
+                    if depth != 1 or element.tag != "ViewRegistration":
+                        continue
+
+                    affine_text = affine_texts.get(int(element.attrib["setup"]))
+                    if affine_text is not None:
+                        _update_view_registration(element, affine_text, name, mode)
+                        n_updated += 1
+
+                    if not n_written:
+                        target.write(_open(0, "ViewRegistrations", section.attrib))
+                    n_written += 1
+
+                    ET.indent(element, space="\t", level=level)
+                    element.tail = None
+                    target.write(
+                        (
+                            level * "\t"
+                            + ET.tostring(element, encoding="unicode")
+                            + "\n"
+                        ).encode("utf-8")
+                    )
+                    section.remove(element)
+            parser.close()
+
+            if n_written:
+                target.write(f"{indent}</ViewRegistrations>".encode("utf-8"))
+            else:
+                target.write(
+                    _element(0, "ViewRegistrations", attrib=section.attrib)[:-1]
+                )
+            source.seek(0, os.SEEK_END)
+            _copy_bytes(source, target, section_end, source.tell())
+        except BaseException:
+            target.close()
+            os.remove(target.name)
+            raise
+
+    shutil.copymode(xml_path, target.name)
+    os.replace(target.name, output_path)
+    return n_updated
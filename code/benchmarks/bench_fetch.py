@@ -0,0 +1,93 @@
+"""
+Benchmarks reading a zarr tile through the asynchronous
+fetch layer against serial per-chunk reads, using the local
+backend with a simulated per-request latency.
+
+Run from the code folder:
+    python -m benchmarks.bench_fetch --latency 0.02 --concurrency 64
+"""
+
+import argparse
+import tempfile
+from time import perf_counter
+from typing import Dict
+
+import numpy as np
+import zarr
+
+from aind_proteomics_stitch import s3_fetch
+
+
+class SerialStore(zarr.storage.BaseStore):
+    """
+    Read-only store that reads one chunk at a time.
+    """
+
+    def __init__(self, backend: s3_fetch.LocalBackend):
+        self.backend = backend
+
+    def __getitem__(self, key: str) -> bytes:
+        value = self.backend.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.backend.exists(key)
+
+    def __iter__(self):
+        return iter(self.backend.list())
+
+    def __len__(self) -> int:
+        return len(self.backend.list())
+
+    def __setitem__(self, key: str, value: bytes) -> None:
+        raise PermissionError("SerialStore is read-only")
+
+    def __delitem__(self, key: str) -> None:
+        raise PermissionError("SerialStore is read-only")
+
+
+def run(folder: str, latency: float, concurrency: int) -> Dict[str, float]:
+    """
+    Writes a chunked array and reads it back with both stores.
+    """
+    data = np.random.default_rng(0).integers(0, 1000, (64, 512, 512), dtype=np.uint16)
+    zarr.open_array(
+        f"{folder}/tile.zarr",
+        mode="w",
+        shape=data.shape,
+        chunks=(32, 64, 64),
+        dtype=data.dtype,
+    )[:] = data
+
+    backend = s3_fetch.LocalBackend(f"{folder}/tile.zarr", latency=latency)
+    fetcher = s3_fetch.AsyncFetcher(max_concurrency=concurrency)
+
+    start = perf_counter()
+    serial = zarr.open_array(SerialStore(backend), mode="r")[:]
+    serial_seconds = perf_counter() - start
+
+    start = perf_counter()
+    fetched = zarr.open_array(s3_fetch.FetchStore(backend, fetcher), mode="r")[:]
+    async_seconds = perf_counter() - start
+
+    assert np.array_equal(serial, data) and np.array_equal(fetched, data)
+    return {"serial": serial_seconds, "async": async_seconds, **fetcher.stats()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        result = run(folder, args.latency, args.concurrency)
+
+    print(
+        f"latency {args.latency * 1000:.0f} ms | "
+        f"serial {result['serial']:.2f}s | "
+        f"async {result['async']:.2f}s ({args.concurrency} in flight) | "
+        f"{result['requests']} requests"
+    )
@@ -0,0 +1,222 @@
+"""
+Benchmarks the import time of the modules loaded when the
+capsule starts with python -X importtime in a fresh
+interpreter. The run fails if any of them imports one of
+the heavy dependencies that are only needed by a few
+functions, or if its import time regressed beyond a
+threshold against a stored baseline.
+
+Run from the code folder:
+    python -m benchmarks.bench_imports
+    python -m benchmarks.bench_imports --save_baseline
+
+The baseline is stored in benchmarks/baselines/imports.json.
+Import times depend on the machine, so save a new baseline
+before comparing on another one. --require_baseline makes a
+missing baseline a failure.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+CODE_FOLDER = str(Path(__file__).parent.parent)
+DEFAULT_BASELINE = str(Path(__file__).parent.joinpath("baselines", "imports.json"))
+
+MODULES = [
+    "aind_proteomics_stitch.utils.utils",
+    "aind_proteomics_stitch.bigstitcher",
+    "run_capsule",
+]
+
+# Loaded on demand by the functions that use them
+LAZY_MODULES = ["matplotlib", "aind_data_schema", "psutil"]
+
+
+def import_time(module: str, repeat: int = 5) -> Dict[str, float]:
+    """
+    Imports a module in fresh interpreters.
+
+    Parameters
+    ----------
+    module: str
+        Module to import
+    repeat: int
+        Number of interpreters. The fastest one is kept,
+        since the rest measure disk caches and scheduling.
+        Default: 5
+
+    Returns
+    -------
+    Dict[str, float]
+        Cumulative import time in seconds of every module
+        loaded by the import. The entry of the module is the
+        total, including its parent packages
+    """
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=CODE_FOLDER,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # Modules are listed after their dependencies, and the
+        # ones loaded by the interpreter startup end with site
+        times = {}
+        total = 0.0
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:") :].split("|")
+            seconds = int(cumulative) / 1e6
+            if name.strip() == "site" and not name.startswith("  "):
+                times, total = {}, 0.0
+                continue
+            times[name.strip()] = seconds
+            if not name[1:].startswith(" "):
+                total += seconds
+        times[module] = total
+        if best is None or total < best[module]:
+            best = times
+    return best
+
+
+def run(modules: List[str], repeat: int = 5) -> Dict[str, Dict]:
+    """
+    Measures the import time of every module.
+
+    Returns
+    -------
+    Dict[str, Dict]
+        Import time in seconds, the lazy modules that
+        were loaded and the slowest dependencies of each
+        module
+    """
+    results = {}
+    for module in modules:
+        times = import_time(module, repeat)
+        loaded = sorted(
+            lazy
+            for lazy in LAZY_MODULES
+            if any(name == lazy or name.startswith(f"{lazy}.") for name in times)
+        )
+        slowest = sorted(
+            ((name, t) for name, t in times.items() if name != module),
+            key=lambda item: -item[1],
+        )[:5]
+        results[module] = {
+            "seconds": times[module],
+            "lazy_loaded": loaded,
+            "slowest": [f"{name} {1e3 * t:.0f}ms" for name, t in slowest],
+        }
+        print(
+            f"{module:<40} {1e3 * times[module]:8.1f}ms  "
+            f"slowest: {', '.join(results[module]['slowest'][:3])}"
+        )
+    return results
+
+
+def main(
+    modules: List[str],
+    baseline_path: str = DEFAULT_BASELINE,
+    save_baseline: bool = False,
+    threshold: float = 0.2,
+    min_seconds: float = 0.1,
+    repeat: int = 5,
+    require_baseline: bool = False,
+) -> int:
+    """
+    Runs the benchmark and saves or checks the baseline.
+
+    Parameters
+    ----------
+    modules: List[str]
+        Modules to import
+    baseline_path: str
+        Path of the baseline json
+    save_baseline: bool
+        Whether to store the results as the baseline
+    threshold: float
+        Allowed relative increase. Default: 0.2
+    min_seconds: float
+        Allowed absolute increase, since small import times
+        are dominated by noise. Default: 0.1
+    repeat: int
+        Interpreters per module. Default: 5
+    require_baseline: bool
+        Whether a missing baseline is a failure. Default: False
+
+    Returns
+    -------
+    int
+        Exit code, 1 if a lazy module is imported, there are
+        regressions or a required baseline is missing
+    """
+    results = run(modules, repeat)
+    failures = [
+        f"{module} imports {', '.join(result['lazy_loaded'])}"
+        for module, result in results.items()
+        if result["lazy_loaded"]
+    ]
+
+    if save_baseline:
+        baseline = {}
+        if os.path.exists(baseline_path):
+            with open(baseline_path, "r") as f:
+                baseline = json.load(f)
+        baseline.update(
+            {module: {"seconds": r["seconds"]} for module, r in results.items()}
+        )
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print(f"Saved {len(results)} results to {baseline_path}")
+    elif os.path.exists(baseline_path):
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)
+        for module, result in results.items():
+            if module not in baseline:
+                continue
+            before = baseline[module]["seconds"]
+            after = result["seconds"]
+            if after > before * (1 + threshold) and after - before > min_seconds:
+                failures.append(
+                    f"{module} seconds: {before:.3f} -> {after:.3f} "
+                    f"(+{100 * (after / max(before, 1e-12) - 1):.0f}%)"
+                )
+    elif require_baseline:
+        failures.append(f"no baseline in {baseline_path}")
+    else:
+        print(f"No baseline in {baseline_path}, run with --save_baseline")
+
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modules", type=str, nargs="+", default=MODULES)
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE)
+    parser.add_argument("--save_baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--require_baseline", action="store_true")
+    args = parser.parse_args()
+
+    sys.exit(
+        main(
+            args.modules,
+            baseline_path=args.baseline,
+            save_baseline=args.save_baseline,
+            threshold=args.threshold,
+            repeat=args.repeat,
+            require_baseline=args.require_baseline,
+        )
+    )
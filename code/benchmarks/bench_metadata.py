@@ -0,0 +1,279 @@
+"""
+Benchmarks the metadata and XML code paths that run on every
+dataset with synthetic tile metadata: reading the records of
+a channel, parse_json, write_xml, tile_number_to_position
+and bigstitcher.main end to end,
+including the processing metadata. Wall time and peak traced
+memory of each case are compared against a stored baseline
+and the run fails if any of them regressed beyond a threshold.
+
+Run from the code folder:
+    python -m benchmarks.bench_metadata --n_tiles 10 1000 10000 \
+        --n_channels 1 4 --layouts regular jittered sparse
+    python -m benchmarks.bench_metadata --save_baseline
+
+The baseline of the default cases is stored in
+benchmarks/baselines/metadata.json. Timings depend on the
+machine, so save a new baseline before comparing on another
+one. --require_baseline makes a missing baseline a failure.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Dict, List
+
+from aind_proteomics_stitch import (bigstitcher, bigstitcher_utilities,
+                                    metadata_reader)
+
+from . import synthetic
+
+DEFAULT_BASELINE = str(Path(__file__).parent.joinpath("baselines", "metadata.json"))
+
+# Number of tiles converted by tile_number_to_position,
+# which recomputes the grid of the dataset on every call
+N_POSITION_LOOKUPS = 10
+
+
+def measure(function: Callable, repeat: int = 3) -> Dict[str, float]:
+    """
+    Measures the wall time of a function call and the
+    peak traced memory of a separate call, since tracing
+    slows down code that allocates many small objects.
+    The fastest of repeat calls is kept, since the rest
+    measure scheduling and cache noise.
+    """
+    elapsed = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        elapsed = min(elapsed, perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": elapsed, "peak_mib": peak / 1024**2}
+
+
+def run_case(
+    folder: str, n_tiles: int, n_channels: int, layout: str, repeat: int = 3
+) -> Dict[str, Dict[str, float]]:
+    """
+    Benchmarks every code path on one synthetic dataset.
+    """
+    metadata_path = os.path.join(folder, "all_channel_tile_metadata.json")
+    records = synthetic.write_tile_metadata(
+        metadata_path, n_tiles, n_channels=n_channels, layout=layout
+    )
+    channel = records[0]["channel_wavelength"]
+    channel_metadata = [t for t in records if t["channel_wavelength"] == channel]
+    channel_path = os.path.join(folder, "channel_tile_metadata.json")
+    with open(channel_path, "w") as f:
+        json.dump(channel_metadata, f)
+
+    trees = {}
+    results_folder = Path(folder).joinpath("results")
+    results_folder.mkdir(exist_ok=True)
+
+    def read_channel():
+        metadata_reader.read_tile_metadata(metadata_path, [channel])
+
+    def parse():
+        trees["tree"] = bigstitcher_utilities.parse_json(
+            channel_path, "s3://bucket/dataset.zarr", microns=True
+        )
+
+    def write():
+        bigstitcher_utilities.write_xml(
+            trees["tree"], os.path.join(folder, "dataset.xml")
+        )
+
+    def positions():
+        n_lookups = min(N_POSITION_LOOKUPS, len(channel_metadata))
+        for tile_number in range(n_lookups):
+            bigstitcher_utilities.tile_number_to_position(tile_number, channel_metadata)
+
+    def end_to_end():
+        # main prints the parameters path for the run script
+        with contextlib.redirect_stdout(io.StringIO()):
+            bigstitcher.main(
+                path_to_data=os.path.join(folder, "missing_data"),
+                channel_wavelength=channel,
+                path_to_tile_metadata=metadata_path,
+                voxel_resolution=[0.75, 0.75, 2.0],
+                output_json_file=results_folder.joinpath("tile_metadata.json"),
+                results_folder=results_folder,
+                proteomics_dataset_name="synthetic",
+                scale_for_transforms=2,
+                validate_tiles=False,
+            )
+
+    return {
+        "read_tile_metadata": measure(read_channel, repeat),
+        "parse_json": measure(parse, repeat),
+        "write_xml": measure(write, repeat),
+        "tile_number_to_position": measure(positions, repeat),
+        "bigstitcher_main": measure(end_to_end, repeat),
+    }
+
+
+def run(
+    n_tiles: List[int], n_channels: List[int], layouts: List[str], repeat: int = 3
+) -> Dict[str, Dict[str, float]]:
+    """
+    Benchmarks every combination of dataset parameters.
+
+    Returns
+    -------
+    Dict[str, Dict[str, float]]
+        Time and peak memory of every case, keyed by
+        "<layout>/<channels>ch/<tiles>/<code path>"
+    """
+    results = {}
+    for layout in layouts:
+        for channels in n_channels:
+            for tiles in n_tiles:
+                if tiles < channels:
+                    continue
+                with tempfile.TemporaryDirectory() as folder:
+                    case = run_case(folder, tiles, channels, layout, repeat)
+                for name, result in case.items():
+                    key = f"{layout}/{channels}ch/{tiles}/{name}"
+                    results[key] = result
+                    print(
+                        f"{key:<55} {result['seconds']:9.3f}s "
+                        f"{result['peak_mib']:9.1f} MiB"
+                    )
+    return results
+
+
+def find_regressions(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float = 0.2,
+    min_seconds: float = 0.05,
+    min_peak_mib: float = 1.0,
+) -> List[str]:
+    """
+    Compares results against a baseline.
+
+    Parameters
+    ----------
+    results: Dict[str, Dict[str, float]]
+        Results of run
+    baseline: Dict[str, Dict[str, float]]
+        Stored results
+    threshold: float
+        Allowed relative increase. Default: 0.2
+    min_seconds: float
+        Cases faster than this in the baseline are not
+        checked for time, since they are dominated by
+        noise. Default: 0.05
+    min_peak_mib: float
+        Cases that use less memory than this in the
+        baseline are not checked for memory. Default: 1.0
+
+    Returns
+    -------
+    List[str]
+        Description of every regression
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ("seconds", "peak_mib"):
+            before = baseline[key][metric]
+            after = result[metric]
+            if before < (min_seconds if metric == "seconds" else min_peak_mib):
+                continue
+            if after > before * (1 + threshold):
+                regressions.append(
+                    f"{key} {metric}: {before:.3f} -> {after:.3f} "
+                    f"(+{100 * (after / max(before, 1e-12) - 1):.0f}%)"
+                )
+    return regressions
+
+
+def main(
+    n_tiles: List[int],
+    n_channels: List[int],
+    layouts: List[str],
+    baseline_path: str = DEFAULT_BASELINE,
+    save_baseline: bool = False,
+    threshold: float = 0.2,
+    require_baseline: bool = False,
+    repeat: int = 3,
+) -> int:
+    """
+    Runs the benchmarks and saves or checks the baseline.
+
+    Returns
+    -------
+    int
+        Exit code, 1 if there are regressions or the baseline
+        is missing and require_baseline is set
+    """
+    results = run(n_tiles, n_channels, layouts, repeat)
+
+    if save_baseline:
+        baseline = {}
+        if os.path.exists(baseline_path):
+            with open(baseline_path, "r") as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print(f"Saved {len(results)} results to {baseline_path}")
+        return 0
+
+    if not os.path.exists(baseline_path):
+        print(f"No baseline in {baseline_path}, run with --save_baseline")
+        return 1 if require_baseline else 0
+
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+
+    regressions = find_regressions(results, baseline, threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regressions above {100 * threshold:.0f}%")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n_tiles", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--n_channels", type=int, nargs="+", default=[1, 4])
+    parser.add_argument(
+        "--layouts", type=str, nargs="+", default=list(synthetic.LAYOUTS)
+    )
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE)
+    parser.add_argument("--save_baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--require_baseline", action="store_true")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    sys.exit(
+        main(
+            args.n_tiles,
+            args.n_channels,
+            args.layouts,
+            baseline_path=args.baseline,
+            save_baseline=args.save_baseline,
+            threshold=args.threshold,
+            require_baseline=args.require_baseline,
+            repeat=args.repeat,
+        )
+    )
@@ -0,0 +1,245 @@
+"""
+Measures the accuracy and throughput of the in-process
+registration on a synthetic mosaic with known positions.
+For every pyramid level it reports the error of the pairwise
+shifts against the ground truth, the pairs registered per
+second and the bytes of the chunks read.
+
+Run from the code folder:
+    python -m benchmarks.bench_registration --grid 3 3 \
+        --tile_size 256 256 64 --levels 0 1 2 --min_correlation 0.6
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from time import perf_counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from aind_proteomics_stitch import (bigstitcher, bigstitcher_utilities,
+                                    overlaps, phase_correlation)
+from aind_proteomics_stitch.spatial_index import TileIndex
+
+from . import synthetic_mosaic
+
+
+def get_expected_shifts(
+    tile_metadata: List[Dict], true_positions: Dict[str, List[float]]
+) -> Dict[tuple, np.ndarray]:
+    """
+    Shift in microns of the second tile of every pair with
+    respect to its nominal position relative to the first,
+    which is what the registration estimates.
+    """
+    nominal = {t["file"]: np.asarray(t["position"]) for t in tile_metadata}
+    true = {name: np.asarray(position) for name, position in true_positions.items()}
+    return {
+        (a, b): (true[b] - true[a]) - (nominal[b] - nominal[a])
+        for a in nominal
+        for b in nominal
+        if a != b
+    }
+
+
+def estimate_bytes_read(dataset: Dict, level: int, max_shift: np.ndarray) -> int:
+    """
+    Bytes of the chunks intersecting the overlap boxes
+    registered at a level.
+    """
+    arrays = [
+        phase_correlation.get_tile_array(dataset["zarr_path"], tile, level)
+        for tile in dataset["tiles"]
+    ]
+    level_scale = phase_correlation.get_level_scale(arrays[0], dataset["tile_sizes"][0])
+    pairs = TileIndex(
+        dataset["tile_translations"], dataset["tile_sizes"], dataset["tile_resolution"]
+    ).overlapping_pairs()
+    boxes = overlaps.get_overlap_boxes(
+        dataset["tile_translations"],
+        dataset["tile_sizes"],
+        dataset["tile_resolution"],
+        pairs,
+        level_scale=level_scale,
+        max_shift=max_shift,
+    )
+    return int(
+        sum(
+            overlaps.estimate_box_bytes(arrays[box["pair"][0]], box["fixed_box"])
+            + overlaps.estimate_box_bytes(arrays[box["pair"][1]], box["moving_box"])
+            for box in boxes
+        )
+    )
+
+
+def run_level(
+    paths: Dict[str, str],
+    level: int,
+    min_correlation: float,
+    parallel: int,
+    memgb: int,
+) -> Dict:
+    """
+    Registers the mosaic at a level and compares the
+    shifts against the ground truth.
+    """
+    stitching_dict = bigstitcher.get_stitching_dict(
+        specimen_id="synthetic",
+        dataset_xml_path=paths["dataset_xml"],
+        downsample=level,
+        memgb=memgb,
+        parallel=parallel,
+    )
+    stitching_dict["phase_correlation_params"]["min_correlation"] = min_correlation
+    params = stitching_dict["phase_correlation_params"]
+    max_shift = np.array(
+        [params["max_shift_in_x"], params["max_shift_in_y"], params["max_shift_in_z"]]
+    )
+
+    with open(paths["tile_metadata"], "r") as f:
+        tile_metadata = json.load(f)
+    with open(paths["true_positions"], "r") as f:
+        expected = get_expected_shifts(tile_metadata, json.load(f))
+
+    dataset = bigstitcher_utilities.parse_xml(paths["dataset_xml"])
+    bytes_read = estimate_bytes_read(dataset, level, max_shift)
+    n_pairs = len(
+        TileIndex(
+            dataset["tile_translations"],
+            dataset["tile_sizes"],
+            dataset["tile_resolution"],
+        ).overlapping_pairs()
+    )
+
+    start = perf_counter()
+    shifts = phase_correlation.compute_pairwise_shifts(stitching_dict)
+    seconds = perf_counter() - start
+
+    errors = np.array(
+        [
+            np.linalg.norm(
+                np.asarray(s["shift"]) - expected[(s["tile_a"], s["tile_b"])]
+            )
+            for s in shifts
+        ]
+    )
+    voxel = np.asarray(tile_metadata[0]["pixel_resolution"])
+    return {
+        "level": level,
+        "pairs": n_pairs,
+        "accepted": len(shifts),
+        "seconds": seconds,
+        "pairs_per_second": n_pairs / seconds if seconds else float("inf"),
+        "bytes_read": bytes_read,
+        "median_error_um": float(np.median(errors)) if len(errors) else None,
+        "max_error_um": float(np.max(errors)) if len(errors) else None,
+        # Shifts off by more than a level 0 voxel
+        "outliers": int(np.sum(errors > np.linalg.norm(voxel))),
+    }
+
+
+def run(
+    output_folder: str,
+    levels: List[int],
+    min_correlation: float = 0.6,
+    parallel: int = 1,
+    memgb: int = 4,
+    **mosaic_kwargs,
+) -> List[Dict]:
+    """
+    Writes a synthetic mosaic and registers it at
+    every level.
+
+    Parameters
+    ----------
+    output_folder: str
+        Folder where the mosaic is written
+    levels: List[int]
+        Pyramid levels to register
+    min_correlation: float
+        Minimum correlation of an accepted pair. Default: 0.6
+    parallel: int
+        Registration workers. Default: 1
+    memgb: int
+        Memory budget in GB of the registration. Default: 4
+    **mosaic_kwargs
+        Arguments of synthetic_mosaic.make_mosaic
+
+    Returns
+    -------
+    List[Dict]
+        Results of every level
+    """
+    paths = synthetic_mosaic.make_mosaic(output_folder, **mosaic_kwargs)
+    return [
+        run_level(paths, level, min_correlation, parallel, memgb) for level in levels
+    ]
+
+
+def main(
+    levels: List[int],
+    output: Optional[str] = None,
+    results_json: Optional[str] = None,
+    **kwargs,
+) -> List[Dict]:
+    """
+    Runs the harness in the output folder or in a
+    temporary folder, and prints a table of the results.
+    """
+    if output is None:
+        with tempfile.TemporaryDirectory() as folder:
+            results = run(folder, levels, **kwargs)
+    else:
+        os.makedirs(output, exist_ok=True)
+        results = run(output, levels, **kwargs)
+
+    for r in results:
+        median = "-" if r["median_error_um"] is None else f"{r['median_error_um']:.3f}"
+        maximum = "-" if r["max_error_um"] is None else f"{r['max_error_um']:.3f}"
+        print(
+            f"level {r['level']} | {r['accepted']}/{r['pairs']} pairs | "
+            f"error median {median} um max {maximum} um, {r['outliers']} outliers | "
+            f"{r['pairs_per_second']:.2f} pairs/s | "
+            f"{r['bytes_read'] / 1024 ** 2:.1f} MiB read"
+        )
+
+    if results_json is not None:
+        with open(results_json, "w") as f:
+            json.dump(results, f, indent=4)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--results_json", type=str, default=None)
+    parser.add_argument("--levels", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--min_correlation", type=float, default=0.6)
+    parser.add_argument("--parallel", type=int, default=1)
+    parser.add_argument("--memgb", type=int, default=4)
+    parser.add_argument("--grid", type=int, nargs=2, default=[3, 3])
+    parser.add_argument("--tile_size", type=int, nargs=3, default=[256, 256, 64])
+    parser.add_argument("--overlap", type=float, default=0.15)
+    parser.add_argument("--jitter", type=int, default=6)
+    parser.add_argument("--n_levels", type=int, default=3)
+    parser.add_argument("--chunks", type=int, nargs=3, default=[64, 128, 128])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(
+        levels=args.levels,
+        output=args.output,
+        results_json=args.results_json,
+        min_correlation=args.min_correlation,
+        parallel=args.parallel,
+        memgb=args.memgb,
+        grid=args.grid,
+        tile_size=args.tile_size,
+        overlap=args.overlap,
+        jitter=args.jitter,
+        n_levels=args.n_levels,
+        chunks=args.chunks,
+        seed=args.seed,
+    )
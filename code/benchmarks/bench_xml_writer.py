@@ -0,0 +1,89 @@
+"""
+Benchmarks the streaming XML writer against building the
+ElementTree with parse_json and writing it with write_xml.
+
+Run from the code folder:
+    python -m benchmarks.bench_xml_writer --n_tiles 1000 10000 100000
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import tracemalloc
+from time import perf_counter
+from typing import Callable, Dict
+
+from aind_proteomics_stitch import bigstitcher_utilities, xml_streaming
+
+from .synthetic import make_tile_metadata
+
+
+def measure(function: Callable) -> Dict[str, float]:
+    """
+    Measures the wall time and the peak traced
+    memory of a function call.
+    """
+    tracemalloc.start()
+    start = perf_counter()
+    function()
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": elapsed, "peak_mib": peak / 1024**2}
+
+
+def run(n_tiles: int, folder: str) -> Dict:
+    """
+    Writes the XML of a synthetic dataset with both
+    writers and checks that the outputs are identical.
+    """
+    json_path = os.path.join(folder, f"tiles_{n_tiles}.json")
+    tree_xml = os.path.join(folder, f"tree_{n_tiles}.xml")
+    streaming_xml = os.path.join(folder, f"streaming_{n_tiles}.xml")
+
+    with open(json_path, "w") as f:
+        json.dump(make_tile_metadata(n_tiles, n_channels=4, layout="jittered"), f)
+
+    def write_tree():
+        tree = bigstitcher_utilities.parse_json(
+            json_path, "s3://bucket/dataset.zarr", microns=True
+        )
+        bigstitcher_utilities.write_xml(tree, tree_xml)
+
+    def write_streaming():
+        with open(json_path, "r") as f:
+            json_dict = json.load(f)
+        xml_streaming.write_json_xml_streaming(
+            json_dict, streaming_xml, "s3://bucket/dataset.zarr", microns=True
+        )
+
+    result = {
+        "n_tiles": n_tiles,
+        "tree": measure(write_tree),
+        "streaming": measure(write_streaming),
+    }
+    with open(tree_xml, "rb") as f_tree, open(streaming_xml, "rb") as f_streaming:
+        result["identical"] = f_tree.read() == f_streaming.read()
+
+    for path in (json_path, tree_xml, streaming_xml):
+        os.remove(path)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n_tiles", type=int, nargs="+", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        for n_tiles in args.n_tiles:
+            result = run(n_tiles, folder)
+            print(
+                f"{n_tiles:>7} tiles | "
+                f"tree {result['tree']['seconds']:7.2f}s "
+                f"{result['tree']['peak_mib']:8.1f} MiB | "
+                f"streaming {result['streaming']['seconds']:7.2f}s "
+                f"{result['streaming']['peak_mib']:8.1f} MiB | "
+                f"identical: {result['identical']}"
+            )
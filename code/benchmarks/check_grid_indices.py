@@ -0,0 +1,128 @@
+"""
+Checks the grid indices inferred from tile positions against
+the grid the positions were generated on: the synthetic
+layouts, flat mosaics whose z positions only have stage
+jitter, and single row and single column mosaics. The run
+fails if any tile gets a wrong index.
+
+Run from the code folder:
+    python -m benchmarks.check_grid_indices
+"""
+
+import argparse
+import sys
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from aind_proteomics_stitch import bigstitcher_utilities
+
+from . import synthetic
+
+TILE_SIZE = (2048, 2048, 512)
+PIXEL_RESOLUTION = (0.75, 0.75, 2.0)
+OVERLAP = 0.1
+
+
+def make_grid_case(
+    shape: Tuple[int, int], jitter: float, z_jitter: float, seed: int = 0
+) -> Tuple[List[Dict], np.ndarray]:
+    """
+    Tile metadata of a rectangular grid with stage jitter in
+    X and Y and a flat Z with its own jitter.
+
+    Returns
+    -------
+    Tuple[List[Dict], np.ndarray]
+        Tile metadata records and the expected grid index
+        (n, 3) of every tile
+    """
+    rng = np.random.default_rng(seed)
+    xs, ys = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+    grid = np.stack([xs.ravel(), ys.ravel(), np.zeros(xs.size, dtype=int)], axis=1)
+
+    step = np.asarray(TILE_SIZE, float) * np.asarray(PIXEL_RESOLUTION) * (1 - OVERLAP)
+    positions = grid * step
+    positions[:, :2] += rng.normal(0, jitter, (len(grid), 2))
+    positions[:, 2] += rng.normal(0, z_jitter, len(grid))
+
+    records = [
+        {
+            "file": f"Tile_X_{x:04d}_Y_{y:04d}_Z_0000_ch_488.ome.zarr",
+            "size": list(TILE_SIZE),
+            "position": [float(p) for p in position],
+            "pixel_resolution": list(PIXEL_RESOLUTION),
+            "channel_wavelength": 488,
+        }
+        for (x, y, _), position in zip(grid, positions)
+    ]
+    return records, grid
+
+
+def make_layout_case(layout: str, n_tiles: int) -> Tuple[List[Dict], np.ndarray]:
+    """
+    Tile metadata of a synthetic layout and its grid.
+    """
+    records = synthetic.make_tile_metadata(
+        n_tiles,
+        layout=layout,
+        tile_size=TILE_SIZE,
+        pixel_resolution=PIXEL_RESOLUTION,
+        overlap=OVERLAP,
+    )
+    grid = np.array(
+        [
+            [int(record["file"].split("_")[2]), int(record["file"].split("_")[4]), 0]
+            for record in records
+        ]
+    )
+    # Sparse layouts start the grid inside the ellipse
+    return records, grid - grid.min(axis=0)
+
+
+def get_cases() -> Dict[str, Tuple[List[Dict], np.ndarray]]:
+    """
+    Every checked mosaic.
+    """
+    cases = {
+        "flat_4x3": make_grid_case((4, 3), jitter=2.0, z_jitter=0.3),
+        "flat_4x3_exact": make_grid_case((4, 3), jitter=0.0, z_jitter=0.0),
+        "single_row": make_grid_case((6, 1), jitter=2.0, z_jitter=0.3),
+        "single_column": make_grid_case((1, 6), jitter=2.0, z_jitter=0.3),
+        "single_tile": make_grid_case((1, 1), jitter=2.0, z_jitter=0.3),
+    }
+    for layout in synthetic.LAYOUTS:
+        cases[layout] = make_layout_case(layout, 100)
+    return cases
+
+
+def main() -> int:
+    """
+    Runs every case.
+
+    Returns
+    -------
+    int
+        Exit code, 1 if any tile got a wrong index
+    """
+    failures = []
+    for name, (records, expected) in get_cases().items():
+        indices = bigstitcher_utilities.get_tile_grid_indices(records)
+        wrong = np.flatnonzero(np.any(indices != expected, axis=1))
+        print(f"{name:<20} {len(records):5d} tiles {len(wrong):5d} wrong")
+        if len(wrong):
+            k = wrong[0]
+            failures.append(
+                f"{name}: tile {k} got {indices[k].tolist()}, "
+                f"expected {expected[k].tolist()}"
+            )
+
+    for failure in failures:
+        print(f"FAILURE {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.parse_args()
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""
+Synthetic all_channel_tile_metadata.json generators for
+the benchmarks. Tiles are laid out on a regular grid, a
+grid with stage jitter or a sparse grid where only the
+tiles inside an elliptical sample are acquired, with the
+same positions repeated for every channel.
+"""
+
+import json
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+LAYOUTS = ("regular", "jittered", "sparse")
+
+# Excitation wavelengths of the synthetic channels
+WAVELENGTHS = [
+    405, 445, 488, 514, 532, 561, 594, 639, 660, 685,
+    730, 750, 785, 808, 830, 850, 880, 915, 940, 980,
+]  # fmt: skip
+
+
+def get_grid_positions(
+    n_positions: int,
+    layout: str = "regular",
+    tile_size: Sequence[int] = (2048, 2048, 512),
+    pixel_resolution: Sequence[float] = (0.75, 0.75, 2.0),
+    overlap: float = 0.1,
+    jitter: float = 2.0,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Tile positions of a single channel.
+
+    Parameters
+    ----------
+    n_positions: int
+        Number of tile positions
+    layout: str
+        "regular", "jittered" or "sparse". Default: "regular"
+    tile_size: Sequence[int]
+        Tile size in voxels in XYZ order
+    pixel_resolution: Sequence[float]
+        Voxel size in microns in XYZ order
+    overlap: float
+        Overlap fraction between neighboring tiles. Default: 0.1
+    jitter: float
+        Standard deviation in microns of the stage jitter
+        of the jittered layout. Default: 2.0
+    seed: int
+        Random seed. Default: 0
+
+    Returns
+    -------
+    np.ndarray
+        Positions (n_positions, 3) in microns in XYZ order
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout}, use one of {LAYOUTS}")
+
+    rng = np.random.default_rng(seed)
+    step = np.asarray(tile_size[:2], float) * np.asarray(pixel_resolution[:2])
+    step *= 1 - overlap
+
+    if layout == "sparse":
+        # Grid large enough that its inscribed ellipse holds
+        # the positions, scanned in row order
+        side = int(np.ceil(np.sqrt(n_positions * 4 / np.pi))) + 2
+        while True:
+            xs, ys = np.meshgrid(np.arange(side), np.arange(side))
+            center = (side - 1) / 2
+            inside = ((xs - center) / (side / 2)) ** 2 + (
+                (ys - center) / (side / 2)
+            ) ** 2 <= 1
+            if inside.sum() >= n_positions:
+                break
+            side += 1
+        grid = np.stack([xs[inside], ys[inside]], axis=1)[:n_positions]
+    else:
+        side = int(np.ceil(np.sqrt(n_positions)))
+        indices = np.arange(n_positions)
+        grid = np.stack([indices % side, indices // side], axis=1)
+
+    positions = np.zeros((n_positions, 3))
+    positions[:, :2] = grid * step
+    if layout == "jittered":
+        positions[:, :2] += rng.normal(0, jitter, (n_positions, 2))
+    return positions
+
+
+def make_tile_metadata(
+    n_tiles: int,
+    n_channels: int = 1,
+    layout: str = "regular",
+    tile_size: Sequence[int] = (2048, 2048, 512),
+    pixel_resolution: Sequence[float] = (0.75, 0.75, 2.0),
+    overlap: float = 0.1,
+    seed: int = 0,
+) -> List[Dict]:
+    """
+    Generates the tile metadata records of a synthetic
+    dataset.
+
+    Parameters
+    ----------
+    n_tiles: int
+        Number of tiles over all the channels
+    n_channels: int
+        Number of channels, up to 20. Default: 1
+    layout: str
+        "regular", "jittered" or "sparse". Default: "regular"
+    tile_size: Sequence[int]
+        Tile size in voxels in XYZ order
+    pixel_resolution: Sequence[float]
+        Voxel size in microns in XYZ order
+    overlap: float
+        Overlap fraction between neighboring tiles. Default: 0.1
+    seed: int
+        Random seed. Default: 0
+
+    Returns
+    -------
+    List[Dict]
+        Tile metadata records ordered by channel
+    """
+    if not 1 <= n_channels <= len(WAVELENGTHS):
+        raise ValueError(f"n_channels must be between 1 and {len(WAVELENGTHS)}")
+
+    n_positions = int(np.ceil(n_tiles / n_channels))
+    positions = get_grid_positions(
+        n_positions,
+        layout=layout,
+        tile_size=tile_size,
+        pixel_resolution=pixel_resolution,
+        overlap=overlap,
+        seed=seed,
+    )
+    step = np.asarray(tile_size[:2], float) * np.asarray(pixel_resolution[:2])
+    grid = np.round(positions[:, :2] / (step * (1 - overlap))).astype(int)
+
+    records = []
+    for i in range(n_tiles):
+        position = i % n_positions
+        channel = WAVELENGTHS[i // n_positions]
+        x, y = grid[position]
+        records.append(
+            {
+                "file": f"Tile_X_{x:04d}_Y_{y:04d}_Z_0000_ch_{channel}.ome.zarr",
+                "size": [int(s) for s in tile_size],
+                "position": [float(p) for p in positions[position]],
+                "pixel_resolution": [float(r) for r in pixel_resolution],
+                "channel_wavelength": channel,
+            }
+        )
+    return records
+
+
+def write_tile_metadata(path: str, *args, **kwargs) -> List[Dict]:
+    """
+    Writes the metadata of a synthetic dataset as an
+    all_channel_tile_metadata.json file.
+
+    Parameters
+    ----------
+    path: str
+        Path of the json
+    *args, **kwargs
+        Arguments of make_tile_metadata
+
+    Returns
+    -------
+    List[Dict]
+        Tile metadata records
+    """
+    records = make_tile_metadata(*args, **kwargs)
+    with open(path, "w") as f:
+        json.dump(records, f)
+    return records
@@ -0,0 +1,281 @@
+"""
+Synthetic OME-Zarr mosaics with known tile positions. A
+procedurally textured volume is cut into overlapping tiles
+at jittered stage positions, and every tile is written as a
+multiscale OME-Zarr store with the tile metadata, the dataset
+XML and the true positions of the tiles, so registration
+results can be checked against the ground truth.
+
+Run from the code folder:
+    python -m benchmarks.synthetic_mosaic --output /tmp/mosaic \
+        --grid 3 3 --tile_size 256 256 64
+"""
+
+import argparse
+import json
+import os
+from typing import Dict, List, Sequence
+
+import numpy as np
+import zarr
+from scipy import ndimage
+
+from aind_proteomics_stitch import xml_streaming
+
+
+def make_volume(
+    shape: Sequence[int], seed: int = 0, n_blobs: int = 2000, sigma: float = 2.0
+) -> np.ndarray:
+    """
+    Generates a textured volume: smoothed noise with bright
+    blobs of random sizes, similar to labeled nuclei.
+
+    Parameters
+    ----------
+    shape: Sequence[int]
+        Shape of the volume in ZYX order
+    seed: int
+        Random seed. Default: 0
+    n_blobs: int
+        Number of blobs. Default: 2000
+    sigma: float
+        Smoothing of the background noise in voxels. Default: 2.0
+
+    Returns
+    -------
+    np.ndarray
+        uint16 volume
+    """
+    rng = np.random.default_rng(seed)
+    volume = ndimage.gaussian_filter(rng.random(shape, dtype=np.float32), sigma)
+    volume = (volume - volume.min()) / max(float(np.ptp(volume)), 1e-6) * 200
+
+    blobs = np.zeros(shape, dtype=np.float32)
+    centers = (rng.random((n_blobs, 3)) * np.asarray(shape)).astype(int)
+    blobs[tuple(centers.T)] = rng.uniform(2e4, 6e4, n_blobs)
+    for blob_sigma in (1.0, 2.0, 3.0):
+        volume += ndimage.gaussian_filter(blobs, blob_sigma) * blob_sigma
+
+    return np.clip(volume + 100, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+def downsample(data: np.ndarray) -> np.ndarray:
+    """
+    Downsamples the last three axes by 2 with a mean.
+    """
+    z, y, x = data.shape[-3:]
+    blocks = data.reshape(data.shape[:-3] + (z // 2, 2, y // 2, 2, x // 2, 2))
+    return blocks.mean(axis=(-5, -3, -1)).astype(data.dtype)
+
+
+def write_ome_zarr(
+    path: str,
+    data: np.ndarray,
+    pixel_resolution: Sequence[float],
+    n_levels: int = 3,
+    chunks: Sequence[int] = (64, 128, 128),
+) -> None:
+    """
+    Writes a tile as a multiscale OME-Zarr store with
+    (t, c, z, y, x) arrays downsampled by 2 in every axis.
+
+    Parameters
+    ----------
+    path: str
+        Path of the store
+    data: np.ndarray
+        Tile data in ZYX order
+    pixel_resolution: Sequence[float]
+        Voxel size in microns in XYZ order
+    n_levels: int
+        Number of multiscale levels. Default: 3
+    chunks: Sequence[int]
+        Chunk shape in ZYX order. Default: (64, 128, 128)
+    """
+    group = zarr.open_group(path, mode="w")
+    resolution_zyx = np.asarray(pixel_resolution, float)[::-1]
+
+    datasets = []
+    level_data = data[None, None]
+    for level in range(n_levels):
+        group.create_dataset(
+            str(level),
+            data=level_data,
+            chunks=(1, 1) + tuple(int(c) for c in chunks),
+            dimension_separator="/",
+            overwrite=True,
+        )
+        scale = (resolution_zyx * 2**level).tolist()
+        datasets.append(
+            {
+                "path": str(level),
+                "coordinateTransformations": [
+                    {"type": "scale", "scale": [1.0, 1.0] + scale}
+                ],
+            }
+        )
+        level_data = downsample(level_data)
+
+    group.attrs["multiscales"] = [
+        {
+            "version": "0.4",
+            "name": os.path.basename(path),
+            "axes": [
+                {"name": "t", "type": "time", "unit": "millisecond"},
+                {"name": "c", "type": "channel"},
+                {"name": "z", "type": "space", "unit": "micrometer"},
+                {"name": "y", "type": "space", "unit": "micrometer"},
+                {"name": "x", "type": "space", "unit": "micrometer"},
+            ],
+            "datasets": datasets,
+        }
+    ]
+
+
+def make_mosaic(
+    output_folder: str,
+    grid: Sequence[int] = (3, 3),
+    tile_size: Sequence[int] = (256, 256, 64),
+    pixel_resolution: Sequence[float] = (0.75, 0.75, 2.0),
+    overlap: float = 0.15,
+    jitter: int = 6,
+    n_levels: int = 3,
+    chunks: Sequence[int] = (64, 128, 128),
+    channel_wavelength: int = 488,
+    seed: int = 0,
+) -> Dict[str, str]:
+    """
+    Writes a synthetic mosaic with the files that
+    bigstitcher.main and the registration expect.
+
+    Parameters
+    ----------
+    output_folder: str
+        Folder of the mosaic. Tiles are written to its
+        data folder
+    grid: Sequence[int]
+        Number of tiles in X and Y. Default: (3, 3)
+    tile_size: Sequence[int]
+        Tile size in voxels in XYZ order. Every axis must be
+        divisible by 2 ** (n_levels - 1)
+    pixel_resolution: Sequence[float]
+        Voxel size in microns in XYZ order
+    overlap: float
+        Nominal overlap fraction between neighboring tiles.
+        Default: 0.15
+    jitter: int
+        Maximum stage error in voxels in X and Y. Default: 6
+    n_levels: int
+        Number of multiscale levels. Default: 3
+    chunks: Sequence[int]
+        Chunk shape in ZYX order. Default: (64, 128, 128)
+    channel_wavelength: int
+        Channel of the tiles. Default: 488
+    seed: int
+        Random seed. Default: 0
+
+    Returns
+    -------
+    Dict[str, str]
+        Paths of the data folder, the tile metadata json,
+        the dataset XML and the true positions json
+    """
+    tile_size = np.asarray(tile_size, dtype=int)
+    if np.any(tile_size % 2 ** (n_levels - 1)):
+        raise ValueError(
+            f"Tile size {tile_size.tolist()} must be divisible by "
+            f"{2 ** (n_levels - 1)} to write {n_levels} levels"
+        )
+
+    rng = np.random.default_rng(seed)
+    step = np.round(tile_size[:2] * (1 - overlap)).astype(int)
+
+    # Voxel origins at level 0 of every tile in the volume,
+    # which has room for the largest stage error
+    nominal = {}
+    true = {}
+    for ix in range(grid[0]):
+        for iy in range(grid[1]):
+            origin = np.array([ix, iy]) * step + jitter
+            nominal[(ix, iy)] = origin
+            true[(ix, iy)] = origin + rng.integers(-jitter, jitter + 1, 2)
+
+    volume_xy = (np.array(grid) - 1) * step + tile_size[:2] + 2 * jitter
+    volume = make_volume(
+        (int(tile_size[2]), int(volume_xy[1]), int(volume_xy[0])), seed=seed
+    )
+
+    data_folder = os.path.join(output_folder, "data")
+    os.makedirs(data_folder, exist_ok=True)
+    resolution = np.asarray(pixel_resolution, float)
+
+    records: List[Dict] = []
+    true_positions = {}
+    for (ix, iy), (x0, y0) in true.items():
+        name = f"Tile_X_{ix:04d}_Y_{iy:04d}_Z_0000_ch_{channel_wavelength}.ome.zarr"
+        tile = volume[:, y0 : y0 + tile_size[1], x0 : x0 + tile_size[0]]
+        write_ome_zarr(
+            os.path.join(data_folder, name), tile, pixel_resolution, n_levels, chunks
+        )
+
+        nominal_xy = (nominal[(ix, iy)] - jitter) * resolution[:2]
+        true_xy = (np.array([x0, y0]) - jitter) * resolution[:2]
+        records.append(
+            {
+                "file": name,
+                "size": tile_size.tolist(),
+                "position": [float(nominal_xy[0]), float(nominal_xy[1]), 0.0],
+                "pixel_resolution": resolution.tolist(),
+                "channel_wavelength": int(channel_wavelength),
+            }
+        )
+        true_positions[name] = [float(true_xy[0]), float(true_xy[1]), 0.0]
+
+    paths = {
+        "data": os.path.abspath(data_folder),
+        "tile_metadata": os.path.join(output_folder, "all_channel_tile_metadata.json"),
+        "dataset_xml": os.path.join(output_folder, "dataset.xml"),
+        "true_positions": os.path.join(output_folder, "true_positions.json"),
+    }
+    with open(paths["tile_metadata"], "w") as f:
+        json.dump(records, f, indent=4)
+    with open(paths["true_positions"], "w") as f:
+        json.dump(true_positions, f, indent=4)
+
+    xml_streaming.write_json_xml_streaming(
+        json_dict=records,
+        path=paths["dataset_xml"],
+        s3_data_path=paths["data"],
+        data_path_type="relative",
+        microns=True,
+    )
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--grid", type=int, nargs=2, default=[3, 3])
+    parser.add_argument("--tile_size", type=int, nargs=3, default=[256, 256, 64])
+    parser.add_argument(
+        "--pixel_resolution", type=float, nargs=3, default=[0.75, 0.75, 2.0]
+    )
+    parser.add_argument("--overlap", type=float, default=0.15)
+    parser.add_argument("--jitter", type=int, default=6)
+    parser.add_argument("--n_levels", type=int, default=3)
+    parser.add_argument("--chunks", type=int, nargs=3, default=[64, 128, 128])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = make_mosaic(
+        args.output,
+        grid=args.grid,
+        tile_size=args.tile_size,
+        pixel_resolution=args.pixel_resolution,
+        overlap=args.overlap,
+        jitter=args.jitter,
+        n_levels=args.n_levels,
+        chunks=args.chunks,
+        seed=args.seed,
+    )
+    print(json.dumps(paths, indent=4))